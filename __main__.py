@@ -0,0 +1,34 @@
+# coding: utf-8
+"""
+Command line entry point, e.g.,
+    python -m plottery serve --workers 4
+    python -m plottery render manifest.json --workers 4
+"""
+import argparse
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m plottery")
+    subparsers = parser.add_subparsers(dest="command")
+
+    parser_serve = subparsers.add_parser("serve", help="run a plotting server (see serve.py)")
+    parser_serve.add_argument("--socket", default=None, help="path of the Unix socket (default: per-user file in $XDG_RUNTIME_DIR or /tmp)")
+    parser_serve.add_argument("--workers", type=int, default=1, help="number of worker processes (default: %(default)s)")
+    parser_serve.add_argument("--no-warmup", action="store_true", help="don't draw a plot before forking the workers")
+
+    parser_render = subparsers.add_parser("render", help="render the plots in a manifest (see render.py)")
+    parser_render.add_argument("manifest", help="json file describing the processes and plots")
+    parser_render.add_argument("--workers", type=int, default=1, help="number of worker processes (default: %(default)s)")
+    parser_render.add_argument("--dry-run", action="store_true", help="only print the names of the plots that would be made")
+
+    args = parser.parse_args(args)
+    if args.command == "serve":
+        from . import serve
+        serve.serve(socket_path=args.socket, workers=args.workers, warmup=not args.no_warmup)
+    elif args.command == "render":
+        from . import render
+        render.render(args.manifest, workers=args.workers, dry_run=args.dry_run)
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
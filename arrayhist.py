@@ -0,0 +1,142 @@
+# coding: utf-8
+"""
+A lightweight histogram made of numpy arrays, which the plotting functions
+accept anywhere they take a TH1/TH2, e.g.,
+    counts, edges = np.histogram(x, bins=50, range=(0,500))
+    ply.plot_hist(bgs=[ArrayHist(counts, edges, label="ttbar")], ...)
+It only becomes a ROOT histogram (see to_root) when it's time to draw it.
+"""
+import itertools
+import numpy as np
+
+name_counter = itertools.count()
+
+class ArrayHist(object):
+    """
+    counts and sumw2 are arrays with one entry per bin, optionally with
+    the under/overflow bins at both ends (for 2D, of shape (nx,ny) or (nx+2,ny+2),
+    indexed as [ix,iy]). edges is the array of bin edges, or a pair of arrays
+    for 2D. If sumw2 is not given, errors are sqrt(counts).
+    """
+
+    def __init__(self, counts, edges, sumw2=None, label=""):
+        if len(edges) == 2 and np.ndim(edges[0]) == 1:
+            self.edges = [np.asarray(edges[0], dtype=np.double), np.asarray(edges[1], dtype=np.double)]
+        else:
+            self.edges = [np.asarray(edges, dtype=np.double)]
+        self.counts = self.with_flows(counts)
+        self.sumw2 = self.with_flows(sumw2) if sumw2 is not None else np.abs(self.counts)
+        self.label = label
+
+    def with_flows(self, arr):
+        arr = np.asarray(arr, dtype=np.double)
+        nbins = tuple(len(edges)-1 for edges in self.edges)
+        if arr.shape == nbins:
+            return np.pad(arr, 1, mode="constant")
+        if arr.shape == tuple(n+2 for n in nbins):
+            return arr.copy()
+        raise ValueError("Shape {} doesn't match {} bins".format(arr.shape, nbins))
+
+    @property
+    def ndim(self):
+        return len(self.edges)
+
+    @property
+    def visible(self):
+        return (slice(1,-1),)*self.ndim
+
+    def values(self):
+        return self.counts[self.visible]
+
+    def errors(self):
+        return np.sqrt(self.sumw2[self.visible])
+
+    def Integral(self):
+        # like TH1::Integral(), only visible bins
+        return float(self.values().sum())
+
+    def GetTitle(self):
+        return self.label
+
+    def GetDimension(self):
+        return self.ndim
+
+    def Clone(self, name=None):
+        return ArrayHist(self.counts, self.edges if self.ndim == 2 else self.edges[0], self.sumw2, self.label)
+
+    def move_in_overflows(self):
+        """
+        Like utils.move_in_overflows, for 1D
+        """
+        for arr in (self.counts, self.sumw2):
+            arr[1] += arr[0]
+            arr[-2] += arr[-1]
+            arr[0] = 0.
+            arr[-1] = 0.
+
+    def to_root(self, name=None):
+        """
+        Return an equivalent TH1D/TH2D, not attached to any directory
+        """
+        from .lazyroot import r
+        from . import utils
+        if name is None:
+            name = "arrayhist{}".format(next(name_counter))
+        binning = []
+        for edges in self.edges:
+            widths = np.diff(edges)
+            # relative tolerance only, so that tiny (e.g. 1e-9 wide) variable bins aren't taken as uniform
+            if np.allclose(widths, widths[0], rtol=1e-9, atol=0.):
+                binning += [len(edges)-1, float(edges[0]), float(edges[-1])]
+            else:
+                binning += [len(edges)-1, np.ascontiguousarray(edges)]
+        cls = r.TH1D if self.ndim == 1 else r.TH2D
+        h = cls(name, self.label, *binning)
+        h.SetDirectory(0)
+        contents, sumw2 = utils.hist_arrays(h, create_sumw2=True)
+        contents[...] = self.counts
+        sumw2[...] = self.sumw2
+        h.ResetStats()
+        h.SetEntries(float(self.counts.sum()))
+        return h
+
+    @classmethod
+    def from_root(cls, h):
+        """
+        Make an ArrayHist with a copy of the bins of a TH1/TH2
+        """
+        from . import utils
+        contents, sumw2 = utils.hist_arrays(h)
+        if sumw2 is None: sumw2 = np.abs(contents)
+        edges = [utils.axis_edges(h.GetXaxis())]
+        if h.GetDimension() == 2:
+            edges.append(utils.axis_edges(h.GetYaxis()))
+        return cls(contents, edges if len(edges) == 2 else edges[0], sumw2, label=h.GetTitle())
+
+def to_root(obj, name=None, copy=False):
+    """
+    obj.to_root() for ArrayHists, otherwise obj itself
+    (or, with copy, a clone of it not attached to any directory)
+    """
+    if isinstance(obj, ArrayHist):
+        return obj.to_root(name=name)
+    if copy:
+        clone = obj.Clone(name) if name else obj.Clone()
+        clone.SetDirectory(0)
+        return clone
+    return obj
+
+def add_hists(hists, label=""):
+    """
+    Sum of a list of ArrayHists with the same binning (None if the list is empty)
+    """
+    hists = [h for h in hists if h is not None]
+    if not hists: return None
+    first = hists[0]
+    counts, sumw2 = first.counts.copy(), first.sumw2.copy()
+    for h in hists[1:]:
+        if counts.shape != h.counts.shape or not all(np.array_equal(e1, e2) for e1,e2 in zip(first.edges, h.edges)):
+            raise ValueError("can't add histograms with different binnings")
+        counts += h.counts
+        sumw2 += h.sumw2
+    return ArrayHist(counts, first.edges if first.ndim == 2 else first.edges[0], sumw2, label=label)
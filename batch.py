@@ -0,0 +1,193 @@
+# coding: utf-8
+"""
+Render many plots in a pool of warm worker processes.
+Each job is a dict like
+    {
+        "kind": "hist",                   # "hist", "graph" or "hist_2d"
+        "args": [...],                    # optional positional arguments
+        "kwargs": {"bgs": [...], ...},    # keyword arguments of the plot function
+    }
+Histograms can be passed directly (they are pickled to the worker) or as
+FileRef(fname, key) which the worker reads itself, opening each file once.
+SumRef([FileRef, ...], label) is read the same way, as the ArrayHist sum of the histograms.
+"""
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+from collections import namedtuple
+
+from . import plottery as ply
+from . import lazyroot
+from .arrayhist import ArrayHist, add_hists
+
+FileRef = namedtuple("FileRef", ["fname", "key"])
+SumRef = namedtuple("SumRef", ["refs", "label"])
+
+plot_functions = {
+        "hist": "plot_hist",
+        "graph": "plot_graph",
+        "hist_2d": "plot_hist_2d",
+        }
+
+def get_context():
+    # fork so that the workers inherit the already imported ROOT
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+def resolve_refs(obj, files):
+    """
+    Replace FileRefs (also inside lists, tuples and dicts) with a
+    detached clone of the object they point to, and SumRefs with the sum of theirs
+    """
+    if isinstance(obj, FileRef):
+        if obj.fname not in files:
+            files[obj.fname] = ply.r.TFile.Open(obj.fname)
+        tfile = files[obj.fname]
+        if not tfile or tfile.IsZombie():
+            raise IOError("can't open {}".format(obj.fname))
+        orig = tfile.Get(obj.key)
+        if not orig:
+            raise KeyError("{} not found in {}".format(obj.key, obj.fname))
+        # clone so that the plot function can't mutate the cached object
+        clone = orig.Clone()
+        if hasattr(clone, "SetDirectory"): clone.SetDirectory(0)
+        return clone
+    if isinstance(obj, SumRef):
+        return add_hists([ArrayHist.from_root(resolve_refs(ref, files)) for ref in obj.refs], label=obj.label)
+    if isinstance(obj, list):
+        return [resolve_refs(x, files) for x in obj]
+    if isinstance(obj, tuple):
+        return tuple(resolve_refs(x, files) for x in obj)
+    if isinstance(obj, dict):
+        return dict((k, resolve_refs(v, files)) for k,v in obj.items())
+    return obj
+
+def get_output_name(job):
+    options = job.get("kwargs", {}).get("options", {})
+    try:
+        return options["output_name"]
+    except (KeyError, TypeError):
+        return None
+
+def run_job(index, job, files):
+    result = {
+            "index": index,
+            "kind": job.get("kind"),
+            "output_name": get_output_name(job),
+            "status": "ok",
+            "error": None,
+            }
+    t0, c0 = time.time(), time.process_time()
+    try:
+        func = getattr(ply, plot_functions[job["kind"]])
+        args = resolve_refs(job.get("args", []), files)
+        kwargs = resolve_refs(job.get("kwargs", {}), files)
+        ret = func(*args, **kwargs)
+        if isinstance(ret, tuple) and len(ret) == 2 and isinstance(ret[1], dict):
+            # the per-stage timings with the "profile" option
+            result["stages"] = ret[1]
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+    result["time"] = time.time()-t0
+    result["cpu_time"] = time.process_time()-c0
+    return result
+
+def worker_loop(conn):
+    files = {}
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        if msg is None:
+            break
+        index, job = msg
+        conn.send(run_job(index, job, files))
+    conn.close()
+
+def render_batch(jobs, workers=None):
+    """
+    Render a list of jobs (see module docstring) using `workers` processes
+    (default: number of cores). Returns a list with one dict per job (same order)
+    with keys index, kind, output_name, status ("ok", "error" or "crashed"),
+    error, time and cpu_time (and stages, if the job has the "profile" option,
+    which can be combined with utils.aggregate_timings). A job that kills its worker (e.g., a segfault
+    inside ROOT) is reported as "crashed" and the worker is replaced, so the
+    rest of the batch carries on.
+    """
+    jobs = list(jobs)
+    if not jobs: return []
+    if workers is None: workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(jobs)))
+
+    ctx = get_context()
+    if ctx.get_start_method() == "fork":
+        # import ROOT once here, so that the workers inherit it instead of each importing it
+        lazyroot.load()
+    results = [None for _ in jobs]
+    pending = list(range(len(jobs)))[::-1]
+    # connection -> [process, index of running job or None, start time]
+    states = {}
+
+    def spawn():
+        parent_conn, child_conn = ctx.Pipe()
+        proc = ctx.Process(target=worker_loop, args=(child_conn,))
+        proc.daemon = True
+        proc.start()
+        child_conn.close()
+        states[parent_conn] = [proc, None, None]
+
+    def dispatch(conn):
+        while pending:
+            index = pending.pop()
+            try:
+                conn.send((index, jobs[index]))
+            except Exception as e:
+                # e.g., something in the job can't be pickled
+                results[index] = {
+                        "index": index, "kind": jobs[index].get("kind"), "output_name": get_output_name(jobs[index]),
+                        "status": "error", "error": "{}: {}".format(type(e).__name__, e), "time": 0., "cpu_time": 0.,
+                        }
+                continue
+            states[conn][1:] = [index, time.time()]
+            return
+
+    t0 = time.time()
+    for _ in range(workers): spawn()
+    for conn in list(states.keys()): dispatch(conn)
+
+    while any(state[1] is not None for state in states.values()):
+        busy = [conn for conn,state in states.items() if state[1] is not None]
+        for conn in wait(busy):
+            proc, index, tstart = states[conn]
+            try:
+                results[index] = conn.recv()
+                states[conn][1:] = [None, None]
+                dispatch(conn)
+            except (EOFError, OSError):
+                proc.join()
+                print(">>> Worker died (exit code {}) while rendering job {}".format(proc.exitcode, index))
+                results[index] = {
+                        "index": index, "kind": jobs[index].get("kind"), "output_name": get_output_name(jobs[index]),
+                        "status": "crashed", "error": "worker exited with code {}".format(proc.exitcode),
+                        "time": time.time()-tstart, "cpu_time": None,
+                        }
+                del states[conn]
+                conn.close()
+                if pending:
+                    spawn()
+                    dispatch(list(states.keys())[-1])
+
+    for conn,(proc, _, _) in states.items():
+        try:
+            conn.send(None)
+        except (EOFError, OSError):
+            pass
+        conn.close()
+        proc.join()
+
+    nfailed = sum(res["status"] != "ok" for res in results)
+    print(">>> Rendered {} plots with {} workers in {:.1f}s ({} failed)".format(len(jobs), workers, time.time()-t0, nfailed))
+    return results
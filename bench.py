@@ -0,0 +1,270 @@
+# coding: utf-8
+"""
+Benchmarks for the plotting hot paths, over a grid of bin counts, numbers of
+backgrounds, ratio/pull/syst options and output formats. Each case is run a few
+times (after a warm-up) on freshly made inputs, and the median wall and CPU
+times (also per stage, for the plot functions) are reported, along with the
+peak python memory (tracemalloc) and the growth of the peak RSS, measured in a
+separate run.
+    python -m plottery.bench                      # full grid
+    python -m plottery.bench --quick -k plot_hist # subset
+    python -m plottery.bench --save baseline.json
+    python -m plottery.bench --compare baseline.json --tolerance 0.2
+With --compare, cases slower than the baseline by more than the tolerance are
+flagged, and the exit code is 1 if there are any.
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import resource
+import tempfile
+import itertools
+import tracemalloc
+
+import numpy as np
+
+from . import plottery as ply
+from . import utils
+
+r = ply.r
+
+class Case(object):
+    """
+    A benchmark case: setup(outdir) returns the arguments for run(*args), which is what gets timed
+    """
+    def __init__(self, group, params, setup, run):
+        self.group = group
+        self.params = params
+        self.setup = setup
+        self.run = run
+
+    @property
+    def name(self):
+        return "{}[{}]".format(self.group, ",".join("{}={}".format(k,v) for k,v in sorted(self.params.items())))
+
+name_counter = itertools.count()
+
+def make_hist(nbins, nentries, seed, dist="gaus"):
+    rng = np.random.RandomState(seed)
+    h = r.TH1D("bench{}".format(next(name_counter)), "", nbins, -5., 5.)
+    h.SetDirectory(0)
+    vals = rng.normal(size=nentries) if dist == "gaus" else rng.exponential(size=nentries)*2.-5.
+    utils.fill_fast(h, vals)
+    return h
+
+def make_hist_2d(nbins, nentries, seed):
+    rng = np.random.RandomState(seed)
+    h = r.TH2D("bench{}".format(next(name_counter)), "", nbins, -3., 3., nbins, -3., 3.)
+    h.SetDirectory(0)
+    utils.fill_fast(h, rng.normal(size=nentries), rng.normal(size=nentries))
+    return h
+
+def hist_inputs(nbins, nbgs, mode):
+    bgs = [make_hist(nbins, 5000, seed, dist=["gaus","expo"][seed%2]) for seed in range(nbgs)]
+    kwargs = {"bgs": bgs, "legend_labels": ["bg{}".format(i) for i in range(nbgs)]}
+    if mode != "plain":
+        data = bgs[0].Clone("bench{}".format(next(name_counter)))
+        data.SetDirectory(0)
+        for bg in bgs[1:]: data.Add(bg)
+        kwargs["data"] = data
+    if mode == "syst":
+        kwargs["syst"] = make_hist(nbins, 500, 1000)
+    return kwargs
+
+def get_cases(quick=False):
+    cases = []
+    pick = (lambda full, small: small) if quick else (lambda full, small: full)
+
+    def plot_hist_case(nbins, nbgs, mode, formats):
+        def setup(outdir):
+            kwargs = hist_inputs(nbins, nbgs, mode)
+            kwargs["options"] = {
+                    "output_name": os.path.join(outdir, "hist.pdf"),
+                    "output_formats": formats,
+                    "ratio_pull": mode == "pull",
+                    "ratio_chi2prob": mode in ["ratio","syst"],
+                    "profile": True,
+                    }
+            return [kwargs]
+        return Case("plot_hist", dict(nbins=nbins, nbgs=nbgs, mode=mode, formats="+".join(formats)), setup, lambda kwargs: ply.plot_hist(**kwargs))
+    for nbins, nbgs, mode, formats in itertools.product(pick([30,1000],[30,1000]), pick([3,20],[5]),
+            pick(["plain","ratio","pull","syst"],["plain","pull"]), pick([["pdf"],["pdf","png"]],[["pdf"]])):
+        cases.append(plot_hist_case(nbins, nbgs, mode, formats))
+
+    def plot_graph_case(npoints, ngraphs):
+        def setup(outdir):
+            rng = np.random.RandomState(npoints)
+            valpairs = [(np.sort(rng.uniform(size=npoints)), rng.uniform(size=npoints)) for _ in range(ngraphs)]
+            return [valpairs, {"output_name": os.path.join(outdir, "graph.pdf"), "profile": True}]
+        return Case("plot_graph", dict(npoints=npoints, ngraphs=ngraphs), setup, lambda valpairs, options: ply.plot_graph(valpairs, options=options))
+    for npoints, ngraphs in itertools.product(pick([100,10000],[1000]), pick([1,5],[3])):
+        cases.append(plot_graph_case(npoints, ngraphs))
+
+    def plot_hist_2d_case(nbins, smart):
+        def setup(outdir):
+            return [make_hist_2d(nbins, 100000, 0), {"output_name": os.path.join(outdir, "hist2d.pdf"), "bin_text_smart": smart, "profile": True}]
+        return Case("plot_hist_2d", dict(nbins=nbins, smart=smart), setup, lambda hist, options: ply.plot_hist_2d(hist, options=options))
+    for nbins, smart in itertools.product(pick([20,200],[50]), [False, True]):
+        cases.append(plot_hist_2d_case(nbins, smart))
+
+    def smart_legend_case(nbins, nbgs):
+        def setup(outdir):
+            kwargs = hist_inputs(nbins, nbgs, "ratio")
+            opts = ply.Options({}, kind="1dratio")
+            c1 = r.TCanvas("bench_canvas{}".format(next(name_counter)))
+            stack = r.THStack()
+            for bg in kwargs["bgs"]: stack.Add(bg)
+            stack.Draw("hist")
+            legend = ply.get_legend(opts)
+            for bg, label in zip(kwargs["bgs"], kwargs["legend_labels"]): legend.AddEntry(bg, label, "F")
+            # keep the canvas and stack alive while timing
+            return [legend, kwargs["bgs"], kwargs["data"], opts, (c1, stack)]
+        def run(legend, bgs, data, opts, keep):
+            utils.smart_legend(legend, bgs, data=data, ymin=0., opts=opts)
+        return Case("smart_legend", dict(nbins=nbins, nbgs=nbgs), setup, run)
+    for nbins, nbgs in itertools.product(pick([30,1000],[1000]), pick([3,20],[5])):
+        cases.append(smart_legend_case(nbins, nbgs))
+
+    def fill_fast_case(nentries, ndim, threads):
+        def setup(outdir):
+            rng = np.random.RandomState(0)
+            if ndim == 1:
+                h = r.TH1D("bench{}".format(next(name_counter)), "", 100, -5., 5.)
+                args = [rng.normal(size=nentries)]
+            else:
+                h = r.TH2D("bench{}".format(next(name_counter)), "", 100, -5., 5., 100, -5., 5.)
+                args = [rng.normal(size=nentries), rng.normal(size=nentries)]
+            h.SetDirectory(0)
+            if threads > 1: r.ROOT.EnableThreadSafety()
+            return [h] + args
+        return Case("fill_fast", dict(nentries=nentries, ndim=ndim, threads=threads), setup, lambda h, *args: utils.fill_fast(h, *args, threads=threads))
+    for nentries, ndim, threads in itertools.product(pick([100000,10000000],[1000000]), [1,2], pick([1,4],[1,4])):
+        cases.append(fill_fast_case(nentries, ndim, threads))
+
+    def move_in_overflows_case(nbins):
+        return Case("move_in_overflows", dict(nbins=nbins), lambda outdir: [make_hist(nbins, 10000, 0)], utils.move_in_overflows)
+    for nbins in pick([100,100000],[100000]):
+        cases.append(move_in_overflows_case(nbins))
+
+    def save_case(formats):
+        def setup(outdir):
+            c1 = r.TCanvas("bench_canvas{}".format(next(name_counter)))
+            h = make_hist(100, 10000, 0)
+            h.Draw("hist")
+            return [c1, ply.Options({"output_name": os.path.join(outdir, "save.pdf"), "output_formats": formats}), h]
+        return Case("save", dict(formats="+".join(formats)), setup, lambda c1, opts, h: ply.save(c1, opts))
+    for formats in pick([["pdf"],["png"],["pdf","png","json"]],[["pdf","png"]]):
+        cases.append(save_case(formats))
+
+    return cases
+
+def time_case(case, outdir, repeat=3):
+    """
+    Return a dict of timings (median over `repeat` runs after one warm-up) and memory for a case
+    """
+    walls, cpus, stages = [], [], []
+    for irun in range(repeat+1):
+        args = case.setup(outdir)
+        t0, c0 = time.perf_counter(), time.process_time()
+        ret = case.run(*args)
+        wall, cpu = time.perf_counter()-t0, time.process_time()-c0
+        if irun > 0:
+            walls.append(wall)
+            cpus.append(cpu)
+            # plot functions run with the profile option also give the time of each stage
+            if isinstance(ret, tuple) and len(ret) == 2 and isinstance(ret[1], dict):
+                stages.append(ret[1])
+
+    args = case.setup(outdir)
+    maxrss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    case.run(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    maxrss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {
+            "group": case.group,
+            "params": case.params,
+            "wall": float(np.median(walls)),
+            "wall_min": float(np.min(walls)),
+            "cpu": float(np.median(cpus)),
+            "peak_python_kb": peak/1024.,
+            "maxrss_growth_kb": float(maxrss1-maxrss0),
+            "stages": dict((stage, summary["p50"]) for stage, summary in utils.aggregate_timings(stages).items()),
+            }
+
+def run_benchmarks(cases, repeat=3, outdir=None):
+    """
+    Time each case and return a dict from case name to its results
+    """
+    cleanup = outdir is None
+    if outdir is None: outdir = tempfile.mkdtemp(prefix="plottery_bench_")
+    # the plot functions are chatty
+    results = {}
+    try:
+        for case in cases:
+            stdout = sys.stdout
+            try:
+                sys.stdout = open(os.devnull, "w")
+                results[case.name] = time_case(case, outdir, repeat=repeat)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            res = results[case.name]
+            print("{:70s} {:9.2f} ms {:9.2f} ms cpu {:10.0f} kB".format(case.name, 1e3*res["wall"], 1e3*res["cpu"], res["peak_python_kb"]))
+            if res["stages"]:
+                print("    " + ", ".join("{} {:.2f} ms".format(stage, 1e3*wall) for stage, wall in res["stages"].items()))
+    finally:
+        if cleanup: shutil.rmtree(outdir, ignore_errors=True)
+    return results
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Print the change in wall time with respect to a baseline, and return the names
+    of cases which got slower by more than the tolerance (as a fraction)
+    """
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        new, old = results[name]["wall"], baseline[name]["wall"]
+        change = new/old-1. if old > 0 else 0.
+        flag = ""
+        if change > tolerance:
+            flag = "  <-- REGRESSION"
+            regressions.append(name)
+        print("{:70s} {:9.2f} ms -> {:9.2f} ms ({:+.0%}){}".format(name, 1e3*old, 1e3*new, change, flag))
+    for name in sorted(set(baseline) - set(results)):
+        print("{:70s} not run".format(name))
+    return regressions
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="benchmark plottery")
+    parser.add_argument("--quick", action="store_true", help="run a smaller grid")
+    parser.add_argument("-k", "--filter", default="", help="only run cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case (default: %(default)s)")
+    parser.add_argument("--outdir", default=None, help="where to write plots (default: a temporary directory)")
+    parser.add_argument("--save", default=None, help="save results to this json file")
+    parser.add_argument("--compare", default=None, help="compare to results in this json file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before flagging a regression (default: %(default)s)")
+    args = parser.parse_args(args)
+
+    cases = [case for case in get_cases(quick=args.quick) if args.filter in case.name]
+    results = run_benchmarks(cases, repeat=args.repeat, outdir=args.outdir)
+    if args.save:
+        with open(args.save, "w") as fh:
+            json.dump(results, fh, indent=1, sort_keys=True)
+        print(">>> Saved results to {}".format(args.save))
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+        if regressions:
+            print(">>> {} cases are slower than {} by more than {:.0%}".format(len(regressions), args.compare, args.tolerance))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+# coding: utf-8
+"""
+Opt-in render cache (option `output_cache`). A plot function call is hashed from
+the contents of its inputs, the resolved options, the function and the plottery
+source, and the hash is written to a sidecar file (.plottery_cache/<output name>.key)
+next to the output. If the output exists and its hash matches, the plot isn't drawn at all.
+With `output_cache_dir`, rendered files are also kept there (keyed by hash, up to
+`output_cache_max_mb`, evicting the least recently used) and copied back on a hit,
+e.g., after the output directory was cleaned.
+On a hit, the plot function returns HIT in place of the canvas (so `(HIT, {})` with `profile`).
+"""
+import os
+import json
+import time
+import glob
+import fcntl
+import shutil
+import hashlib
+import functools
+import inspect
+import copy
+from contextlib import contextmanager
+
+import numpy as np
+
+from . import utils
+from . import sinks
+from .arrayhist import ArrayHist
+
+sidecar_dir_name = ".plottery_cache"
+cache_stats = {"hits": 0, "misses": 0}
+source_digest = None
+
+class CacheHit(object):
+    """
+    What a cached plot function returns in place of the canvas when nothing was drawn.
+    It's falsy, so `if c1:` still works.
+    """
+
+    def __bool__(self):
+        return False
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return "plottery.cache.HIT"
+
+HIT = CacheHit()
+
+def get_source_digest():
+    """
+    Digest of the plottery source files, standing in for the version, so that
+    changing plottery invalidates the cache
+    """
+    global source_digest
+    if source_digest is None:
+        hasher = hashlib.sha1()
+        for fname in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py"))):
+            with open(fname, "rb") as fh:
+                hasher.update(fh.read())
+        source_digest = hasher.hexdigest()
+    return source_digest
+
+def update_with_array(hasher, arr):
+    arr = np.ascontiguousarray(arr)
+    hasher.update(str((arr.dtype.str, arr.shape)).encode())
+    hasher.update(arr.data if arr.size else b"")
+
+def update_with_object(hasher, obj):
+    """
+    Feed the contents of obj (histograms, graphs, arrays, and containers of them) to hasher
+    """
+    if isinstance(obj, ArrayHist):
+        hasher.update(b"ArrayHist")
+        for arr in obj.edges + [obj.counts, obj.sumw2]:
+            update_with_array(hasher, arr)
+        hasher.update(repr(obj.label).encode())
+    elif isinstance(obj, np.ndarray):
+        update_with_array(hasher, obj)
+    elif isinstance(obj, (list, tuple)):
+        hasher.update("{}{}".format(type(obj).__name__, len(obj)).encode())
+        for x in obj:
+            update_with_object(hasher, x)
+    elif isinstance(obj, dict):
+        hasher.update("dict{}".format(len(obj)).encode())
+        for key in sorted(obj, key=repr):
+            hasher.update(repr(key).encode())
+            update_with_object(hasher, obj[key])
+    elif hasattr(obj, "InheritsFrom"):
+        hasher.update("{} {}".format(obj.ClassName(), obj.GetTitle()).encode())
+        if obj.InheritsFrom("TH1"):
+            for arr in utils.hist_arrays(obj):
+                if arr is not None: update_with_array(hasher, arr)
+            update_with_array(hasher, utils.axis_edges(obj.GetXaxis()))
+            if obj.GetDimension() == 2:
+                update_with_array(hasher, utils.axis_edges(obj.GetYaxis()))
+        elif obj.InheritsFrom("TGraph"):
+            getters = ["GetX", "GetY"]
+            if obj.InheritsFrom("TGraphAsymmErrors"): getters += ["GetEXlow", "GetEXhigh", "GetEYlow", "GetEYhigh"]
+            elif obj.InheritsFrom("TGraphErrors"): getters += ["GetEX", "GetEY"]
+            for getter in getters:
+                update_with_array(hasher, utils.buffer_as_array(getattr(obj, getter)(), "f8", obj.GetN()))
+        else:
+            from .lazyroot import r
+            hasher.update(str(r.TBufferJSON.ConvertToJSON(obj)).encode())
+    else:
+        hasher.update(repr(obj).encode())
+
+def render_key(func_name, inputs, options):
+    """
+    Hash of a plot function call. options is the dict of resolved options.
+    """
+    hasher = hashlib.sha1()
+    hasher.update("{} {}".format(func_name, get_source_digest()).encode())
+    update_with_object(hasher, inputs)
+    # the cache options themselves don't change what's drawn
+    to_hash = dict((k,v) for k,v in options.items() if not k.startswith("output_cache"))
+    hasher.update(json.dumps(to_hash, sort_keys=True, default=repr).encode())
+    return hasher.hexdigest()
+
+@contextmanager
+def locked_json(fname, readonly=False):
+    """
+    Load the dict in json file fname (empty if it doesn't exist) while holding a lock
+    (so parallel workers don't lose each other's updates), and write it back afterwards
+    if it was changed. With readonly, the lock is shared and nothing is written.
+    """
+    with open(fname+".lock", "a") as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_SH if readonly else fcntl.LOCK_EX)
+        try:
+            try:
+                with open(fname) as fh:
+                    data = json.load(fh)
+            except (IOError, ValueError):
+                data = {}
+            original = None if readonly else copy.deepcopy(data)
+            yield data
+            if not readonly and data != original:
+                tmpname = "{}.tmp{}".format(fname, os.getpid())
+                with open(tmpname, "w") as fh:
+                    json.dump(data, fh, indent=1, sort_keys=True)
+                os.replace(tmpname, fname)
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+def sidecar_name(fname):
+    """
+    File holding the key of the plot that output fname was rendered from. There's one per output,
+    so checking or updating it doesn't depend on how many other plots are in the directory.
+    """
+    dirname, basename = os.path.split(os.path.abspath(fname))
+    return os.path.join(dirname, sidecar_dir_name, basename+".key")
+
+def read_sidecar(fname):
+    try:
+        with open(sidecar_name(fname)) as fh:
+            return fh.read()
+    except IOError:
+        return None
+
+def write_sidecar(fname, key):
+    if read_sidecar(fname) == key: return
+    sidecar = sidecar_name(fname)
+    os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+    # write then rename, so that other processes never see half a key
+    tmpname = "{}.tmp{}".format(sidecar, os.getpid())
+    with open(tmpname, "w") as fh:
+        fh.write(key)
+    os.replace(tmpname, sidecar)
+
+def lookup(key, opts):
+    """
+    Return True (and make sure the outputs exist) if the plot with this key was already rendered
+    """
+    fnames = utils.get_output_names(opts)
+    if all(os.path.exists(fname) and read_sidecar(fname) == key for fname in fnames):
+        return True
+
+    cache_dir = opts["output_cache_dir"]
+    if not cache_dir or not os.path.isdir(cache_dir): return False
+    index_name = os.path.join(cache_dir, "index.json")
+    blobs = [os.path.join(cache_dir, key, os.path.basename(fname)) for fname in fnames]
+    with locked_json(index_name, readonly=True) as index:
+        if key not in index or not all(os.path.exists(blob) for blob in blobs):
+            return False
+    with locked_json(index_name) as index:
+        if key in index: index[key]["last_used"] = time.time()
+    for blob, fname in zip(blobs, fnames):
+        dirname = os.path.dirname(fname)
+        if dirname: os.makedirs(dirname, exist_ok=True)
+        shutil.copyfile(blob, fname)
+        write_sidecar(fname, key)
+    return True
+
+def store(key, opts):
+    """
+    Record that the outputs in opts were rendered from the plot with this key
+    """
+    fnames = [fname for fname in utils.get_output_names(opts) if os.path.exists(fname)]
+    for fname in fnames:
+        write_sidecar(fname, key)
+
+    cache_dir = opts["output_cache_dir"]
+    if not cache_dir or not fnames: return
+    blob_dir = os.path.join(cache_dir, key)
+    os.makedirs(blob_dir, exist_ok=True)
+    for fname in fnames:
+        shutil.copyfile(fname, os.path.join(blob_dir, os.path.basename(fname)))
+    with locked_json(os.path.join(cache_dir, "index.json")) as index:
+        index[key] = {
+                "size": sum(os.path.getsize(os.path.join(blob_dir, os.path.basename(fname))) for fname in fnames),
+                "last_used": time.time(),
+                }
+        evict(cache_dir, index, opts["output_cache_max_mb"])
+
+def evict(cache_dir, index, max_mb):
+    """
+    Remove least recently used entries from index (and cache_dir) until it's below max_mb
+    """
+    if max_mb is None: return
+    total = sum(entry["size"] for entry in index.values())
+    for key in sorted(index, key=lambda k: index[k]["last_used"]):
+        if total <= max_mb*1024*1024: break
+        total -= index.pop(key)["size"]
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+
+def summary():
+    """
+    Print and return the number of cache hits and misses so far
+    """
+    print(">>> Render cache: {} hits, {} misses".format(cache_stats["hits"], cache_stats["misses"]))
+    return dict(cache_stats)
+
+def cached_render(func):
+    """
+    Decorator for plot functions taking an `options` argument. If the options have
+    output_cache set and the plot was already rendered, don't draw it (except inside a sink,
+    see sinks.py), and return HIT where the function returns its canvas: HIT, or (HIT, {})
+    if the options have profile set, so that `c1, timings = ...` works either way.
+    """
+    signature = inspect.signature(func)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        # check the raw options (a dict or an Options), so that plots without the cache don't pay for
+        # resolving them; plots going into a sink (e.g., a page of a booklet) always have to be drawn
+        if not bound.arguments["options"].get("output_cache") or sinks.current_sink() is not None:
+            return func(*args, **kwargs)
+        from .plottery import Options
+        opts = Options(bound.arguments["options"], check=False)
+        inputs = dict((k,v) for k,v in bound.arguments.items() if k != "options")
+        key = render_key(func.__name__, inputs, opts.resolved)
+        if lookup(key, opts):
+            cache_stats["hits"] += 1
+            print(">>> Using cached {}".format(", ".join(utils.get_output_names(opts))))
+            return (HIT, {}) if opts["profile"] else HIT
+        cache_stats["misses"] += 1
+        ret = func(*args, **kwargs)
+        store(key, opts)
+        return ret
+    return wrapper
@@ -0,0 +1,37 @@
+# coding: utf-8
+"""
+`r` stands in for the ROOT module, and only imports (and sets up) ROOT the
+first time one of its attributes is used. This way, `import plottery` and
+things like Options work without paying for (or even having) ROOT.
+"""
+
+class LazyROOT(object):
+
+    def __init__(self):
+        object.__setattr__(self, "_module", None)
+
+    def _load(self):
+        if self._module is None:
+            import ROOT
+            ROOT.gROOT.SetBatch(1) # please don't open an Xwindow
+            ROOT.gEnv.SetValue("RooFit.Banner", "0") # turn off annoying RooFit banner
+            ROOT.gErrorIgnoreLevel = ROOT.kError # ignore Info/Warnings
+            object.__setattr__(self, "_module", ROOT)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+r = LazyROOT()
+
+def load():
+    """
+    Import ROOT now (e.g., before forking workers), and return it
+    """
+    return r._load()
+
+def is_loaded():
+    return r._module is not None
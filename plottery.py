@@ -1,15 +1,15 @@
 # coding: utf-8
 import os
-import ROOT as r
+import shutil
+from .lazyroot import r
 from . import utils
-from array import array
+from . import stats
+from . import cache
+from . import sinks
+from .arrayhist import ArrayHist, to_root
 import math
 from itertools import cycle
 
-r.gROOT.SetBatch(1) # please don't open an Xwindow
-r.gEnv.SetValue("RooFit.Banner", "0") # turn off annoying RooFit banner
-r.gErrorIgnoreLevel = r.kError # ignore Info/Warnings
-
 class Options(object):
     """
     The Options object is just a nice wrapper around a dictionary
@@ -26,7 +26,182 @@ class Options(object):
     >>> print opts1+ply.Options(d_opts2)
     """
 
-    def __init__(self, options={}, kind=None):
+    recognized_options = {
+
+        # Canvas
+        "canvas_keep": {"type": "Boolean", "desc": "keep the canvas and everything drawn on it alive after saving (e.g., for interactive use)", "default": False, "kinds": ["1dratio","graph","2d"], },
+        "canvas_width": {"type": "Int", "desc": "width of TCanvas in pixel", "default": None, "kinds": ["1dratio","graph","2d"], },
+        "canvas_height": {"type": "Int", "desc": "height of TCanvas in pixel", "default": None, "kinds": ["1dratio","graph","2d"], },
+        "canvas_main_y1": {"type": "Float", "desc": "main plot tpad y1", "default": 0.18, "kinds": ["1dratio","graph","2d"], },
+        "canvas_main_topmargin": {"type": "Float", "desc": "ratio plot top margin", "default": None, "kinds": ["1dratio"], },
+        "canvas_main_bottommargin": {"type": "Float", "desc": "ratio plot bottom margin", "default": None, "kinds": ["1dratio"], },
+        "canvas_main_rightmargin": {"type": "Float", "desc": "ratio plot right margin", "default": None, "kinds": ["1dratio"], },
+        "canvas_main_leftmargin": {"type": "Float", "desc": "ratio plot left margin", "default": None, "kinds": ["1dratio"], },
+        "canvas_ratio_y2": {"type": "Float", "desc": "ratio tpad y2", "default": 0.19, "kinds": ["1dratio","graph","2d"], },
+        "canvas_ratio_topmargin": {"type": "Float", "desc": "ratio plot top margin", "default": None, "kinds": ["1dratio"], },
+        "canvas_ratio_bottommargin": {"type": "Float", "desc": "ratio plot bottom margin", "default": None, "kinds": ["1dratio"], },
+        "canvas_ratio_rightmargin": {"type": "Float", "desc": "ratio plot right margin", "default": None, "kinds": ["1dratio"], },
+        "canvas_ratio_leftmargin": {"type": "Float", "desc": "ratio plot left margin", "default": None, "kinds": ["1dratio"], },
+        "canvas_tick_one_side": {"type": "Boolean", "desc": "ratio plot left margin", "default": False, "kinds": ["1dratio"], },
+
+        # Graph
+        "graph_decimate": { "type": "String", "desc": "reduce each series to about graph_decimate_npoints points, keeping its shape: 'lttb' (largest triangle three buckets) or 'minmax' (lowest and highest point per bucket); default keeps all points", "default": "", "kinds": ["graph"], },
+        "graph_decimate_npoints": { "type": "Int", "desc": "number of points to keep with graph_decimate; default is the canvas width in pixels", "default": None, "kinds": ["graph"], },
+
+        # Legend
+        "legend_coordinates": { "type": "List", "desc": "4 elements specifying TLegend constructor coordinates", "default": [0.63,0.67,0.93,0.87], "kinds": ["1dratio","graph"], },
+        "legend_alignment": { "type": "String", "desc": "easy alignment of TLegend. String containing two words from: bottom, top, left, right", "default": "", "kinds": ["1dratio","graph"], },
+        "legend_smart": { "type": "Boolean", "desc": "Smart alignment of legend to prevent overlaps", "default": True, "kinds": ["1dratio"], },
+        "legend_border": { "type": "Boolean", "desc": "show legend border?", "default": True, "kinds": ["1dratio","graph"], },
+        "legend_rounded": { "type": "Boolean", "desc": "rounded legend border", "default": True, "kinds": ["1dratio"], },
+        "legend_scalex": { "type": "Float", "desc": "scale width of legend by this factor", "default": 1, "kinds": ["1dratio","graph"], },
+        "legend_scaley": { "type": "Float", "desc": "scale height of legend by this factor", "default": 1, "kinds": ["1dratio","graph"], },
+        "legend_opacity": { "type": "Float", "desc": "from 0 to 1 representing the opacity of the TLegend white background", "default": 0.5, "kinds": ["1dratio","graph"], },
+        "legend_ncolumns": { "type": "Int", "desc": "number of columns in the legend", "default": 1, "kinds": ["1dratio","graph"], },
+        "legend_column_separation": { "type": "Float", "desc": "column separation size", "default": None, "kinds": ["1dratio","graph"], },
+        "legend_percentageinbox": { "type": "Boolean", "desc": "show relative process contributions as %age in the legend thumbnails", "default": True, "kinds": ["1dratio"], },
+        "legend_datalabel": { "type": "String", "desc": "label for the data histogram in the legend", "default": "Data", "kinds": ["1dratio"], },
+
+        # Axes
+        "xaxis_log": { "type": "Boolean", "desc": "log scale x-axis", "default": False, "kinds": ["1dratio","graph","2d"], },
+        "yaxis_log": { "type": "Boolean", "desc": "log scale y-axis", "default": False, "kinds": ["1dratio","graph","2d"], },
+        "zaxis_log": { "type": "Boolean", "desc": "log scale z-axis", "default": False, "kinds": ["2d"], },
+
+        "xaxis_label": { "type": "String", "desc": "label for x axis", "default": "", "kinds": ["1dratio","graph","2d"], },
+        "yaxis_label": { "type": "String", "desc": "label for y axis", "default": "Events", "kinds": ["1dratio","graph","2d"], },
+        "zaxis_label": { "type": "String", "desc": "label for z axis", "default": "", "kinds": ["2d"], },
+
+        "xaxis_label_size_scale": { "type": "Float", "desc": "size of fonts for x axis", "default": 1.0, "kinds": ["1dratio","graph","2d"], },
+        "yaxis_label_size_scale": { "type": "Float", "desc": "size of fonts for y axis", "default": 1.0, "kinds": ["1dratio","graph","2d"], },
+        "zaxis_label_size_scale": { "type": "Float", "desc": "size of fonts for z axis", "default": 1.0, "kinds": ["2d"], },
+
+        "xaxis_title_size": { "type": "Float", "desc": "size of fonts for x axis title", "default": None, "kinds": ["1dratio","graph","2d"], },
+        "yaxis_title_size": { "type": "Float", "desc": "size of fonts for y axis title", "default": None, "kinds": ["1dratio","graph","2d"], },
+
+        "xaxis_title_offset": { "type": "Float", "desc": "offset of x axis title", "default": None, "kinds": ["1dratio","graph","2d"], },
+        "yaxis_title_offset": { "type": "Float", "desc": "offset of y axis title", "default": None, "kinds": ["1dratio","graph","2d"], },
+
+        "xaxis_label_offset_scale": { "type": "Float", "desc": "x axis tickmark labels offset", "default": 1.0, "kinds": ["1dratio","graph","2d"], },
+        "yaxis_label_offset_scale": { "type": "Float", "desc": "y axis tickmark labels offset", "default": 1.0, "kinds": ["1dratio","graph","2d"], },
+
+        "xaxis_tick_length_scale": { "type": "Float", "desc": "x axis tickmark length scale", "default": 1.0, "kinds": ["1dratio","graph","2d"], },
+        "yaxis_tick_length_scale": { "type": "Float", "desc": "y axis tickmark length scale", "default": 1.0, "kinds": ["1dratio","graph","2d"], },
+
+        "xaxis_moreloglabels": { "type": "Boolean", "desc": "show denser labels with logscale for x axis", "default": True, "kinds": ["1dratio","graph","2d"], },
+        "yaxis_moreloglabels": { "type": "Boolean", "desc": "show denser labels with logscale for y axis", "default": True, "kinds": ["1dratio","graph","2d"], },
+        "zaxis_moreloglabels": { "type": "Boolean", "desc": "show denser labels with logscale for z axis", "default": True, "kinds": ["1dratio","graph","2d"], },
+        "xaxis_noexponents": { "type": "Boolean", "desc": "don't show exponents in logscale labels for x axis", "default": False, "kinds": ["1dratio","graph","2d"], },
+        "yaxis_noexponents": { "type": "Boolean", "desc": "don't show exponents in logscale labels for y axis", "default": False, "kinds": ["1dratio","graph","2d"], },
+        "zaxis_noexponents": { "type": "Boolean", "desc": "don't show exponents in logscale labels for z axis", "default": False, "kinds": ["1dratio","graph","2d"], },
+
+        "yaxis_exponent_offset": { "type": "Float", "desc": "offset x10^n left or right", "default": 0.0, "kinds": ["1dratio"], },
+        "yaxis_exponent_vertical_offset": { "type": "Float", "desc": "offset x10^n up or down", "default": 0.0, "kinds": ["1dratio"], },
+
+        "yaxis_ndivisions": { "type": "Int", "desc": "SetNdivisions integer for y-axis", "default": 510, "kinds": ["1dratio", "graph", "2d"], },
+        "xaxis_ndivisions": { "type": "Int", "desc": "SetNdivisions integer for x-axis", "default": 510, "kinds": ["1dratio", "graph", "2d"], },
+
+        "xaxis_range": { "type": "List", "desc": "2 elements to specify x axis range", "default": [], "kinds": ["1dratio","graph","2d"], },
+        "yaxis_range": { "type": "List", "desc": "2 elements to specify y axis range", "default": [], "kinds": ["1dratio","graph","2d"], },
+        "zaxis_range": { "type": "List", "desc": "2 elements to specify z axis range", "default": [], "kinds": ["2d"], },
+
+        "xaxis_bin_text_labels":{"type":"List","desc":"List containing bin labels instead of text","default":[],"kinds":["1dratio","graph","2dratio"]},
+
+        # Ratio
+        "ratio_name": { "type": "String", "desc": "name of ratio pad", "default": "Data/MC", "kinds": ["1dratio"], },
+        "ratio_name_size": { "type": "Float", "desc": "size of the name on the ratio pad (e.g. data/MC)", "default": 0.2, "kinds": ["1dratio"], },
+        "ratio_name_offset": { "type": "Float", "desc": "offset to the name of ratio pad", "default": 0.25, "kinds": ["1dratio"], },
+        "ratio_range": { "type": "List", "desc": "pair for min and max y-value for ratio; default auto re-sizes to 3 sigma range", "default": [-1,-1], "kinds": ["1dratio"], },
+        "ratio_horizontal_lines": { "type": "List", "desc": "list of y-values to draw horizontal line", "default": [1.], "kinds": ["1dratio"], },
+        "ratio_chi2prob": { "type": "Boolean", "desc": "show chi2 probability for ratio", "default": False, "kinds": ["1dratio"], },
+        "ratio_pull": { "type": "Boolean", "desc": "show pulls instead of ratios in ratio pad", "default": False, "kinds": ["1dratio"], },
+        "ratio_pull_numbers": { "type": "Boolean", "desc": "show numbers for pulls, and mean/sigma", "default": True, "kinds": ["1dratio"], },
+        "ratio_ndivisions": { "type": "Int", "desc": "SetNdivisions integer for ratio", "default": 505, "kinds": ["1dratio"], },
+        "ratio_numden_indices": { "type": "List", "desc": "Pair of numerator and denominator histogram indices (from `bgs`) for ratio", "default": None, "kinds": ["1dratio"], },
+        "ratio_binomial_errors": { "type": "Boolean", "desc": "Use binomial error propagation when computing ratio eror bars", "default": False, "kinds": ["1dratio"], },
+        "ratio_xaxis_title": { "type": "String", "desc": "X-axis label", "default": "", "kinds": ["1dratio"], },
+        "ratio_xaxis_title_size": { "type": "Float", "desc": "X-axis label size", "default": None, "kinds": ["1dratio"], },
+        "ratio_xaxis_title_offset": { "type": "FLoat", "desc": "X-axis label offset", "default": None, "kinds": ["1dratio"], },
+        "ratio_label_size": { "type": "Float", "desc": "X-axis label size", "default": 0., "kinds": ["1dratio"], },
+        "ratio_xaxis_label_offset": { "type": "Float", "desc": "offset to the x-axis labels (numbers)", "default": None, "kinds": ["1dratio"], },
+        "ratio_yaxis_label_offset": { "type": "Float", "desc": "offset to the y-axis labels (numbers)", "default": None, "kinds": ["1dratio"], },
+        "ratio_tick_length_scale": { "type": "Float", "desc": "Tick length scale of ratio pads", "default": 1.0, "kinds": ["1dratio"], },
+
+        # Overall
+        "title": { "type": "String", "desc": "plot title", "default": "", "kinds": ["1dratio","graph","2d"], },
+        "draw_points": { "type": "Boolean", "desc": "draw points instead of fill", "default": False, "kinds": ["1d","1dratio"], },
+        "draw_option_2d": { "type": "String", "desc": "hist draw option", "default": "colz", "kinds": ["2d"], },
+        "bkg_err_fill_style": { "type": "Int", "desc": "Error shade draw style", "default": 1001, "kinds": ["1d", "1dratio"], },
+        "bkg_err_fill_color": { "type": "Int", "desc": "Error shade color", "default": None, "kinds": ["1d", "1dratio"], },
+        "input_immutable": { "type": "Boolean", "desc": "leave the input histograms untouched (overflows, Sumw2, styles) and draw copies of them instead", "default": False, "kinds": ["1dratio"], },
+
+        # CMS things
+        "cms_label": {"type": "String", "desc": "E.g., 'Preliminary'; default hides label", "default": None, "kinds": ["1dratio","graph","2d"]},
+        "lumi_value": {"type": "String", "desc": "E.g., 35.9; default hides lumi label", "default": "", "kinds": ["1dratio","graph","2d"]},
+        "lumi_unit": {"type": "String", "desc": "Unit for lumi label", "default": "fb", "kinds": ["1dratio","graph","2d"]},
+
+        # Misc
+        "do_stack": { "type": "Boolean", "desc": "stack histograms", "default": True, "kinds": ["1dratio"], },
+        "palette_name": { "type": "String", "desc": "color palette: 'default', 'rainbow', 'susy', etc.", "default": "default", "kinds": ["2d"], },
+        "show_bkg_errors": { "type": "Boolean", "desc": "show error bar for background stack", "default": False, "kinds": ["1dratio"], },
+        "show_bkg_smooth": { "type": "Boolean", "desc": "show smoothed background stack", "default": False, "kinds": ["1dratio"], },
+        "bkg_sort_method": { "type": "Boolean", "desc": "how to sort background stack using integrals: 'unsorted', 'ascending', or 'descending'", "default": 'ascending', "kinds": ["1dratio"], },
+        "no_ratio": { "type": "Boolean", "desc": "do not draw ratio plot", "default": False, "kinds": ["1dratio"], },
+
+        "max_digits": { "type": "Int", "desc": "integer for max digits", "default": 5, "kinds" : ["1dratio", "graph", "2d"], },
+
+
+        "bin_text_size": { "type": "Float", "desc": "size of text in bins (TH2::SetMarkerSize)", "default": 1.7, "kinds": ["2d"], },
+        "bin_text_format": { "type": "String", "desc": "format string for text in TH2 bins", "default": ".1f", "kinds": ["2d"], },
+        "bin_text_smart": { "type": "Boolean", "desc": "change bin text color for aesthetics", "default": False, "kinds": ["2d"], },
+        "bin_text_format_smart": { "type": "String", "desc": "python-syntax format string for smart text in TH2 bins taking value and bin error", "default": "{0:.0f}#pm{1:.0f}", "kinds": ["2d"], },
+        "bin_text_lod_threshold": { "type": "Float", "desc": "with bin_text_smart, minimum size of a bin relative to its label (in pixels) to draw labels for individual bins; 0 always draws them", "default": 0., "kinds": ["2d"], },
+        "bin_text_lod_mode": { "type": "String", "desc": "what to do when bins are smaller than bin_text_lod_threshold: 'aggregate' (label blocks of bins with their sum) or 'skip'", "default": "aggregate", "kinds": ["2d"], },
+        "downsample_2d": { "type": "String", "desc": "'sum' or 'max' to merge blocks of bins so that there are no more bins than pixels before drawing ('max' keeps the z range, 'sum' shows the sum of each block); '' draws every bin", "default": "", "kinds": ["2d"], },
+        "downsample_2d_max_bins": { "type": "List", "desc": "with downsample_2d, 2 elements to draw at most this many bins along x and y, instead of the number of pixels", "default": [], "kinds": ["2d"], },
+
+        "hist_line_none": { "type": "Boolean", "desc": "No lines for histograms, only fill", "default": False, "kinds": ["1dratio"], },
+        "hist_line_black": { "type": "Boolean", "desc": "Black lines for histograms", "default": False, "kinds": ["1dratio"], },
+        "hist_disable_xerrors": { "type": "Boolean", "desc": "Disable the x-error bars on data for 1D hists", "default": True, "kinds": ["1dratio"], },
+
+        "extra_text": { "type": "List", "desc": "list of strings for textboxes", "default": [], "kinds": [ "1dratio","graph"], },
+        "extra_text_size": { "type": "Float", "desc": "size for extra text", "default": 0.04, "kinds": [ "1dratio","graph"], },
+        "extra_text_xpos": { "type": "Float", "desc": "NDC x position (0 to 1) for extra text", "default": 0.3, "kinds": [ "1dratio","graph"], },
+        "extra_text_ypos": { "type": "Float", "desc": "NDC y position (0 to 1) for extra text", "default": 0.87, "kinds": [ "1dratio","graph"], },
+
+        "extra_lines": { "type": "List", "desc": "list of upto 7-tuples (x1,y1,x2,y2,style,width,color) for lines", "default": [], "kinds": [ "1dratio","graph"], },
+
+        "no_overflow": {"type":"Boolean","desc":"Do not plot overflow bins","default": False, "kinds" : ["1dratio"],},
+
+        # Fun
+        "us_flag": { "type": "Boolean", "desc": "show the US flag in the corner", "default": False, "kinds": ["1dratio","graph","2d"], },
+        "us_flag_coordinates": { "type": "List", "desc": "Specify flag location with (x pos, y pos, size)", "default": [0.68,0.96,0.06], "kinds": ["1dratio","graph","2d"], },
+
+        # Output
+        "profile": { "type": "Boolean", "desc": "return (canvas, timings) where timings has the wall and CPU time (s) of each stage of the plot function", "default": False, "kinds": ["1dratio","graph","2d"], },
+        "output_name": { "type": "String", "desc": "output file name/path, or a list of them to save the same plot to each", "default": "plot.pdf", "kinds": ["1dratio","graph","2d"], },
+        "output_formats": { "type": "List", "desc": "extensions (e.g., ['pdf','png']) to save the plot as, replacing the one in output_name", "default": [], "kinds": ["1dratio","graph","2d"], },
+        "output_ic": { "type": "Boolean", "desc": "run `ic` (imgcat) on output", "default": False, "kinds": ["1dratio","graph","2d"], },
+        "output_jsroot": { "type": "Boolean", "desc": "output .json for jsroot", "default": False, "kinds": ["1dratio","graph","2d"], },
+        "output_diff_previous": { "type": "Boolean", "desc": "diff the new output file with the previous", "default": False, "kinds": ["1dratio","graph","2d"], },
+        "output_cache": { "type": "Boolean", "desc": "skip drawing if the output exists and was made from identical inputs and options, returning cache.HIT instead of the canvas (see cache.py)", "default": False, "kinds": ["1dratio","graph","2d"], },
+        "output_cache_dir": { "type": "String", "desc": "directory to also keep cached outputs in, to restore them if deleted", "default": None, "kinds": ["1dratio","graph","2d"], },
+        "output_cache_max_mb": { "type": "Float", "desc": "maximum size of output_cache_dir in MB, evicting the least recently used plots", "default": None, "kinds": ["1dratio","graph","2d"], },
+
+    }
+
+    # the schema is compiled once, when the class is created
+    defaults = {}
+    list_defaults = []
+    keys_by_kind = {}
+    for _key, _obj in recognized_options.items():
+        defaults[_key] = _obj["default"]
+        if type(_obj["default"]) is list:
+            list_defaults.append(_key)
+        for _kind in _obj["kinds"]:
+            keys_by_kind.setdefault(_kind, set()).add(_key)
+    del _key, _obj, _kind
+
+    def __init__(self, options={}, kind=None, check=True):
 
         # if we pass in a plain dict, then do the usual
         # thing, otherwise make a new options object
@@ -34,159 +209,17 @@ class Options(object):
         if type(options) is dict:
             self.options = options
             self.kind = kind
+            # defaults are merged once here so that lookups are a single dict access
+            self.resolved = dict(self.defaults)
+            for key in self.list_defaults:
+                self.resolved[key] = list(self.resolved[key])
+            self.resolved.update(options)
+            if check:
+                self.check_options()
         else:
             self.options = options.options
             self.kind = options.kind
-
-        self.recognized_options = {
-
-            # Canvas
-            "canvas_width": {"type": "Int", "desc": "width of TCanvas in pixel", "default": None, "kinds": ["1dratio","graph","2d"], },
-            "canvas_height": {"type": "Int", "desc": "height of TCanvas in pixel", "default": None, "kinds": ["1dratio","graph","2d"], },
-            "canvas_main_y1": {"type": "Float", "desc": "main plot tpad y1", "default": 0.18, "kinds": ["1dratio","graph","2d"], },
-            "canvas_main_topmargin": {"type": "Float", "desc": "ratio plot top margin", "default": None, "kinds": ["1dratio"], },
-            "canvas_main_bottommargin": {"type": "Float", "desc": "ratio plot bottom margin", "default": None, "kinds": ["1dratio"], },
-            "canvas_main_rightmargin": {"type": "Float", "desc": "ratio plot right margin", "default": None, "kinds": ["1dratio"], },
-            "canvas_main_leftmargin": {"type": "Float", "desc": "ratio plot left margin", "default": None, "kinds": ["1dratio"], },
-            "canvas_ratio_y2": {"type": "Float", "desc": "ratio tpad y2", "default": 0.19, "kinds": ["1dratio","graph","2d"], },
-            "canvas_ratio_topmargin": {"type": "Float", "desc": "ratio plot top margin", "default": None, "kinds": ["1dratio"], },
-            "canvas_ratio_bottommargin": {"type": "Float", "desc": "ratio plot bottom margin", "default": None, "kinds": ["1dratio"], },
-            "canvas_ratio_rightmargin": {"type": "Float", "desc": "ratio plot right margin", "default": None, "kinds": ["1dratio"], },
-            "canvas_ratio_leftmargin": {"type": "Float", "desc": "ratio plot left margin", "default": None, "kinds": ["1dratio"], },
-            "canvas_tick_one_side": {"type": "Boolean", "desc": "ratio plot left margin", "default": False, "kinds": ["1dratio"], },
-
-            # Legend
-            "legend_coordinates": { "type": "List", "desc": "4 elements specifying TLegend constructor coordinates", "default": [0.63,0.67,0.93,0.87], "kinds": ["1dratio","graph"], },
-            "legend_alignment": { "type": "String", "desc": "easy alignment of TLegend. String containing two words from: bottom, top, left, right", "default": "", "kinds": ["1dratio","graph"], },
-            "legend_smart": { "type": "Boolean", "desc": "Smart alignment of legend to prevent overlaps", "default": True, "kinds": ["1dratio"], },
-            "legend_border": { "type": "Boolean", "desc": "show legend border?", "default": True, "kinds": ["1dratio","graph"], },
-            "legend_rounded": { "type": "Boolean", "desc": "rounded legend border", "default": True, "kinds": ["1dratio"], },
-            "legend_scalex": { "type": "Float", "desc": "scale width of legend by this factor", "default": 1, "kinds": ["1dratio","graph"], },
-            "legend_scaley": { "type": "Float", "desc": "scale height of legend by this factor", "default": 1, "kinds": ["1dratio","graph"], },
-            "legend_opacity": { "type": "Float", "desc": "from 0 to 1 representing the opacity of the TLegend white background", "default": 0.5, "kinds": ["1dratio","graph"], },
-            "legend_ncolumns": { "type": "Int", "desc": "number of columns in the legend", "default": 1, "kinds": ["1dratio","graph"], },
-            "legend_column_separation": { "type": "Float", "desc": "column separation size", "default": None, "kinds": ["1dratio","graph"], },
-            "legend_percentageinbox": { "type": "Boolean", "desc": "show relative process contributions as %age in the legend thumbnails", "default": True, "kinds": ["1dratio"], },
-            "legend_datalabel": { "type": "String", "desc": "label for the data histogram in the legend", "default": "Data", "kinds": ["1dratio"], },
-
-            # Axes
-            "xaxis_log": { "type": "Boolean", "desc": "log scale x-axis", "default": False, "kinds": ["1dratio","graph","2d"], },
-            "yaxis_log": { "type": "Boolean", "desc": "log scale y-axis", "default": False, "kinds": ["1dratio","graph","2d"], },
-            "zaxis_log": { "type": "Boolean", "desc": "log scale z-axis", "default": False, "kinds": ["2d"], },
-
-            "xaxis_label": { "type": "String", "desc": "label for x axis", "default": "", "kinds": ["1dratio","graph","2d"], },
-            "yaxis_label": { "type": "String", "desc": "label for y axis", "default": "Events", "kinds": ["1dratio","graph","2d"], },
-            "zaxis_label": { "type": "String", "desc": "label for z axis", "default": "", "kinds": ["2d"], },
-
-            "xaxis_label_size_scale": { "type": "Float", "desc": "size of fonts for x axis", "default": 1.0, "kinds": ["1dratio","graph","2d"], },
-            "yaxis_label_size_scale": { "type": "Float", "desc": "size of fonts for y axis", "default": 1.0, "kinds": ["1dratio","graph","2d"], },
-            "zaxis_label_size_scale": { "type": "Float", "desc": "size of fonts for z axis", "default": 1.0, "kinds": ["2d"], },
-
-            "xaxis_title_size": { "type": "Float", "desc": "size of fonts for x axis title", "default": None, "kinds": ["1dratio","graph","2d"], },
-            "yaxis_title_size": { "type": "Float", "desc": "size of fonts for y axis title", "default": None, "kinds": ["1dratio","graph","2d"], },
-
-            "xaxis_title_offset": { "type": "Float", "desc": "offset of x axis title", "default": None, "kinds": ["1dratio","graph","2d"], },
-            "yaxis_title_offset": { "type": "Float", "desc": "offset of y axis title", "default": None, "kinds": ["1dratio","graph","2d"], },
-
-            "xaxis_label_offset_scale": { "type": "Float", "desc": "x axis tickmark labels offset", "default": 1.0, "kinds": ["1dratio","graph","2d"], },
-            "yaxis_label_offset_scale": { "type": "Float", "desc": "y axis tickmark labels offset", "default": 1.0, "kinds": ["1dratio","graph","2d"], },
-
-            "xaxis_tick_length_scale": { "type": "Float", "desc": "x axis tickmark length scale", "default": 1.0, "kinds": ["1dratio","graph","2d"], },
-            "yaxis_tick_length_scale": { "type": "Float", "desc": "y axis tickmark length scale", "default": 1.0, "kinds": ["1dratio","graph","2d"], },
-
-            "xaxis_moreloglabels": { "type": "Boolean", "desc": "show denser labels with logscale for x axis", "default": True, "kinds": ["1dratio","graph","2d"], },
-            "yaxis_moreloglabels": { "type": "Boolean", "desc": "show denser labels with logscale for y axis", "default": True, "kinds": ["1dratio","graph","2d"], },
-            "zaxis_moreloglabels": { "type": "Boolean", "desc": "show denser labels with logscale for z axis", "default": True, "kinds": ["1dratio","graph","2d"], },
-            "xaxis_noexponents": { "type": "Boolean", "desc": "don't show exponents in logscale labels for x axis", "default": False, "kinds": ["1dratio","graph","2d"], },
-            "yaxis_noexponents": { "type": "Boolean", "desc": "don't show exponents in logscale labels for y axis", "default": False, "kinds": ["1dratio","graph","2d"], },
-            "zaxis_noexponents": { "type": "Boolean", "desc": "don't show exponents in logscale labels for z axis", "default": False, "kinds": ["1dratio","graph","2d"], },
-
-            "yaxis_exponent_offset": { "type": "Float", "desc": "offset x10^n left or right", "default": 0.0, "kinds": ["1dratio"], },
-            "yaxis_exponent_vertical_offset": { "type": "Float", "desc": "offset x10^n up or down", "default": 0.0, "kinds": ["1dratio"], },
-
-            "yaxis_ndivisions": { "type": "Int", "desc": "SetNdivisions integer for y-axis", "default": 510, "kinds": ["1dratio", "graph", "2d"], },
-            "xaxis_ndivisions": { "type": "Int", "desc": "SetNdivisions integer for x-axis", "default": 510, "kinds": ["1dratio", "graph", "2d"], },
-
-            "xaxis_range": { "type": "List", "desc": "2 elements to specify x axis range", "default": [], "kinds": ["1dratio","graph","2d"], },
-            "yaxis_range": { "type": "List", "desc": "2 elements to specify y axis range", "default": [], "kinds": ["1dratio","graph","2d"], },
-            "zaxis_range": { "type": "List", "desc": "2 elements to specify z axis range", "default": [], "kinds": ["2d"], },
-
-            "xaxis_bin_text_labels":{"type":"List","desc":"List containing bin labels instead of text","default":[],"kinds":["1dratio","graph","2dratio"]},
-
-            # Ratio
-            "ratio_name": { "type": "String", "desc": "name of ratio pad", "default": "Data/MC", "kinds": ["1dratio"], },
-            "ratio_name_size": { "type": "Float", "desc": "size of the name on the ratio pad (e.g. data/MC)", "default": 0.2, "kinds": ["1dratio"], },
-            "ratio_name_offset": { "type": "Float", "desc": "offset to the name of ratio pad", "default": 0.25, "kinds": ["1dratio"], },
-            "ratio_range": { "type": "List", "desc": "pair for min and max y-value for ratio; default auto re-sizes to 3 sigma range", "default": [-1,-1], "kinds": ["1dratio"], },
-            "ratio_horizontal_lines": { "type": "List", "desc": "list of y-values to draw horizontal line", "default": [1.], "kinds": ["1dratio"], },
-            "ratio_chi2prob": { "type": "Boolean", "desc": "show chi2 probability for ratio", "default": False, "kinds": ["1dratio"], },
-            "ratio_pull": { "type": "Boolean", "desc": "show pulls instead of ratios in ratio pad", "default": False, "kinds": ["1dratio"], },
-            "ratio_pull_numbers": { "type": "Boolean", "desc": "show numbers for pulls, and mean/sigma", "default": True, "kinds": ["1dratio"], },
-            "ratio_ndivisions": { "type": "Int", "desc": "SetNdivisions integer for ratio", "default": 505, "kinds": ["1dratio"], },
-            "ratio_numden_indices": { "type": "List", "desc": "Pair of numerator and denominator histogram indices (from `bgs`) for ratio", "default": None, "kinds": ["1dratio"], },
-            "ratio_binomial_errors": { "type": "Boolean", "desc": "Use binomial error propagation when computing ratio eror bars", "default": False, "kinds": ["1dratio"], },
-            "ratio_xaxis_title": { "type": "String", "desc": "X-axis label", "default": "", "kinds": ["1dratio"], },
-            "ratio_xaxis_title_size": { "type": "Float", "desc": "X-axis label size", "default": None, "kinds": ["1dratio"], },
-            "ratio_xaxis_title_offset": { "type": "FLoat", "desc": "X-axis label offset", "default": None, "kinds": ["1dratio"], },
-            "ratio_label_size": { "type": "Float", "desc": "X-axis label size", "default": 0., "kinds": ["1dratio"], },
-            "ratio_xaxis_label_offset": { "type": "Float", "desc": "offset to the x-axis labels (numbers)", "default": None, "kinds": ["1dratio"], },
-            "ratio_yaxis_label_offset": { "type": "Float", "desc": "offset to the y-axis labels (numbers)", "default": None, "kinds": ["1dratio"], },
-            "ratio_tick_length_scale": { "type": "Float", "desc": "Tick length scale of ratio pads", "default": 1.0, "kinds": ["1dratio"], },
-
-            # Overall
-            "title": { "type": "String", "desc": "plot title", "default": "", "kinds": ["1dratio","graph","2d"], },
-            "draw_points": { "type": "Boolean", "desc": "draw points instead of fill", "default": False, "kinds": ["1d","1dratio"], },
-            "draw_option_2d": { "type": "String", "desc": "hist draw option", "default": "colz", "kinds": ["2d"], },
-            "bkg_err_fill_style": { "type": "Int", "desc": "Error shade draw style", "default": 1001, "kinds": ["1d", "1dratio"], },
-            "bkg_err_fill_color": { "type": "Int", "desc": "Error shade color", "default": None, "kinds": ["1d", "1dratio"], },
-
-            # CMS things
-            "cms_label": {"type": "String", "desc": "E.g., 'Preliminary'; default hides label", "default": None, "kinds": ["1dratio","graph","2d"]},
-            "lumi_value": {"type": "String", "desc": "E.g., 35.9; default hides lumi label", "default": "", "kinds": ["1dratio","graph","2d"]},
-            "lumi_unit": {"type": "String", "desc": "Unit for lumi label", "default": "fb", "kinds": ["1dratio","graph","2d"]},
-
-            # Misc
-            "do_stack": { "type": "Boolean", "desc": "stack histograms", "default": True, "kinds": ["1dratio"], },
-            "palette_name": { "type": "String", "desc": "color palette: 'default', 'rainbow', 'susy', etc.", "default": "default", "kinds": ["2d"], },
-            "show_bkg_errors": { "type": "Boolean", "desc": "show error bar for background stack", "default": False, "kinds": ["1dratio"], },
-            "show_bkg_smooth": { "type": "Boolean", "desc": "show smoothed background stack", "default": False, "kinds": ["1dratio"], },
-            "bkg_sort_method": { "type": "Boolean", "desc": "how to sort background stack using integrals: 'unsorted', 'ascending', or 'descending'", "default": 'ascending', "kinds": ["1dratio"], },
-            "no_ratio": { "type": "Boolean", "desc": "do not draw ratio plot", "default": False, "kinds": ["1dratio"], },
-
-            "max_digits": { "type": "Int", "desc": "integer for max digits", "default": 5, "kinds" : ["1dratio", "graph", "2d"], },
-
-
-            "bin_text_size": { "type": "Float", "desc": "size of text in bins (TH2::SetMarkerSize)", "default": 1.7, "kinds": ["2d"], },
-            "bin_text_format": { "type": "String", "desc": "format string for text in TH2 bins", "default": ".1f", "kinds": ["2d"], },
-            "bin_text_smart": { "type": "Boolean", "desc": "change bin text color for aesthetics", "default": False, "kinds": ["2d"], },
-            "bin_text_format_smart": { "type": "String", "desc": "python-syntax format string for smart text in TH2 bins taking value and bin error", "default": "{0:.0f}#pm{1:.0f}", "kinds": ["2d"], },
-
-            "hist_line_none": { "type": "Boolean", "desc": "No lines for histograms, only fill", "default": False, "kinds": ["1dratio"], },
-            "hist_line_black": { "type": "Boolean", "desc": "Black lines for histograms", "default": False, "kinds": ["1dratio"], },
-            "hist_disable_xerrors": { "type": "Boolean", "desc": "Disable the x-error bars on data for 1D hists", "default": True, "kinds": ["1dratio"], },
-
-            "extra_text": { "type": "List", "desc": "list of strings for textboxes", "default": [], "kinds": [ "1dratio","graph"], },
-            "extra_text_size": { "type": "Float", "desc": "size for extra text", "default": 0.04, "kinds": [ "1dratio","graph"], },
-            "extra_text_xpos": { "type": "Float", "desc": "NDC x position (0 to 1) for extra text", "default": 0.3, "kinds": [ "1dratio","graph"], },
-            "extra_text_ypos": { "type": "Float", "desc": "NDC y position (0 to 1) for extra text", "default": 0.87, "kinds": [ "1dratio","graph"], },
-
-            "extra_lines": { "type": "List", "desc": "list of upto 7-tuples (x1,y1,x2,y2,style,width,color) for lines", "default": [], "kinds": [ "1dratio","graph"], },
-
-            "no_overflow": {"type":"Boolean","desc":"Do not plot overflow bins","default": False, "kinds" : ["1dratio"],},
-
-            # Fun
-            "us_flag": { "type": "Boolean", "desc": "show the US flag in the corner", "default": False, "kinds": ["1dratio","graph","2d"], },
-            "us_flag_coordinates": { "type": "List", "desc": "Specify flag location with (x pos, y pos, size)", "default": [0.68,0.96,0.06], "kinds": ["1dratio","graph","2d"], },
-
-            # Output
-            "output_name": { "type": "String", "desc": "output file name/path", "default": "plot.pdf", "kinds": ["1dratio","graph","2d"], },
-            "output_ic": { "type": "Boolean", "desc": "run `ic` (imgcat) on output", "default": False, "kinds": ["1dratio","graph","2d"], },
-            "output_jsroot": { "type": "Boolean", "desc": "output .json for jsroot", "default": False, "kinds": ["1dratio","graph","2d"], },
-            "output_diff_previous": { "type": "Boolean", "desc": "diff the new output file with the previous", "default": False, "kinds": ["1dratio","graph","2d"], },
-
-        }
-
-        self.check_options()
+            self.resolved = options.resolved
 
     def usage(self):
 
@@ -199,27 +232,24 @@ class Options(object):
             if type(default) is str: default = '"{}"'.format(default)
             print("* `{}` [{}]\n    {} (default: {})".format(key,typ,desc,default))
 
-    def check_options(self):
-        for name,val in self.options.items():
+    def check_options(self, names=None):
+        # keys_by_kind makes the common case (a recognized option
+        # for this kind of plot) a single set lookup
+        kind_keys = self.keys_by_kind.get(self.kind, ())
+        for name in (self.options if names is None else names):
+            if name in kind_keys:
+                continue
             if name not in self.recognized_options:
                 print(">>> Option {} not in list of recognized options".format(name))
             else:
-                obj = self.recognized_options[name]
-                if self.kind not in obj["kinds"]:
-                    print(">>> Option {} isn't declared to work with plot type of '{}'".format(name, self.kind))
-                else:
-                    pass
-                    # print ">>> Carry on mate ... {} is fine".format(name)
+                print(">>> Option {} isn't declared to work with plot type of '{}'".format(name, self.kind))
 
     def __getitem__(self, key):
-        if key in self.options:
-            return self.options[key]
-        else:
-            if key in self.recognized_options:
-                return self.recognized_options[key]["default"]
-            else:
-                print(">>> Hmm, can't find {} anywhere. Typo or intentional?".format(key))
-                return None
+        try:
+            return self.resolved[key]
+        except KeyError:
+            print(">>> Hmm, can't find {} anywhere. Typo or intentional?".format(key))
+            return None
 
     def get(self, key, default=None):
         val = self.__getitem__(key)
@@ -230,13 +260,11 @@ class Options(object):
         """
         returns True if user has not overriden this particular option
         """
-        default = None
-        if key in self.recognized_options:
-            default = self.recognized_options[key]["default"]
-        return (self.__getitem__(key) == default)
+        return (self.__getitem__(key) == self.defaults.get(key))
 
     def __setitem__(self, key, value):
         self.options[key] = value
+        self.resolved[key] = value
 
     def __repr__(self):
         return str(self.options)
@@ -247,51 +275,75 @@ class Options(object):
     def __add__(self, other):
         new_opts = {}
         new_opts.update(self.options)
-        if type(other) is dict:
-            new_opts.update(other)
-        else:
-            new_opts.update(other.options)
-        return Options(new_opts,kind=self.kind)
+        if type(other) is not dict:
+            other = other.options
+        new_opts.update(other)
+        # options coming from self were already checked
+        new = Options(new_opts,kind=self.kind,check=False)
+        new.check_options(other)
+        return new
 
 
+@cache.cached_render
+@utils.plot_scope
 def plot_graph(valpairs,colors=[],legend_labels=[],draw_styles=[],options={}):
 
     opts = Options(options, kind="graph")
+    utils.current_scope().keep = opts["canvas_keep"]
+    timer = utils.get_stage_timer("plot_graph", opts["profile"])
 
     utils.set_style()
+    timer.lap("style")
 
     c1 = r.TCanvas()
     if opts["canvas_width"] and opts["canvas_height"]:
         width = opts["canvas_width"]
         height = opts["canvas_height"]
         c1 = r.TCanvas("c1", "c1", width, height)
-    legend = get_legend(opts)
+    utils.persist(c1)
+    legend = utils.persist(get_legend(opts))
+
+    timer.lap("canvas")
+
+    decimate = opts["graph_decimate"]
+    if decimate and decimate not in utils.decimation_methods:
+        raise ValueError("graph_decimate should be one of {}".format(", ".join(sorted(utils.decimation_methods))))
+    npoints_max = opts["graph_decimate_npoints"] or c1.GetWw()
 
     mg = r.TMultiGraph()
+    # the graphs are persisted after mg, so that they are released (and removed from it) first
+    utils.persist(mg)
     drawopt = ""
     for parts in enumerate(valpairs):
         ipair = parts[0]
-        rest = parts[1]
+        # numpy arrays of doubles are passed to ROOT as they are
+        rest = [utils.as_double_array(vals) for vals in parts[1]]
+        if decimate and len(rest) in [2,4,6]:
+            indices = utils.decimation_methods[decimate](rest[0], rest[1], npoints_max)
+            if len(indices) < len(rest[0]):
+                rest = [vals[indices] for vals in rest]
+        # missing errors are passed as null pointers, which ROOT takes as 0
+        null = r.nullptr
         typ = "xy"
         if len(rest) == 2:
             xs, ys = rest
-            graph = r.TGraphAsymmErrors(len(xs), array('d',xs), array('d',ys))
+            graph = r.TGraphAsymmErrors(len(xs), xs, ys, null, null, null, null)
             typ = "xy"
             legopt = "LP"
             drawopt = "ALP"
         elif len(rest) == 4:
             xs, ys, ylows, yhighs = rest
-            zeros = array('d',[0. for _ in xs])
-            graph = r.TGraphAsymmErrors(len(xs), array('d',xs), array('d',ys), zeros, zeros, array('d',ylows),array('d',yhighs))
+            graph = r.TGraphAsymmErrors(len(xs), xs, ys, null, null, ylows, yhighs)
             typ = "xyey"
             legopt, drawopt = "FLP","ALP3"
         elif len(rest) == 6:
             xs, ys, xlows, xhighs, ylows, yhighs = rest
-            graph = r.TGraphAsymmErrors(len(xs), array('d',xs), array('d',ys), array('d',xlows), array('d',xhighs), array('d',ylows),array('d',yhighs))
+            graph = r.TGraphAsymmErrors(len(xs), xs, ys, xlows, xhighs, ylows, yhighs)
             typ = "xyexey"
             legopt, drawopt = "FELP","ALP3"
         else:
             raise ValueError("don't recognize this format")
+        utils.persist(graph)
 
         if ipair < len(colors):
             graph.SetLineColor(colors[ipair])
@@ -309,17 +361,24 @@ def plot_graph(valpairs,colors=[],legend_labels=[],draw_styles=[],options={}):
 
         mg.Add(graph,drawopt)
 
+    timer.lap("graphs")
+
     mg.SetTitle(opts["title"])
 
     mg.Draw("A")
 
     if legend_labels: legend.Draw()
 
+    timer.lap("draw")
+
     draw_cms_lumi(c1, opts)
     handle_axes(c1, mg, opts)
     draw_extra_stuff(c1, opts)
+    timer.lap("axes")
     save(c1, opts)
+    timer.lap("save")
 
+    if opts["profile"]: return c1, timer.timings
     return c1
 
 def get_legend(opts):
@@ -364,20 +423,25 @@ def get_legend(opts):
     return legend
 
 
-def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],syst=None,options={},_persist=[],marker_shapes = []):
+@cache.cached_render
+@utils.plot_scope
+def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],syst=None,options={},marker_shapes = []):
 
     opts = Options(options, kind="1dratio")
+    utils.current_scope().keep = opts["canvas_keep"]
+    timer = utils.get_stage_timer("plot_hist", opts["profile"])
 
     style = utils.set_style()
+    timer.lap("style")
 
     c1 = r.TCanvas()
     if opts["canvas_width"] and opts["canvas_height"]:
         width = opts["canvas_width"]
         height = opts["canvas_height"]
         c1 = r.TCanvas("c1", "c1", width, height)
-    _persist.append(c1) # need this to avoid segfault with garbage collection
+    utils.persist(c1)
 
-    has_data = data and data.InheritsFrom(r.TH1.Class())
+    has_data = isinstance(data, ArrayHist) or (data and data.InheritsFrom(r.TH1.Class()))
     do_ratio = (has_data or opts["ratio_numden_indices"]) and not opts["no_ratio"]
     if do_ratio:
         pad_main = r.TPad("pad1","pad1",0.0,opts["canvas_main_y1"],1.0,1.0)
@@ -392,6 +456,7 @@ def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],
         if opts["canvas_ratio_bottommargin"]: pad_ratio.SetBottomMargin(opts["canvas_ratio_bottommargin"])
         if opts["canvas_ratio_leftmargin"]: pad_ratio.SetLeftMargin(opts["canvas_ratio_leftmargin"])
         if opts["canvas_tick_one_side"]: pad_ratio.SetTicks(0, 0)
+        utils.persist(pad_main, pad_ratio)
         pad_main.Draw()
         pad_ratio.Draw()
     else:
@@ -401,10 +466,16 @@ def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],
         if opts["canvas_main_bottommargin"]: pad_main.SetBottomMargin(opts["canvas_main_bottommargin"])
         if opts["canvas_main_leftmargin"]: pad_main.SetLeftMargin(opts["canvas_main_leftmargin"])
         if opts["canvas_tick_one_side"]: pad_main.SetTicks(0, 0)
+        utils.persist(pad_main)
         pad_main.Draw()
 
     pad_main.cd()
 
+    timer.lap("canvas")
+
+    # work on our own lists, so that neither the caller's nor the default ones get extended
+    colors, legend_labels, sig_labels = list(colors), list(legend_labels), list(sig_labels)
+
     # sort backgrounds, but make sure all parameters have same length
     if len(colors) < len(bgs):
         print(">>> Provided only {} colors for {} backgrounds, so using default palette".format(len(colors),len(bgs)))
@@ -433,11 +504,24 @@ def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],
     bgs, colors, legend_labels, original_index_mapping = list(zip(*sorted(zip(bgs,colors,legend_labels,original_index_mapping), key=sort_methods[which_method])))
     # map original indices of bgs to indices of sorted bgs
     original_index_mapping = { oidx: nidx for oidx,nidx in zip(original_index_mapping,list(range(len(bgs)))) }
+    # array histograms (sorted above using their arrays) only need to become ROOT histograms to be drawn,
+    # and with input_immutable, the ROOT histograms we modify below are copied once here
+    copy = opts["input_immutable"]
+    bgs = [to_root(bg, copy=copy) for bg in bgs]
+    sigs = [to_root(sig, copy=copy) for sig in sigs]
+    if has_data: data = to_root(data, copy=copy)
+    if syst: syst = to_root(syst)
+    # the stack and legend only point to these, so they have to live as long as the canvas
+    utils.persist(*(bgs + sigs + ([data] if has_data else [])))
     list(map(lambda x: x.Sumw2(), bgs))
     if not opts["no_overflow"]:
         list(map(utils.move_in_overflows, bgs))
+    # totals, per-process integrals, etc. of the backgrounds, shared by everything below
+    stack_model = utils.StackModel(bgs)
+
+    timer.lap("inputs")
 
-    legend = get_legend(opts)
+    legend = utils.persist(get_legend(opts))
 
     if has_data:
         utils.move_in_overflows(data)
@@ -449,6 +533,7 @@ def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],
         legend.AddEntry(data, opts["legend_datalabel"], "LPE" if not opts["hist_disable_xerrors"] else "PE")
 
     stack = r.THStack("stack", "stack")
+    utils.persist(stack)
     for ibg,bg in enumerate(bgs):
         if ibg < len(colors):
             bg.SetLineColor(r.TColor.GetColorDark(colors[ibg]))
@@ -494,7 +579,7 @@ def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],
     # returns the actual maximum (even though that's what we set it to!) because
     # thstack multiplies the max by 1.05??? Odd
     # So here, we take into account that scaling for the rest of this function
-    ymin, ymax = 0., utils.get_stack_maximum(data,stack,opts)
+    ymin, ymax = 0., utils.get_stack_maximum(data,stack,opts,stack_model=stack_model)
     stack.SetMaximum(ymax)
     stack.Draw(drawopt)
     ymax = 1.05*ymax if opts["do_stack"] else 1.00*ymax
@@ -503,17 +588,17 @@ def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],
         stack.SetMaximum(opts["yaxis_range"][1])
         ymin, ymax = opts["yaxis_range"]
 
+    timer.lap("stack")
+
     if syst:
         # Turn relative bin errors from syst into drawable histogram
         bgs_syst = syst.Clone("bgs_syst")
-        bgs_syst.Reset()
-        for hist in bgs:
-            bgs_syst.Add(hist)
-        for ibin in range(0,bgs_syst.GetNbinsX()+2):
-            # Set the bin content of the systematic band to the total of the backgrounds
-            # and the error to the actual value of the systematic histogram
-            bgs_syst.SetBinContent(ibin, bgs_syst.GetBinContent(ibin))
-            bgs_syst.SetBinError(ibin, syst.GetBinContent(ibin))
+        # Set the bin content of the systematic band to the total of the backgrounds
+        # and the error to the actual value of the systematic histogram
+        band_vals, band_sumw2 = utils.hist_arrays(bgs_syst, create_sumw2=True)
+        band_sumw2[:] = band_vals**2.
+        band_vals[:] = stack_model.total
+        utils.sync_hist_stats(bgs_syst)
         if not opts["no_overflow"]: utils.move_in_overflows(bgs_syst)
         bgs_syst.SetMarkerSize(0)
         bgs_syst.SetMarkerColorAlpha(r.kWhite,0.)
@@ -522,21 +607,21 @@ def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],
         bgs_syst.SetFillStyle(opts["bkg_err_fill_style"])
 
         # Compute the systematics band in the ratio, to be drawn later in the ratio
-        all_bgs = syst.Clone("all_bgs")
-        all_bgs.Reset()
-        for hist in bgs:
-            all_bgs.Add(hist)
         ratio_syst = bgs_syst.Clone("ratio_syst")
-        ratio_syst.Sumw2()
-        ratio_syst.Divide(all_bgs)
+        syst_vals, syst_sumw2 = utils.hist_arrays(ratio_syst, create_sumw2=True)
+        syst_vals[:], syst_sumw2[:] = stats.divide(syst_vals, syst_sumw2, stack_model.total, stack_model.total_sumw2)
+        utils.sync_hist_stats(ratio_syst)
         ratio_syst.SetFillColorAlpha(r.kGray+2,0.4)
         if not opts["bkg_err_fill_color"]: ratio_syst.SetFillColorAlpha(r.kGray+2,0.4)
         else: ratio_syst.SetFillColorAlpha(opts["bkg_err_fill_color"],0.4)
         ratio_syst.SetFillStyle(opts["bkg_err_fill_style"])
+        utils.persist(bgs_syst, ratio_syst)
 
         # Draw the main band in the main pad
         bgs_syst.Draw("E2 SAME")
 
+    timer.lap("syst")
+
     if has_data:
         data.Draw("samepe"+extradrawopt)
 
@@ -556,12 +641,18 @@ def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],
 
 
 
+    timer.lap("data_signals")
+
     draw_cms_lumi(pad_main, opts)
     handle_axes(pad_main, stack, opts)
     draw_extra_stuff(pad_main, opts)
 
+    timer.lap("axes")
+
     if opts["legend_smart"] and not opts["yaxis_log"]:
-        utils.smart_legend(legend, bgs, data=data, ymin=ymin, ymax=ymax, opts=opts)
+        utils.smart_legend(legend, bgs, data=data, ymin=ymin, ymax=ymax, opts=opts, stack_model=stack_model)
+
+    timer.lap("smart_legend")
 
     if opts["legend_rounded"]:
         legend.SetFillColor(0)
@@ -573,8 +664,12 @@ def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],
     else:
         legend.Draw()
 
+    timer.lap("legend")
+
     if opts["legend_percentageinbox"]:
-        draw_percentageinbox(legend, bgs, sigs, opts, has_data=has_data)
+        draw_percentageinbox(legend, bgs, sigs, opts, has_data=has_data, stack_model=stack_model)
+
+    timer.lap("percentageinbox")
 
     if do_ratio:
         pad_ratio.cd()
@@ -588,34 +683,25 @@ def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],
         else:
             # construct numer and denom to be used everywhere
             numer = data.Clone("numer")
-            denom = bgs[0].Clone("sumbgs")
-            denom.Reset()
-            denom = sum(bgs,denom)
+            denom = stack_model.total_hist("sumbgs")
 
         ratio = numer.Clone("ratio")
-        if opts["ratio_binomial_errors"]:
-            ratio.Divide(numer,denom,1,1,"b")
-        else:
-            ratio.Divide(denom)
+        utils.persist(ratio)
+        ratio_vals, ratio_sumw2 = utils.hist_arrays(ratio, create_sumw2=True)
+        numer_vals, numer_errs = utils.hist_arrays(numer)[0], utils.hist_errors(numer)
+        denom_vals, denom_errs = utils.hist_arrays(denom)[0], utils.hist_errors(denom)
+        ratio_vals[:], ratio_sumw2[:] = stats.divide(numer_vals, numer_errs**2., denom_vals, denom_errs**2., binomial=opts["ratio_binomial_errors"])
+
+        if opts["ratio_pull"]:
+            if syst:
+                # when doing a pull, the denominator is usually MC
+                # which is carries the syst error we need to add in
+                denom_errs = (denom_errs**2. + utils.hist_errors(bgs_syst)**2.)**0.5
+            ratio_vals[:] = stats.pulls(numer_vals, numer_errs, denom_vals, denom_errs)
+            ratio_sumw2[:] = 0.
+        utils.sync_hist_stats(ratio)
 
         if opts["ratio_pull"]:
-            for ibin in range(1,ratio.GetNbinsX()+1):
-                ratio_val = ratio.GetBinContent(ibin)
-                numer_val = numer.GetBinContent(ibin)
-                numer_err = numer.GetBinError(ibin)
-                denom_val = denom.GetBinContent(ibin)
-                denom_err = denom.GetBinError(ibin)
-                if syst:
-                    # when doing a pull, the denominator is usually MC
-                    # which is carries the syst error we need to add in
-                    denom_err = (denom_err**2. + bgs_syst.GetBinError(ibin)**2.)**0.5
-                # gaussian pull
-                pull = (ratio_val-1.)/((numer_err**2.+denom_err**2.)**0.5)
-                if numer_val > 1e-6:
-                    # more correct pull, but is inf when 0 data, so fall back to gaus pull in that case
-                    pull = r.RooStats.NumberCountingUtils.BinomialObsZ(numer_val,denom_val,denom_err/denom_val);
-                ratio.SetBinContent(ibin,pull)
-                ratio.SetBinError(ibin,0.)
             opts["ratio_range"] = [-3.0,3.0]
             opts["ratio_ndivisions"] = 208
             opts["ratio_horizontal_lines"] = [-1.,0.,1.]
@@ -631,8 +717,9 @@ def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],
             t.SetTextFont(42)
             t.SetTextColor(r.kBlack)
             t.SetTextSize(0.1)
+            yvals = utils.hist_arrays(ratio)[0]
             for ibin in range(1,ratio.GetNbinsX()+1):
-                yval = ratio.GetBinContent(ibin)
+                yval = float(yvals[ibin])
                 xval = ratio.GetBinCenter(ibin)
                 yvaldraw = yval
                 if yvaldraw > 2.35: yvaldraw -= 0.6
@@ -664,17 +751,9 @@ def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],
             yloc = pad_ratio.GetAbsHNDC()
             to_show = ""
             if opts["ratio_chi2prob"]:
-                chi2 = 0.
-                ndof = 0
-                for ibin in range(1,ratio.GetNbinsX()+1):
-                    err2 = ratio.GetBinError(ibin)**2.
-                    if err2 < 1.e-6: continue
-                    if syst:
-                        err2 += ratio_syst.GetBinError(ibin)**2.
-                    val = ratio.GetBinContent(ibin)
-                    chi2 += (val-1.)**2./err2
-                    ndof += 1
-                prob = r.TMath.Prob(chi2,ndof-1)
+                syst_errs = utils.hist_errors(ratio_syst)[1:-1] if syst else None
+                chi2, ndof = stats.ratio_chi2(utils.hist_arrays(ratio)[0][1:-1], utils.hist_errors(ratio)[1:-1], syst_errs)
+                prob = stats.chi2_prob(chi2,ndof-1)
                 to_show = "P(#chi^{{2}}/ndof) = {:.2f}".format(prob)
             if opts["ratio_pull"] and opts["ratio_pull_numbers"]:
                 mean, sigma, vals = utils.get_mean_sigma_1d_yvals(ratio)
@@ -684,8 +763,12 @@ def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],
 
         pad_main.cd()
 
+    timer.lap("ratio")
+
     save(c1, opts)
+    timer.lap("save")
 
+    if opts["profile"]: return c1, timer.timings
     return c1
 
 
@@ -693,9 +776,7 @@ def do_style_ratio(ratio, opts, tpad):
     if opts["ratio_range"][1] <= opts["ratio_range"][0]:
         # if high <= low, compute range automatically (+-3 sigma interval)
         mean, sigma, vals = utils.get_mean_sigma_1d_yvals(ratio)
-        low = max(mean-3*sigma,min(vals))-sigma/1e3
-        high = min(mean+3*sigma,max(vals))+sigma/1e3
-        opts["ratio_range"] = [low,high]
+        opts["ratio_range"] = list(stats.robust_range(vals, mean, sigma, nsigma=3.))
     ratio.SetMarkerStyle(20)
     ratio.SetMarkerSize(0.8)
     ratio.SetLineWidth(2)
@@ -721,7 +802,7 @@ def do_style_ratio(ratio, opts, tpad):
     ratio.GetXaxis().SetTickSize(0.06 * opts["ratio_tick_length_scale"])
     ratio.GetYaxis().SetTickSize(0.03 * opts["ratio_tick_length_scale"])
 
-def draw_percentageinbox(legend, bgs, sigs, opts, has_data=False):
+def draw_percentageinbox(legend, bgs, sigs, opts, has_data=False, stack_model=None):
     t = r.TLatex()
     t.SetTextAlign(22)
     t.SetTextFont(42)
@@ -729,7 +810,7 @@ def draw_percentageinbox(legend, bgs, sigs, opts, has_data=False):
     info = utils.get_legend_marker_info(legend)
     t.SetTextSize(info["label_height"])
     all_entries = list(bgs) + list(sigs)
-    total_integral = sum(bg.Integral() for bg in bgs)
+    if stack_model is None: stack_model = utils.StackModel(bgs)
     # we want the number to be centered, without the % symbol, so nudge the percentage text right a bit
     nudge_right = info["box_width"]*0.15
     if info["draw_vertical"]:
@@ -743,7 +824,7 @@ def draw_percentageinbox(legend, bgs, sigs, opts, has_data=False):
             icoord -= 1
         if icoord >= len(bgs): continue # don't do signals
         bg = all_entries[icoord]
-        percentage = int(100.0*bg.Integral()*(1.+1.e-6)/total_integral)
+        percentage = int(100.0*stack_model.integrals[icoord]*(1.+1.e-6)/stack_model.total_integral)
         color = r.gROOT.GetColor(bg.GetFillColor())
         red = color.GetRed()
         green = color.GetGreen()
@@ -804,36 +885,63 @@ def handle_axes(c1, obj, opts):
             obj.GetZaxis().SetNoExponent(opts["zaxis_noexponents"])
 
 
+@cache.cached_render
+@utils.plot_scope
 def plot_hist_2d(hist,options={}):
 
     opts = Options(options, kind="2d")
+    # a histogram converted from an ArrayHist is only referenced from here, but has to outlive the canvas
+    hist = utils.persist(to_root(hist))
+    utils.current_scope().keep = opts["canvas_keep"]
+    timer = utils.get_stage_timer("plot_hist_2d", opts["profile"])
 
-    style = utils.set_style_2d()
+    style = utils.set_style_2d(overrides={"SetPaintTextFormat": (opts["bin_text_format"],)})
 
     utils.set_palette(style, opts["palette_name"])
+    timer.lap("style")
 
     c1 = r.TCanvas()
     if opts["canvas_width"] and opts["canvas_height"]:
         width = opts["canvas_width"]
         height = opts["canvas_height"]
         c1 = r.TCanvas("c1", "c1", width, height)
+    utils.persist(c1)
+
+    timer.lap("canvas")
+
+    if opts["downsample_2d"]:
+        nx_max, ny_max = utils.get_frame_pixels(c1)
+        if opts["downsample_2d_max_bins"]:
+            nx_max, ny_max = min(nx_max, opts["downsample_2d_max_bins"][0]), min(ny_max, opts["downsample_2d_max_bins"][1])
+        hist = utils.downsample_2d(hist, nx_max, ny_max, mode=opts["downsample_2d"],
+                xrange=opts["xaxis_range"], yrange=opts["yaxis_range"])
+        utils.persist(hist)
+
+    timer.lap("downsample")
 
     hist.Draw(opts["draw_option_2d"])
 
     hist.SetTitle(opts["title"])
 
     hist.SetMarkerSize(opts["bin_text_size"])
-    style.SetPaintTextFormat(opts["bin_text_format"])
+
+    timer.lap("draw")
 
     if opts["bin_text_smart"]:
         utils.draw_smart_2d_bin_labels(hist, opts)
 
+    timer.lap("bin_labels")
+
     draw_cms_lumi(c1, opts)
     handle_axes(c1, hist, opts)
     draw_extra_stuff(c1, opts)
+    timer.lap("axes")
     save(c1, opts)
+    timer.lap("save")
 
-def draw_cms_lumi(c1, opts, _persist=[]):
+    if opts["profile"]: return c1, timer.timings
+
+def draw_cms_lumi(c1, opts):
     t = r.TLatex()
     t.SetTextAlign(11) # align bottom left corner of text
     t.SetTextColor(r.kBlack)
@@ -853,7 +961,7 @@ def draw_cms_lumi(c1, opts, _persist=[]):
         t.SetTextAlign(31) # align bottom right
         t.SetTextFont(42) # align bottom right
         t.DrawLatexNDC(xlumi,ycms,"{lumi_str} {lumi_unit}^{{-1}} ({energy} TeV)".format(energy=energy, lumi_str=lumi_value, lumi_unit=lumi_unit))
-    _persist.append(t)
+    utils.persist(t)
 
 def draw_extra_stuff(c1, opts):
 
@@ -902,33 +1010,68 @@ def draw_extra_stuff(c1, opts):
 
 def save(c1, opts):
 
-    fname = opts["output_name"]
-    dirname = os.path.dirname(fname)
-    if dirname and not os.path.isdir(dirname):
-        print(">>> Plot should go inside {}/, but it doesn't exist.".format(dirname))
-        print(">>> Instead of crashing, I'll do you a solid and make it".format(dirname))
-        os.system("mkdir -p {}".format(dirname))
-
+    # inside e.g. a booklet, the plot goes there instead of into its own files
+    sink = sinks.current_sink()
+    if sink is not None:
+        sink.add(c1, opts)
+        return
+
+    fnames = utils.get_output_names(opts)
+    for dirname in sorted(set(os.path.dirname(fname) for fname in fnames)):
+        if dirname and not os.path.isdir(dirname):
+            print(">>> Plot should go inside {}/, but it doesn't exist.".format(dirname))
+            print(">>> Instead of crashing, I'll do you a solid and make it".format(dirname))
+            # another process (e.g., a render_batch worker) may be making it at the same time
+            os.makedirs(dirname, exist_ok=True)
+
+    # diffing, ic, etc. are done with the first output
+    fname = fnames[0]
     orig_fname = None
     if opts["output_diff_previous"]:
         if os.path.exists(fname):
             orig_fname = fname.replace(".pdf","_orig.pdf")
-            os.system("mv {} {}".format(fname, orig_fname))
+            shutil.move(fname, orig_fname)
 
-    print(">>> Saving {}".format(fname))
-    c1.SaveAs(fname)
+    # the canvas is drawn once, and only written out for each format
+    for fname_out in fnames:
+        print(">>> Saving {}".format(fname_out))
+        if fname_out.endswith(".json"):
+            r.TBufferJSON.ExportToFile(fname_out,c1)
+        else:
+            c1.SaveAs(fname_out)
 
     if opts["output_diff_previous"]:
         fname_diff = "diff.png"
         utils.diff_images(orig_fname,fname, output=fname_diff)
         os.system("ic {}".format(fname_diff))
         if orig_fname:
-            os.system("rm {}".format(orig_fname))
+            os.remove(orig_fname)
 
     if opts["output_ic"]:
         os.system("ic {}".format(fname))
-    if opts["output_jsroot"]:
-        r.TBufferJSON.ExportToFile("{}.json".format(fname.rsplit(".",1)[0]),c1)
+
+def booklet(fname, toc=None):
+    """
+    Context manager making every plot inside it a page of the multi-page PDF fname.
+    See `sinks.Booklet`.
+    """
+    return sinks.Booklet(fname, toc=toc)
+
+def web_bundle(dirname, dtype=None):
+    """
+    Context manager collecting the JSROOT json of every plot inside it into one compressed
+    bundle in dirname, with an index for loading plots lazily. dtype="float32" stores
+    non-integer arrays more compactly, but lossily. See `sinks.WebBundle`.
+    """
+    return sinks.WebBundle(dirname, dtype=dtype)
+
+def render_batch(jobs, workers=None):
+    """
+    Render a list of plot jobs in parallel with a pool of worker processes.
+    See `batch.render_batch` for the job format and the returned statuses.
+    """
+    from . import batch
+    return batch.render_batch(jobs, workers=workers)
 
 if __name__ == "__main__":
 
@@ -0,0 +1,178 @@
+# coding: utf-8
+"""
+Compare a directory of new plots against a directory of reference plots.
+PDFs are rasterized with Ghostscript in a pool of processes (rasters are cached
+as .npy files keyed by the hash of the file). Plots whose files are identical apart from
+their metadata (creation date, etc.) are the same without rasterizing them, and the
+others are compared pixel by pixel.
+    >>> from plottery import regression
+    >>> results = regression.compare_dirs("reference/", "plots/", report="report.json")
+or
+    python -m plottery.regression reference/ plots/ --report report.json
+"""
+import os
+import re
+import glob
+import json
+import hashlib
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+conversion_cmd = ["gs", "-q", "-dSAFER", "-dBATCH", "-dNOPAUSE", "-sDEVICE=pngalpha", "-dUseCropBox"]
+
+# entries of a PDF that change every time the same plot is saved, and don't affect what it looks like
+pdf_volatile = re.compile(br"/(?:CreationDate|ModDate)\s*\([^)]*\)|/ID\s*\[[^\]]*\]")
+
+def file_hash(fname):
+    """
+    Hash of the contents of fname, leaving out the volatile metadata of PDFs,
+    so files with equal hashes look the same (but not necessarily the other way around)
+    """
+    with open(fname, "rb") as fh:
+        contents = fh.read()
+    if fname.rsplit(".",1)[-1] == "pdf":
+        contents = pdf_volatile.sub(b"", contents)
+    return hashlib.sha1(contents).hexdigest()
+
+def read_image(fname):
+    import matplotlib.pyplot as plt
+    return plt.imread(fname)
+
+def rasterize(fname, density=75):
+    """
+    Return the image in fname as an array of shape (height, width, channels) with values from 0 to 1,
+    converting the first page of .pdf files with Ghostscript
+    """
+    if fname.rsplit(".",1)[-1] != "pdf":
+        return read_image(fname)
+    fd, fname_png = tempfile.mkstemp(suffix=".png")
+    os.close(fd)
+    try:
+        subprocess.check_call(conversion_cmd + ["-dFirstPage=1", "-dLastPage=1", "-r{}".format(density), "-o", fname_png, fname])
+        return read_image(fname_png)
+    finally:
+        os.remove(fname_png)
+
+def load_raster(fname, cache_dir=None, density=75):
+    """
+    rasterize(), but reusing a previous result from cache_dir if the file contents didn't change
+    """
+    if not cache_dir:
+        return rasterize(fname, density=density)
+    cached = os.path.join(cache_dir, "{}_{}.npy".format(file_hash(fname), density))
+    if os.path.exists(cached):
+        return np.load(cached)
+    img = rasterize(fname, density=density)
+    # write then rename, so that other processes never see half a file
+    tmpname = "{}.tmp{}.npy".format(cached[:-4], os.getpid())
+    np.save(tmpname, img)
+    os.replace(tmpname, cached)
+    return img
+
+def difference_image(img1, img2):
+    """
+    Per-pixel difference of two RGB(A) images of the same shape (0 where identical, 1 for black vs white)
+    """
+    error = np.fabs(img2[:,:,:3] - img1[:,:,:3])
+    return np.sqrt((error*error).sum(axis=2))/np.sqrt(3)
+
+def compare_files(fname_ref, fname_new, cache_dir=None, density=75, diff_output=None):
+    """
+    Return a dict with the status ("same" or "changed") and score (mean of the per-pixel difference,
+    0 if the files are identical, 1 if the image size changed) of two plots.
+    The checks before the per-pixel difference are exact, so they only skip it for plots that are the same.
+    """
+    result = {"reference": fname_ref, "new": fname_new, "status": "same", "score": 0., "error": None}
+    try:
+        if file_hash(fname_ref) == file_hash(fname_new):
+            return result
+        img_ref = load_raster(fname_ref, cache_dir=cache_dir, density=density)
+        img_new = load_raster(fname_new, cache_dir=cache_dir, density=density)
+        if img_ref.shape != img_new.shape:
+            result.update(status="changed", score=1.)
+            return result
+        if np.array_equal(img_ref, img_new):
+            return result
+        diff = difference_image(img_ref, img_new)
+        result["score"] = float(diff.mean())
+        if result["score"] > 0.:
+            result["status"] = "changed"
+            if diff_output:
+                import matplotlib.pyplot as plt
+                plt.imsave(diff_output, -diff, cmap="gray")
+                result["diff"] = diff_output
+    except Exception as e:
+        result.update(status="error", error="{}: {}".format(type(e).__name__, e))
+    return result
+
+def compare_dirs(ref_dir, new_dir, pattern="*.pdf", workers=None, cache_dir=None, density=75,
+        threshold=0., diff_dir=None, report=None):
+    """
+    Compare the plots matching pattern in new_dir against those with the same relative path in ref_dir.
+    Plots with a score above threshold are reported as changed (see compare_files). Plots only in one
+    of the directories are reported as "missing" or "new". If given, diff images are written to diff_dir,
+    and a summary to report (.json, or plain text otherwise). Returns the list of results, most changed first.
+    """
+    def relnames(dirname):
+        fnames = glob.glob(os.path.join(dirname, "**", pattern), recursive=True)
+        return set(os.path.relpath(fname, dirname) for fname in fnames)
+    ref_names, new_names = relnames(ref_dir), relnames(new_dir)
+    if cache_dir: os.makedirs(cache_dir, exist_ok=True)
+    if diff_dir: os.makedirs(diff_dir, exist_ok=True)
+
+    results = []
+    for name in sorted(ref_names - new_names):
+        results.append({"reference": os.path.join(ref_dir, name), "new": None, "status": "missing", "score": 1., "error": None})
+    for name in sorted(new_names - ref_names):
+        results.append({"reference": None, "new": os.path.join(new_dir, name), "status": "new", "score": 1., "error": None})
+
+    common = sorted(ref_names & new_names)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for name in common:
+            diff_output = None
+            if diff_dir:
+                diff_output = os.path.join(diff_dir, "{}_diff.png".format(os.path.splitext(name)[0].replace(os.sep, "_")))
+            futures.append(executor.submit(compare_files, os.path.join(ref_dir, name), os.path.join(new_dir, name),
+                cache_dir=cache_dir, density=density, diff_output=diff_output))
+        for future in futures:
+            result = future.result()
+            if result["status"] == "changed" and result["score"] <= threshold:
+                result["status"] = "same"
+            results.append(result)
+
+    results.sort(key=lambda x: -x["score"])
+    counts = dict((status, sum(res["status"] == status for res in results)) for status in ("same","changed","missing","new","error"))
+    print(">>> Compared {} plots: {changed} changed, {missing} missing, {new} new, {error} errors".format(len(common), **counts))
+    if report:
+        write_report(results, report)
+    return results
+
+def write_report(results, fname):
+    with open(fname, "w") as fh:
+        if fname.endswith(".json"):
+            json.dump(results, fh, indent=1)
+            return
+        for res in results:
+            if res["status"] == "same": continue
+            fh.write("{:8s} {:.5f} {}{}\n".format(res["status"], res["score"], res["new"] or res["reference"],
+                " ({})".format(res["error"]) if res["error"] else ""))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="compare a directory of plots against a reference directory")
+    parser.add_argument("ref_dir")
+    parser.add_argument("new_dir")
+    parser.add_argument("--pattern", default="*.pdf", help="glob for files to compare (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes (default: number of cores)")
+    parser.add_argument("--cache-dir", default=None, help="directory to cache rasters in")
+    parser.add_argument("--density", type=int, default=75, help="resolution for rasterizing PDFs (default: %(default)s)")
+    parser.add_argument("--threshold", type=float, default=0., help="minimum score to count as changed (default: %(default)s)")
+    parser.add_argument("--diff-dir", default=None, help="directory to write diff images to")
+    parser.add_argument("--report", default=None, help="file to write the summary to (.json or text)")
+    args = parser.parse_args()
+    compare_dirs(args.ref_dir, args.new_dir, pattern=args.pattern, workers=args.workers, cache_dir=args.cache_dir,
+            density=args.density, threshold=args.threshold, diff_dir=args.diff_dir, report=args.report)
@@ -0,0 +1,203 @@
+# coding: utf-8
+"""
+Render every plot described by a manifest straight from ROOT files, e.g.,
+    {
+        "processes": [
+            {"name": "ttbar", "files": ["skims/ttbar_*.root"], "type": "bg", "label": "t#bar{t}", "color": 2},
+            {"name": "wjets", "files": ["skims/wjets_*.root"], "type": "bg"},
+            {"name": "data", "files": ["skims/data_*.root"], "type": "data"}
+        ],
+        "plots": [
+            {"hists": "h_met*", "options": {"yaxis_log": true}},
+            {"hists": ["h_njets", "h_nbtags"]},
+            {"hists": "h_occupancy", "kind": "hist_2d"}
+        ],
+        "options": {"legend_smart": true},
+        "output_dir": "plots",
+        "output_ext": "pdf"
+    }
+Processes are of type "bg" (default), "sig" or "data", and the histograms of the
+files of a process are added together. "hists" are glob patterns for the histogram
+names (paths like "dir/h_met" for histograms in directories), and each name
+matching a pattern becomes one plot (a plot_hist of all the processes, or for "hist_2d",
+one plot_hist_2d per process). The keys of each file are indexed without reading
+anything, and the jobs only refer to the histograms (see batch.SumRef), so each one is
+read by the process rendering its plot, when it renders it.
+    >>> from plottery import render
+    >>> results = render.render("manifest.json", workers=4)
+or
+    python -m plottery render manifest.json --workers 4
+"""
+import os
+import glob
+import json
+import fnmatch
+
+from . import batch
+from .lazyroot import r
+
+class KeyIndex(object):
+    """
+    Histogram names in a set of ROOT files, found by walking the keys
+    (without reading any histogram, and closing each file afterwards)
+    """
+
+    def __init__(self, fnames):
+        self.keys = {}
+        self.class_cache = {}
+        for fname in fnames:
+            tfile = r.TFile.Open(fname)
+            if not tfile or tfile.IsZombie():
+                raise IOError("can't open {}".format(fname))
+            try:
+                self.keys[fname] = {}
+                self.walk(tfile, "", self.keys[fname])
+            finally:
+                tfile.Close()
+
+    def inherits(self, classname, base):
+        key = (classname, base)
+        if key not in self.class_cache:
+            cls = r.TClass.GetClass(classname)
+            self.class_cache[key] = bool(cls) and bool(cls.InheritsFrom(base))
+        return self.class_cache[key]
+
+    def walk(self, tdir, prefix, keys):
+        for key in tdir.GetListOfKeys():
+            name = prefix + key.GetName()
+            # several cycles of one object are listed highest first, and Get() returns that one
+            if name in keys: continue
+            classname = key.GetClassName()
+            if self.inherits(classname, "TDirectory"):
+                self.walk(key.ReadObj(), name + "/", keys)
+            elif self.inherits(classname, "TH1"):
+                keys[name] = classname
+
+    def names(self, fnames=None):
+        fnames = self.keys.keys() if fnames is None else fnames
+        names = set()
+        for fname in fnames:
+            names.update(self.keys[fname])
+        return names
+
+    def refs(self, fnames, name):
+        """
+        FileRefs to the histogram `name` in the files that have it
+        """
+        return [batch.FileRef(fname, name) for fname in fnames if name in self.keys[fname]]
+
+def load_manifest(manifest):
+    """
+    manifest can be a dict, or the name of a json file containing one
+    """
+    if isinstance(manifest, dict):
+        return manifest
+    with open(manifest) as fh:
+        return json.load(fh)
+
+def expand_processes(manifest):
+    processes = []
+    for proc in manifest["processes"]:
+        proc = dict(proc)
+        patterns = proc["files"] if isinstance(proc["files"], list) else [proc["files"]]
+        proc["fnames"] = sorted(set(fname for pattern in patterns for fname in glob.glob(pattern)))
+        if not proc["fnames"]:
+            print(">>> No files match {} for process {}".format(patterns, proc["name"]))
+        proc.setdefault("type", "bg")
+        proc.setdefault("label", proc["name"])
+        processes.append(proc)
+    return processes
+
+def get_output_name(manifest, name, suffix=""):
+    basename = "{}{}.{}".format(name.replace("/", "_"), suffix, manifest.get("output_ext", "pdf"))
+    return os.path.join(manifest.get("output_dir", "."), basename)
+
+def make_jobs(manifest, index, processes):
+    """
+    Return a list of jobs for batch.run_job making the plots of the manifest (in order),
+    where each process is a batch.SumRef of its histograms in its files
+    """
+    all_names = index.names()
+    jobs = []
+    done = set()
+    for plot in manifest["plots"]:
+        patterns = plot["hists"] if isinstance(plot["hists"], list) else [plot["hists"]]
+        kind = plot.get("kind", "hist")
+        names = sorted(set(name for pattern in patterns for name in fnmatch.filter(all_names, pattern)))
+        if not names:
+            print(">>> No histograms match {}".format(patterns))
+        for name in names:
+            if (kind, name) in done: continue
+            done.add((kind, name))
+            options = dict(manifest.get("options", {}))
+            options.update(plot.get("options", {}))
+            hists = []
+            for proc in processes:
+                refs = index.refs(proc["fnames"], name)
+                hists.append(batch.SumRef(refs, proc["label"]) if refs else None)
+            if kind == "hist_2d":
+                for proc, hist in zip(processes, hists):
+                    if hist is None: continue
+                    opts = dict(options, output_name=get_output_name(manifest, name, "_"+proc["name"]))
+                    jobs.append({"kind": "hist_2d", "args": [hist], "kwargs": {"options": opts}})
+                continue
+            bgs, legend_labels, colors, sigs, sig_labels, data_refs = [], [], [], [], [], []
+            for proc, hist in zip(processes, hists):
+                if hist is None: continue
+                if proc["type"] == "data":
+                    data_refs.extend(hist.refs)
+                elif proc["type"] == "sig":
+                    sigs.append(hist)
+                    sig_labels.append(proc["label"])
+                else:
+                    bgs.append(hist)
+                    legend_labels.append(proc["label"])
+                    colors.append(proc.get("color"))
+            if not bgs:
+                print(">>> Skipping {}, which no background has".format(name))
+                continue
+            kwargs = {
+                    "data": batch.SumRef(data_refs, "Data") if data_refs else None,
+                    "bgs": bgs,
+                    "legend_labels": legend_labels,
+                    "sigs": sigs,
+                    "sig_labels": sig_labels,
+                    "options": dict(options, output_name=get_output_name(manifest, name)),
+                    }
+            if all(color is not None for color in colors):
+                kwargs["colors"] = colors
+            jobs.append({"kind": "hist", "kwargs": kwargs})
+    return jobs
+
+def render(manifest, workers=1, dry_run=False):
+    """
+    Render every plot in the manifest (a dict or json file name, see module docstring),
+    using render_batch with `workers` processes if there's more than one.
+    Returns the list of results (see batch.render_batch), or the jobs if dry_run.
+    """
+    manifest = load_manifest(manifest)
+    processes = expand_processes(manifest)
+    output_dir = manifest.get("output_dir", ".")
+    if not dry_run: os.makedirs(output_dir, exist_ok=True)
+
+    index = KeyIndex(sorted(set(fname for proc in processes for fname in proc["fnames"])))
+    jobs = make_jobs(manifest, index, processes)
+
+    if dry_run:
+        for job in jobs:
+            print(job["kwargs"]["options"]["output_name"])
+        return jobs
+    if workers > 1:
+        return batch.render_batch(jobs, workers=workers)
+    files = {}
+    try:
+        results = [batch.run_job(ijob, job, files) for ijob, job in enumerate(jobs)]
+    finally:
+        for tfile in files.values():
+            if tfile: tfile.Close()
+    nfailed = sum(res["status"] != "ok" for res in results)
+    print(">>> Rendered {} plots ({} failed)".format(len(jobs), nfailed))
+    for res in results:
+        if res["status"] != "ok":
+            print(">>> {}: {}".format(res["output_name"], res["error"]))
+    return results
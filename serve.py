@@ -0,0 +1,312 @@
+# coding: utf-8
+"""
+A long-lived plotting server, so that scripts don't pay for starting
+Python and ROOT for every handful of plots. Start it with
+    python -m plottery serve --workers 4
+which imports ROOT, draws a warm-up plot and forks workers that all accept
+jobs on a Unix socket (only accessible by the same user). Then, from any script,
+    from plottery import serve
+    serve.plot_hist(bgs=[h1,h2], options={"output_name": "met.pdf"})
+takes the same arguments as plottery.plot_hist, but sends the histograms (as
+arrays, see arrayhist.ArrayHist) to the server and returns the job result dict
+(see batch.run_job). Relative output names are relative to the caller's directory.
+These functions share one connection (see Client), so the worker serving it keeps
+the files of FileRefs open from one job to the next, until close() or the script exits.
+Messages are pickles prefixed by their length, so only run the server for yourself.
+"""
+import os
+import sys
+import time
+import errno
+import pickle
+import signal
+import socket
+import struct
+import tempfile
+from multiprocessing.connection import wait
+
+from . import batch
+from . import lazyroot
+from .arrayhist import ArrayHist
+
+header = struct.Struct(">Q")
+
+def default_socket_path():
+    dirname = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(dirname, "plottery-{}.sock".format(os.getuid()))
+
+def recv_exactly(sock, nbytes):
+    buf = bytearray(nbytes)
+    view = memoryview(buf)
+    while nbytes:
+        nread = sock.recv_into(view, nbytes)
+        if not nread:
+            raise EOFError("connection closed")
+        view = view[nread:]
+        nbytes -= nread
+    return buf
+
+def send_msg(sock, obj):
+    payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(header.pack(len(payload)) + payload)
+
+def recv_msg(sock):
+    """
+    Return the next message from sock, or None if the other end closed the connection
+    """
+    try:
+        size, = header.unpack(recv_exactly(sock, header.size))
+    except EOFError:
+        return None
+    return pickle.loads(recv_exactly(sock, size))
+
+def handle_connection(conn):
+    """
+    Run every job sent over conn (until the client hangs up), replying with each result.
+    Files opened for FileRefs are only reused within the connection, since relative names
+    depend on the client's directory and files can be rewritten between clients.
+    """
+    files = {}
+    index = 0
+    try:
+        while True:
+            job = recv_msg(conn)
+            if job is None:
+                break
+            if job.get("kind") == "ping":
+                send_msg(conn, {"status": "ok", "pid": os.getpid()})
+                continue
+            cwd = job.pop("cwd", None)
+            if cwd: os.chdir(cwd)
+            send_msg(conn, batch.run_job(index, job, files))
+            index += 1
+    finally:
+        for tfile in files.values():
+            if tfile: tfile.Close()
+
+def worker_loop(sock):
+    # the server decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    while True:
+        conn, _ = sock.accept()
+        try:
+            handle_connection(conn)
+        except (EOFError, OSError) as e:
+            print(">>> Lost connection to client: {}".format(e))
+        finally:
+            conn.close()
+
+def warm_up():
+    """
+    Draw (and save) a small plot, so that the libraries and styles the
+    plot functions need are loaded before the workers are forked
+    """
+    import numpy as np
+    from . import plottery as ply
+    dirname = tempfile.mkdtemp(prefix="plottery_warmup")
+    fname = os.path.join(dirname, "warmup.pdf")
+    counts = np.arange(1., 11.)
+    ply.plot_hist(
+            data=ArrayHist(counts, np.linspace(0.,1.,11)),
+            bgs=[ArrayHist(counts, np.linspace(0.,1.,11))],
+            options={"output_name": fname, "do_stack": True, "legend_percentageinbox": True},
+            )
+    ply.plot_hist_2d(ArrayHist(np.outer(counts, counts), (np.linspace(0.,1.,11), np.linspace(0.,1.,11))),
+            options={"output_name": fname})
+    os.remove(fname)
+    os.rmdir(dirname)
+
+def bind_socket(socket_path):
+    """
+    Return a listening Unix socket at socket_path that only this user can connect to,
+    replacing a stale socket file left over by a server that's no longer running
+    """
+    if os.path.exists(socket_path):
+        if is_running(socket_path):
+            raise RuntimeError("a server is already listening on {}".format(socket_path))
+        os.remove(socket_path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        sock.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    os.chmod(socket_path, 0o600)
+    sock.listen(128)
+    return sock
+
+def serve(socket_path=None, workers=1, warmup=True):
+    """
+    Run the server (until interrupted) with `workers` processes accepting jobs on socket_path.
+    Workers that die (e.g., a segfault inside ROOT) are replaced.
+    """
+    if socket_path is None: socket_path = default_socket_path()
+    ctx = batch.get_context()
+    if ctx.get_start_method() != "fork":
+        raise RuntimeError("the server needs to fork its workers")
+    sock = bind_socket(socket_path)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+
+    procs = []
+    def spawn():
+        proc = ctx.Process(target=worker_loop, args=(sock,))
+        proc.daemon = True
+        proc.start()
+        procs.append(proc)
+
+    try:
+        t0 = time.time()
+        lazyroot.load()
+        if warmup: warm_up()
+        for _ in range(workers): spawn()
+        print(">>> Serving on {} with {} workers (ready in {:.1f}s)".format(socket_path, workers, time.time()-t0))
+        sys.stdout.flush()
+        while True:
+            for sentinel in wait([proc.sentinel for proc in procs]):
+                proc = [p for p in procs if p.sentinel == sentinel][0]
+                proc.join()
+                print(">>> Worker {} exited with code {}, starting a new one".format(proc.pid, proc.exitcode))
+                procs.remove(proc)
+                spawn()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.join()
+        sock.close()
+        if os.path.exists(socket_path): os.remove(socket_path)
+        print(">>> Stopped serving on {}".format(socket_path))
+
+def to_arrays(obj):
+    """
+    Replace histograms (also inside lists, tuples and dicts) with ArrayHists,
+    and Options with their dict, so that they can be sent to the server
+    """
+    if isinstance(obj, batch.FileRef):
+        # absolute, since the worker looks up the files it already opened by name
+        return obj._replace(fname=os.path.abspath(obj.fname))
+    if isinstance(obj, batch.SumRef):
+        return obj._replace(refs=to_arrays(obj.refs))
+    if hasattr(obj, "InheritsFrom") and obj.InheritsFrom("TH1"):
+        return ArrayHist.from_root(obj)
+    if hasattr(obj, "resolved") and hasattr(obj, "options"):
+        return dict(obj.options)
+    if isinstance(obj, list):
+        return [to_arrays(x) for x in obj]
+    if isinstance(obj, tuple):
+        return tuple(to_arrays(x) for x in obj)
+    if isinstance(obj, dict):
+        return dict((k, to_arrays(v)) for k,v in obj.items())
+    return obj
+
+def connect(socket_path=None):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path or default_socket_path())
+    return sock
+
+def is_running(socket_path=None):
+    try:
+        sock = connect(socket_path)
+    except (IOError, OSError) as e:
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED): return False
+        raise
+    try:
+        send_msg(sock, {"kind": "ping"})
+        return recv_msg(sock) is not None
+    finally:
+        sock.close()
+
+class Client(object):
+    """
+    One connection to the server, used for every job submitted through it, so that the
+    worker serving it opens the files of FileRefs only once (files rewritten in the meantime
+    need a new Client). The connection is made on the first job, and made again after an error.
+        with serve.Client() as client:
+            for var in variables:
+                client.plot_hist(bgs=[batch.FileRef("hists.root", var)], options={"output_name": var+".pdf"})
+    """
+
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path
+        self.sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def submit(self, kind, args=(), kwargs={}):
+        """
+        Send one job (see batch) to the server, and return its result.
+        Raises RuntimeError if the plot function failed.
+        """
+        job = {"kind": kind, "args": to_arrays(list(args)), "kwargs": to_arrays(kwargs), "cwd": os.getcwd()}
+        if self.sock is None:
+            self.sock = connect(self.socket_path)
+        try:
+            send_msg(self.sock, job)
+            result = recv_msg(self.sock)
+        except Exception:
+            # the connection is in an unknown state, so start over with the next job
+            self.close()
+            raise
+        if result is None:
+            self.close()
+            raise RuntimeError("the server closed the connection while rendering (did the worker crash?)")
+        if result["status"] != "ok":
+            raise RuntimeError(result["error"])
+        return result
+
+    def plot_hist(self,data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],syst=None,options={},marker_shapes = []):
+        return self.submit("hist", kwargs=dict(data=data, bgs=bgs, legend_labels=legend_labels, colors=colors, sigs=sigs,
+            sig_labels=sig_labels, syst=syst, options=options, marker_shapes=marker_shapes))
+
+    def plot_graph(self,valpairs,colors=[],legend_labels=[],draw_styles=[],options={}):
+        return self.submit("graph", kwargs=dict(valpairs=valpairs, colors=colors, legend_labels=legend_labels,
+            draw_styles=draw_styles, options=options))
+
+    def plot_hist_2d(self,hist,options={}):
+        return self.submit("hist_2d", kwargs=dict(hist=hist, options=options))
+
+# socket path -> Client used by the module-level functions
+default_clients = {}
+
+def get_client(socket_path=None):
+    socket_path = socket_path or default_socket_path()
+    if socket_path not in default_clients:
+        default_clients[socket_path] = Client(socket_path)
+    return default_clients[socket_path]
+
+def close():
+    """
+    Close the connections of the module-level functions (e.g., to free their workers for other clients)
+    """
+    for client in default_clients.values():
+        client.close()
+
+def submit(kind, args=(), kwargs={}, socket_path=None):
+    return get_client(socket_path).submit(kind, args=args, kwargs=kwargs)
+
+def plot_hist(data=None,bgs=[],legend_labels=[],colors=[],sigs=[],sig_labels=[],syst=None,options={},marker_shapes = [],socket_path=None):
+    return get_client(socket_path).plot_hist(data=data, bgs=bgs, legend_labels=legend_labels, colors=colors, sigs=sigs,
+        sig_labels=sig_labels, syst=syst, options=options, marker_shapes=marker_shapes)
+
+def plot_graph(valpairs,colors=[],legend_labels=[],draw_styles=[],options={},socket_path=None):
+    return get_client(socket_path).plot_graph(valpairs, colors=colors, legend_labels=legend_labels,
+        draw_styles=draw_styles, options=options)
+
+def plot_hist_2d(hist,options={},socket_path=None):
+    return get_client(socket_path).plot_hist_2d(hist, options=options)
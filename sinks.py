@@ -0,0 +1,224 @@
+# coding: utf-8
+"""
+Output sinks, which collect the plots made inside a `with` block instead of
+letting each plot function write its own files (see save() in plottery.py), e.g.,
+    with ply.booklet("all_plots.pdf", toc=True):
+        for var in variables:
+            ply.plot_hist(bgs=..., options={"output_name": var})
+makes a single multi-page PDF with one page per plot, and ply.web_bundle(...) collects
+JSROOT canvases for a web page (see WebBundle). The innermost sink gets the plots.
+"""
+import os
+import json
+import gzip
+import struct
+
+import numpy as np
+
+from . import utils
+from .lazyroot import r
+
+active_sinks = []
+
+def current_sink():
+    return active_sinks[-1] if active_sinks else None
+
+class Sink(object):
+    """
+    Base class for sinks: add(c1, opts) is called for each plot made inside the block
+    """
+
+    def __enter__(self):
+        active_sinks.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        active_sinks.remove(self)
+        self.close()
+        return False
+
+    def add(self, c1, opts):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+def page_name(opts):
+    """
+    Name of a plot in a sink: its first output name without the directory and extension
+    """
+    return os.path.splitext(os.path.basename(utils.get_output_names(opts)[0]))[0]
+
+class Booklet(Sink):
+    """
+    Multi-page PDF, using the "name.pdf[", "name.pdf", "name.pdf]" protocol of TPad::Print.
+    Pages get a PDF outline entry with the name of the plot, and if toc is True (or
+    a file name), a json table of contents (`pages`: page numbers, names and output names)
+    is written next to the booklet (or to toc) when it's closed.
+    """
+
+    def __init__(self, fname, toc=None):
+        self.fname = fname
+        self.toc = "{}_toc.json".format(os.path.splitext(fname)[0]) if toc is True else toc
+        self.pages = []
+        self.is_open = False
+
+    def add(self, c1, opts):
+        if not self.is_open:
+            dirname = os.path.dirname(self.fname)
+            if dirname: os.makedirs(dirname, exist_ok=True)
+            c1.Print(self.fname+"[")
+            self.is_open = True
+        name = page_name(opts)
+        c1.Print(self.fname, "Title:{}".format(name))
+        self.pages.append({"page": len(self.pages)+1, "name": name, "output_name": opts["output_name"]})
+
+    def close(self):
+        if not self.is_open: return
+        # closing the file doesn't draw anything, so any canvas will do
+        c1 = r.TCanvas("booklet_close", "booklet_close")
+        c1.Print(self.fname+"]")
+        c1.Close()
+        self.is_open = False
+        print(">>> Saved {} pages to {}".format(len(self.pages), self.fname))
+        if self.toc:
+            with open(self.toc, "w") as fh:
+                json.dump({"booklet": self.fname, "pages": self.pages}, fh, indent=1)
+
+def is_scalar(val):
+    return val is None or isinstance(val, (bool, int, float, str))
+
+def is_number_list(val):
+    return all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in val)
+
+class WebBundle(Sink):
+    """
+    Many JSROOT canvases in one directory, for a web page that only fetches the plots it shows:
+      * plots.pack: concatenated gzip members, one per plot, plus one with the shared definitions
+      * index.json: {"pack", "shared": {"offset", "length"}, "plots": {name: {"offset", "length"}}},
+        so a browser can get any member with a Range request (and gunzip it with DecompressionStream)
+    A plot member holds a little-endian uint32 N, N bytes of json, and then the arrays (aligned to 8 bytes)
+    described by json["arrays"] as {"offset", "length", "dtype"} relative to the end of the json padding.
+    json["canvas"] is the TBufferJSON of the canvas, where every object with a _typename only keeps
+    the members that differ from the template of its class ({"$tmpl": typename}, plus "$del": [missing members]),
+    and number lists of at least min_array_size are replaced by {"$typed": index into arrays}.
+    Lists of integers are stored as int32 (or int64 if they don't fit), and other lists as float64,
+    or as `dtype` if given: e.g. dtype="float32" halves their size, but loses precision (bin edges
+    like 0.1 come back as 0.10000000149). The templates (json {typename: {"keys": all members in order,
+    "values": scalar members}}) are the shared member, built from the first object of each class.
+    load_json() undoes all of this (giving back the same values, unless dtype is less precise than float64).
+    """
+
+    def __init__(self, dirname, dtype=None, min_array_size=8):
+        self.dirname = dirname
+        self.dtype = np.dtype(dtype).newbyteorder("<") if dtype else np.dtype("<f8")
+        self.min_array_size = min_array_size
+        self.templates = {}
+        self.plots = {}
+        self.pack = None
+
+    def to_array(self, vals):
+        if all(isinstance(x, int) for x in vals):
+            for dtype in ("<i4", "<i8"):
+                info = np.iinfo(dtype)
+                if info.min <= min(vals) and max(vals) <= info.max:
+                    return np.asarray(vals, dtype=dtype)
+        return np.asarray(vals, dtype=self.dtype)
+
+    def encode(self, obj, arrays):
+        if isinstance(obj, list):
+            if len(obj) >= self.min_array_size and is_number_list(obj):
+                arrays.append(self.to_array(obj))
+                return {"$typed": len(arrays)-1}
+            return [self.encode(x, arrays) for x in obj]
+        if not isinstance(obj, dict):
+            return obj
+        typename = obj.get("_typename")
+        if not isinstance(typename, str):
+            return dict((k, self.encode(v, arrays)) for k,v in obj.items())
+        if typename not in self.templates:
+            self.templates[typename] = {
+                    "keys": list(obj.keys()),
+                    "values": dict((k,v) for k,v in obj.items() if is_scalar(v)),
+                    }
+        defaults = self.templates[typename]["values"]
+        out = {"$tmpl": typename}
+        for key, val in obj.items():
+            if key in defaults and type(defaults[key]) is type(val) and defaults[key] == val: continue
+            out[key] = self.encode(val, arrays)
+        missing = [key for key in self.templates[typename]["keys"] if key not in obj]
+        if missing: out["$del"] = missing
+        return out
+
+    def write_member(self, payload):
+        offset = self.pack.tell()
+        self.pack.write(gzip.compress(payload, mtime=0))
+        return {"offset": offset, "length": self.pack.tell()-offset}
+
+    def add(self, c1, opts):
+        if self.pack is None:
+            os.makedirs(self.dirname, exist_ok=True)
+            self.pack = open(os.path.join(self.dirname, "plots.pack"), "wb")
+        name = os.path.splitext(utils.get_output_names(opts)[0])[0]
+        if name in self.plots:
+            name = "{}_{}".format(name, len(self.plots))
+        arrays = []
+        canvas = self.encode(json.loads(str(r.TBufferJSON.ConvertToJSON(c1))), arrays)
+        descriptors, offset = [], 0
+        for arr in arrays:
+            descriptors.append({"offset": offset, "length": len(arr), "dtype": arr.dtype.str})
+            offset += -(-arr.nbytes//8)*8
+        header = json.dumps({"canvas": canvas, "arrays": descriptors}, separators=(",",":")).encode()
+        chunks = [struct.pack("<I", len(header)), header, b"\0"*(-(4+len(header)) % 8)]
+        for arr in arrays:
+            chunks += [arr.tobytes(), b"\0"*(-arr.nbytes % 8)]
+        self.plots[name] = self.write_member(b"".join(chunks))
+
+    def close(self):
+        if self.pack is None: return
+        shared = self.write_member(json.dumps(self.templates, separators=(",",":")).encode())
+        self.pack.close()
+        self.pack = None
+        with open(os.path.join(self.dirname, "index.json"), "w") as fh:
+            json.dump({"pack": "plots.pack", "shared": shared, "plots": self.plots}, fh, indent=1, sort_keys=True)
+        print(">>> Saved {} plots to {}".format(len(self.plots), self.dirname))
+
+def decode(obj, arrays, templates):
+    if isinstance(obj, list):
+        return [decode(x, arrays, templates) for x in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if "$typed" in obj:
+        # integer arrays give back python ints, so e.g. 16777217 stays 16777217
+        return arrays[obj["$typed"]].tolist()
+    if "$tmpl" not in obj:
+        return dict((k, decode(v, arrays, templates)) for k,v in obj.items())
+    template = templates[obj["$tmpl"]]
+    missing = set(obj.get("$del", []))
+    out = {}
+    for key in template["keys"]:
+        if key in missing: continue
+        out[key] = decode(obj[key], arrays, templates) if key in obj else template["values"][key]
+    for key, val in obj.items():
+        if key not in out and key not in ("$tmpl", "$del"):
+            out[key] = decode(val, arrays, templates)
+    return out
+
+def load_json(dirname, name):
+    """
+    The JSROOT json of the canvas `name` in the web bundle in dirname (see WebBundle)
+    """
+    with open(os.path.join(dirname, "index.json")) as fh:
+        index = json.load(fh)
+    with open(os.path.join(dirname, index["pack"]), "rb") as fh:
+        def read_member(entry):
+            fh.seek(entry["offset"])
+            return gzip.decompress(fh.read(entry["length"]))
+        templates = json.loads(read_member(index["shared"]).decode())
+        payload = read_member(index["plots"][name])
+    size, = struct.unpack("<I", payload[:4])
+    header = json.loads(payload[4:4+size].decode())
+    start = 4 + size + (-(4+size) % 8)
+    arrays = [np.frombuffer(payload, dtype=desc["dtype"], count=desc["length"], offset=start+desc["offset"])
+            for desc in header["arrays"]]
+    return json.dumps(decode(header["canvas"], arrays, templates))
@@ -0,0 +1,225 @@
+# coding: utf-8
+"""
+numpy versions of the statistics that plottery used to compute bin by bin
+through ROOT (TH1::Divide, RooStats::NumberCountingUtils::BinomialObsZ,
+TMath::Prob). They work on whole arrays of bin contents and errors at once,
+and give the same numbers as the ROOT functions.
+"""
+import math
+import numpy as np
+
+def lgamma(x):
+    return np.vectorize(math.lgamma, otypes=[np.double])(x)
+
+def normal_quantile(p):
+    """
+    Inverse of the standard normal CDF (algorithm AS241 of Wichura, good to ~1e-16)
+    """
+    p = np.asarray(p, dtype=np.double)
+    q = p - 0.5
+    out = np.empty_like(q)
+
+    central = np.abs(q) <= 0.425
+    qc = q[central]
+    rc = 0.180625 - qc*qc
+    out[central] = qc * (((((((2509.0809287301226727*rc + 33430.575583588128105)*rc + 67265.770927008700853)*rc
+                    + 45921.953931549871457)*rc + 13731.693765509461125)*rc + 1971.5909503065514427)*rc + 133.14166789178437745)*rc
+                    + 3.387132872796366608) / (((((((5226.495278852545925*rc + 28729.085735721942674)*rc + 39307.89580009271061)*rc
+                    + 21213.794301586595867)*rc + 5394.1960214247511077)*rc + 687.1870074920579083)*rc + 42.313330701600911252)*rc + 1.)
+
+    tail = ~central
+    pt = np.where(q[tail] < 0, p[tail], 1.-p[tail])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rt = np.sqrt(-np.log(pt))
+        near = rt <= 5.
+        rn = rt - 1.6
+        rf = rt - 5.
+        val_near = (((((((7.7454501427834140764e-4*rn + 0.0227238449892691845833)*rn + 0.24178072517745061177)*rn
+                    + 1.27045825245236838258)*rn + 3.64784832476320460504)*rn + 5.7694972214606914055)*rn + 4.6303378461565452959)*rn
+                    + 1.42343711074968357734) / (((((((1.05075007164441684324e-9*rn + 5.475938084995344946e-4)*rn + 0.0151986665636164571966)*rn
+                    + 0.14810397642748007459)*rn + 0.68976733498510000455)*rn + 1.6763848301838038494)*rn + 2.05319162663775882187)*rn + 1.)
+        val_far = (((((((2.01033439929228813265e-7*rf + 2.71155556874348757815e-5)*rf + 0.0012426609473880784386)*rf
+                    + 0.026532189526576123093)*rf + 0.29656057182850489123)*rf + 1.7848265399172913358)*rf + 5.4637849111641143699)*rf
+                    + 6.6579046435011037772) / (((((((2.04426310338993978564e-15*rf + 1.4215117583164458887e-7)*rf + 1.8463183175100546818e-5)*rf
+                    + 7.868691311456132591e-4)*rf + 0.0148753612908506148525)*rf + 0.13692988092273580531)*rf + 0.59983220655588793769)*rf + 1.)
+    val = np.where(near, val_near, val_far)
+    val = np.where(pt > 0., val, np.inf)
+    out[tail] = np.where(q[tail] < 0, -val, val)
+    return out
+
+def normal_quantile_c(p):
+    """
+    Inverse of the standard normal survival function, i.e., the significance of a p-value
+    """
+    return -normal_quantile(p)
+
+def betainc(a, b, x, maxiter=500, eps=1e-15):
+    """
+    Regularized incomplete beta function I_x(a,b) (like TMath::BetaIncomplete(x,a,b)),
+    evaluated with the continued fraction from Numerical Recipes
+    """
+    a, b, x = np.broadcast_arrays(*[np.asarray(v, dtype=np.double) for v in (a, b, x)])
+    out = np.where(x <= 0., 0., 1.)
+    inside = (x > 0.) & (x < 1.)
+    if not inside.any():
+        return out
+    a, b, x = a[inside], b[inside], x[inside]
+
+    # the continued fraction converges quickly for x < (a+1)/(a+b+2), otherwise use the symmetry relation
+    swap = x > (a+1.)/(a+b+2.)
+    a, b, x = np.where(swap, b, a), np.where(swap, a, b), np.where(swap, 1.-x, x)
+
+    tiny = 1e-300
+    qab, qap, qam = a+b, a+1., a-1.
+    c = np.ones_like(x)
+    d = 1. - qab*x/qap
+    d = 1./np.where(np.abs(d) < tiny, tiny, d)
+    h = d.copy()
+    done = np.zeros(x.shape, dtype=bool)
+    for m in range(1, maxiter+1):
+        m2 = 2*m
+        for aa in (m*(b-m)*x/((qam+m2)*(a+m2)), -(a+m)*(qab+m)*x/((a+m2)*(qap+m2))):
+            d = 1. + aa*d
+            d = 1./np.where(np.abs(d) < tiny, tiny, d)
+            c = 1. + aa/c
+            c = np.where(np.abs(c) < tiny, tiny, c)
+            delta = np.where(done, 1., d*c)
+            h *= delta
+        done |= np.abs(delta-1.) < eps
+        if done.all(): break
+
+    front = np.exp(lgamma(a+b) - lgamma(a) - lgamma(b) + a*np.log(x) + b*np.log1p(-x)) / a
+    vals = front*h
+    out[inside] = np.where(swap, 1.-vals, vals)
+    return out
+
+def gammaincc(a, x, maxiter=500, eps=1e-15):
+    """
+    Regularized upper incomplete gamma function Q(a,x) for scalars
+    """
+    if x <= 0.: return 1.
+    lnfront = -x + a*math.log(x) - math.lgamma(a)
+    if x < a+1.:
+        # series for P(a,x)
+        term = total = 1./a
+        ap = a
+        for _ in range(maxiter):
+            ap += 1.
+            term *= x/ap
+            total += term
+            if abs(term) < abs(total)*eps: break
+        return 1. - total*math.exp(lnfront)
+    # continued fraction for Q(a,x)
+    tiny = 1e-300
+    b = x+1.-a
+    c = 1./tiny
+    d = 1./b
+    h = d
+    for i in range(1, maxiter+1):
+        an = -i*(i-a)
+        b += 2.
+        d = an*d+b
+        if abs(d) < tiny: d = tiny
+        c = b+an/c
+        if abs(c) < tiny: c = tiny
+        d = 1./d
+        delta = d*c
+        h *= delta
+        if abs(delta-1.) < eps: break
+    return math.exp(lnfront)*h
+
+def chi2_prob(chi2, ndof):
+    """
+    Probability of getting a chi2 at least this large (like TMath::Prob)
+    """
+    if ndof <= 0: return 0.
+    if chi2 <= 0.: return 0. if chi2 < 0. else 1.
+    return gammaincc(0.5*ndof, 0.5*chi2)
+
+def divide(num, num_w2, den, den_w2, binomial=False):
+    """
+    Bin contents and sumw2 of num/den like TH1::Divide (with option "B" if binomial)
+    """
+    num, num_w2, den, den_w2 = [np.asarray(v, dtype=np.double) for v in (num, num_w2, den, den_w2)]
+    nonzero = den != 0.
+    safe_den = np.where(nonzero, den, 1.)
+    vals = np.where(nonzero, num/safe_den, 0.)
+    den2 = safe_den*safe_den
+    if binomial:
+        w2 = np.abs(((1. - 2.*num/safe_den)*num_w2 + num*num*den_w2/den2)/den2)
+        w2 = np.where(num != den, w2, 0.)
+    else:
+        w2 = (num_w2*den2 + den_w2*num*num)/(den2*den2)
+    return vals, np.where(nonzero, w2, 0.)
+
+def binomial_obs_z(nobs, bexp, frac_berr):
+    """
+    Significance of observing nobs given bexp with a fractional uncertainty
+    (like RooStats::NumberCountingUtils::BinomialObsZ)
+    """
+    nobs, bexp, frac_berr = [np.asarray(v, dtype=np.double) for v in (nobs, bexp, frac_berr)]
+    with np.errstate(divide="ignore"):
+        tau = 1./bexp/(frac_berr*frac_berr)
+    pval = betainc(nobs, bexp*tau+1., 1./(1.+tau))
+    with np.errstate(divide="ignore"):
+        return normal_quantile_c(pval)
+
+def pulls(numer, numer_err, denom, denom_err):
+    """
+    Pull of numer with respect to denom in each bin. The binomial-observed Z
+    is used where numer is nonzero, and a gaussian pull where it's not (where
+    the former would be infinite). Bins without any error get a pull of 0.
+    """
+    numer, numer_err, denom, denom_err = [np.asarray(v, dtype=np.double) for v in (numer, numer_err, denom, denom_err)]
+    err = np.sqrt(numer_err**2. + denom_err**2.)
+    ratio = np.where(denom != 0., numer/np.where(denom != 0., denom, 1.), 0.)
+    out = np.where(err > 0., (ratio-1.)/np.where(err > 0., err, 1.), 0.)
+    binomial = (numer > 1e-6) & (denom > 0.)
+    if binomial.any():
+        out[binomial] = binomial_obs_z(numer[binomial], denom[binomial], denom_err[binomial]/denom[binomial])
+    return out
+
+def ratio_chi2(vals, errs, syst_errs=None):
+    """
+    Return chi2 and number of bins for the compatibility of ratio values with 1,
+    skipping bins without (statistical) error
+    """
+    vals, errs = np.asarray(vals, dtype=np.double), np.asarray(errs, dtype=np.double)
+    err2 = errs**2.
+    use = err2 >= 1.e-6
+    if syst_errs is not None:
+        err2 = err2 + np.asarray(syst_errs, dtype=np.double)**2.
+    chi2 = ((vals[use]-1.)**2./err2[use]).sum()
+    return float(chi2), int(use.sum())
+
+def weighted_mean_sigma(vals, errs, exact=False):
+    """
+    Return mean and sigma of vals weighted by 1/errs (bins with no error are skipped,
+    unless none of them has an error, in which case all get the same weight).
+    This gives the same numbers as filling a TH1D spanning [min(vals),max(vals)] and
+    taking GetMean/GetRMS, which leaves out the values at the maximum (they land in
+    the overflow); exact=True keeps them.
+    """
+    vals, errs = np.asarray(vals, dtype=np.double), np.asarray(errs, dtype=np.double)
+    if not len(vals): return 0., 0.
+    if errs.sum() < 1e-6: errs = 1.+errs
+    use = errs >= 1.e-6
+    vmax = vals.max()
+    if not exact and vals.min() < vmax:
+        use &= vals < vmax
+    weights = 1./errs[use]
+    sumw = weights.sum()
+    if sumw == 0.: return 0., 0.
+    mean = (weights*vals[use]).sum()/sumw
+    sigma = abs((weights*vals[use]**2.).sum()/sumw - mean**2.)**0.5
+    return float(mean), float(sigma)
+
+def robust_range(vals, mean, sigma, nsigma=3.):
+    """
+    Return (low, high) covering mean +- nsigma*sigma, but not going beyond the
+    extreme values, with a little padding
+    """
+    vals = np.asarray(vals)
+    low = max(mean-nsigma*sigma, float(vals.min()))-sigma/1e3
+    high = min(mean+nsigma*sigma, float(vals.max()))+sigma/1e3
+    return low, high
@@ -1,37 +1,192 @@
-import ROOT as r
 import os
 import math
 import random
+import time
+import functools
+import threading
+import queue
 from array import array
+from . import stats
+from .lazyroot import r
 
-class MyArc(r.TLine):
-
-    def __init__(self, xc, yc, radius, phimin=180, phimax=360, ninterp=6):
-        self.xc = xc
-        self.yc = yc
-        self.radius = radius
-        self.phimin = phimin
-        self.phimax = phimax
-        self.ninterp = ninterp
-        super(MyArc, self).__init__()
-
-    def Draw(self, opt=""):
-        xc, yc, radius, phimin, phimax = self.xc, self.yc, self.radius, self.phimin, self.phimax
-        ninterp = self.ninterp
-        dphi = 1.0*(phimax-phimin)/ninterp
-        phis = [phimin + dphi*i for i in range(ninterp+1)]
-        coords = []
-        conv = math.pi/180.
-        for iphi,phi in enumerate(phis):
-            x = xc + radius*math.cos(phi*conv)
-            y = yc + radius*math.sin(phi*conv)
-            coords.append([x,y])
-        for (x1,y1),(x2,y2) in zip(coords[:-1],coords[1:]):
-            self.DrawLineNDC(x1,y1,x2,y2)
-
-def set_style():
-
-    tdr_style = r.TStyle("tdr_style","Style for P-TDR")
+arc_class = None
+
+def get_arc_class():
+    """
+    The class behind MyArc, which derives from TLine, so
+    it can only be defined once ROOT is imported
+    """
+    global arc_class
+    if arc_class is None:
+        class Arc(r.TLine):
+
+            def __init__(self, xc, yc, radius, phimin=180, phimax=360, ninterp=6):
+                self.xc = xc
+                self.yc = yc
+                self.radius = radius
+                self.phimin = phimin
+                self.phimax = phimax
+                self.ninterp = ninterp
+                super(Arc, self).__init__()
+
+            def Draw(self, opt=""):
+                xc, yc, radius, phimin, phimax = self.xc, self.yc, self.radius, self.phimin, self.phimax
+                ninterp = self.ninterp
+                dphi = 1.0*(phimax-phimin)/ninterp
+                phis = [phimin + dphi*i for i in range(ninterp+1)]
+                coords = []
+                conv = math.pi/180.
+                for iphi,phi in enumerate(phis):
+                    x = xc + radius*math.cos(phi*conv)
+                    y = yc + radius*math.sin(phi*conv)
+                    coords.append([x,y])
+                for (x1,y1),(x2,y2) in zip(coords[:-1],coords[1:]):
+                    self.DrawLineNDC(x1,y1,x2,y2)
+        arc_class = Arc
+    return arc_class
+
+def MyArc(*args, **kwargs):
+    return get_arc_class()(*args, **kwargs)
+
+class PlotScope(object):
+    """
+    Owns the ROOT objects (canvases, pads, TLatex, ...) that have to stay
+    alive while a plot is drawn and saved. They are registered with `persist`
+    and deleted when the scope exits, instead of piling up forever. With
+    keep=True, they are handed over to the enclosing scope, or to
+    `session_scope` if there is none, e.g. to play with the canvas interactively.
+    >>> with utils.PlotScope():
+    >>>     c1 = ply.plot_hist(...)
+    """
+
+    def __init__(self, keep=False):
+        self.keep = keep
+        self.objects = []
+
+    def __enter__(self):
+        scope_stack.append(self)
+        return self
+
+    def __exit__(self, *args):
+        scope_stack.remove(self)
+        if self.keep:
+            persist(*self.objects)
+            self.objects = []
+        else:
+            self.release()
+        return False
+
+    def release(self):
+        """
+        Delete the owned objects, newest first, closing canvases
+        """
+        while self.objects:
+            obj = self.objects.pop()
+            if hasattr(obj, "InheritsFrom") and obj.InheritsFrom("TCanvas"):
+                obj.Close()
+            del obj
+
+scope_stack = []
+# owns whatever is persisted outside of any PlotScope; call session_scope.release() to free it
+session_scope = PlotScope(keep=True)
+
+def current_scope():
+    return scope_stack[-1] if scope_stack else session_scope
+
+def persist(*objs):
+    """
+    Keep ROOT objects alive until the current PlotScope exits
+    (need this to avoid segfaults with garbage collection)
+    """
+    current_scope().objects.extend(objs)
+    return objs[0] if len(objs) == 1 else objs
+
+def plot_scope(func):
+    """
+    Decorator running a plot function inside its own PlotScope.
+    The function can set current_scope().keep to keep its objects.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with PlotScope():
+            return func(*args, **kwargs)
+    return wrapper
+
+# functions called as hook(func_name, stage, wall, cpu) at the end of every stage of a plot function
+stage_hooks = []
+
+class StageTimer(object):
+    """
+    Records the wall and CPU time of consecutive named stages of a plot function.
+    Call lap(name) at the end of each stage.
+    """
+    def __init__(self, func_name):
+        self.func_name = func_name
+        self.timings = {}
+        self.last = (time.perf_counter(), time.process_time())
+
+    def lap(self, name):
+        now = (time.perf_counter(), time.process_time())
+        wall, cpu = now[0]-self.last[0], now[1]-self.last[1]
+        # a stage can appear more than once
+        timing = self.timings.setdefault(name, {"wall": 0., "cpu": 0.})
+        timing["wall"] += wall
+        timing["cpu"] += cpu
+        for hook in stage_hooks:
+            hook(self.func_name, name, wall, cpu)
+        self.last = (time.perf_counter(), time.process_time())
+
+class NullTimer(object):
+    timings = None
+    def lap(self, name):
+        pass
+
+null_timer = NullTimer()
+
+def get_stage_timer(func_name, enabled=False):
+    """
+    A StageTimer if enabled (or if there are stage_hooks), otherwise a timer that does nothing
+    """
+    if enabled or stage_hooks:
+        return StageTimer(func_name)
+    return null_timer
+
+def aggregate_timings(timings_list, key="wall", bins=None):
+    """
+    Combine the timings of many plots (dicts like StageTimer.timings) into a dict
+    with, for each stage, the number of plots, total, mean and 50/90/99th percentiles of
+    `key` ("wall" or "cpu"), and a histogram of its values (counts, bin edges in seconds;
+    by default log-spaced from 10us to 100s)
+    """
+    import numpy as np
+    if bins is None: bins = np.logspace(-5, 2, 29)
+    values = {}
+    for timings in timings_list:
+        if not timings: continue
+        for stage, timing in timings.items():
+            values.setdefault(stage, []).append(timing[key])
+    summary = {}
+    for stage, vals in values.items():
+        vals = np.array(vals)
+        counts, edges = np.histogram(vals, bins=bins)
+        summary[stage] = {
+                "n": len(vals),
+                "total": float(vals.sum()),
+                "mean": float(vals.mean()),
+                "p50": float(np.percentile(vals, 50)),
+                "p90": float(np.percentile(vals, 90)),
+                "p99": float(np.percentile(vals, 99)),
+                "hist": (counts.tolist(), edges.tolist()),
+                }
+    return summary
+
+# TStyles are built once and then reused by get_style
+style_cache = {}
+palette_cache = {}
+
+def build_tdr_style(name="tdr_style"):
+
+    tdr_style = r.TStyle(name,"Style for P-TDR")
 
     #  For the canvas:
     tdr_style.SetCanvasBorderMode(0)
@@ -108,9 +263,6 @@ def set_style():
     tdr_style.SetTitleBorderSize(0)
     tdr_style.SetTitleFillColor(0)
 
-    r.TGaxis.SetExponentOffset(-0.06, 0, "y")
-    r.TGaxis.SetExponentOffset(-0.86, -0.08, "x")
-
     # For the axis titles:
     tdr_style.SetTitleColor(1, "XYZ")
     tdr_style.SetTitleFont(42, "XYZ")
@@ -139,20 +291,60 @@ def set_style():
 
     # Postscript options:
     tdr_style.SetPaperSize(20.,20.)
-    tdr_style.cd()
 
     return tdr_style
 
-def set_style_2d():
-    style = set_style()
+def build_tdr_style_2d(name="tdr_style_2d"):
+    style = build_tdr_style(name)
     style.SetPadBottomMargin(0.12)
     style.SetPadRightMargin(0.12)
     style.SetPadLeftMargin(0.10)
     style.SetTitleAlign(23)
-    style.cd()
 
     return style
 
+style_builders = {
+        "tdr_style": build_tdr_style,
+        "tdr_style_2d": build_tdr_style_2d,
+        }
+
+def get_style(name, overrides={}):
+    """
+    Return the TStyle `name` (a key of `style_builders`) after making it the current style.
+    It's only built the first time it's requested. `overrides` maps TStyle setters to
+    argument tuples (e.g., {"SetPaintTextFormat": (".1f",)}), and each distinct set of
+    overrides is cached as a separate style.
+    """
+    key = (name,) + tuple(sorted(overrides.items()))
+    style = style_cache.get(key)
+    if style is None:
+        stylename = "{}_{}".format(name, len(style_cache)) if overrides else name
+        style = style_builders[name](stylename)
+        for setter, args in sorted(overrides.items()):
+            getattr(style, setter)(*args)
+        style_cache[key] = style
+
+    # these are static TGaxis settings rather than part of the style,
+    # and handle_axes can change them, so reset them for every plot
+    r.TGaxis.SetExponentOffset(-0.06, 0, "y")
+    r.TGaxis.SetExponentOffset(-0.86, -0.08, "x")
+
+    style.cd()
+    return style
+
+def reset_style_cache():
+    """
+    Forget all cached styles and palettes, so they get rebuilt for the next plot
+    """
+    style_cache.clear()
+    palette_cache.clear()
+
+def set_style(overrides={}):
+    return get_style("tdr_style", overrides)
+
+def set_style_2d(overrides={}):
+    return get_style("tdr_style_2d", overrides)
+
 def set_palette(style, palette):
     if palette == "default":
         style.SetPalette(r.kBird) # default
@@ -168,8 +360,13 @@ def set_palette(style, palette):
         red   = array('d', [0.50, 0.50, 1.00, 1.00, 1.00])
         green = array('d', [0.50, 1.00, 1.00, 0.60, 0.50])
         blue  = array('d', [1.00, 1.00, 0.50, 0.40, 0.50])
-        r.TColor.CreateGradientColorTable(len(stops), stops, red, green, blue, 255)
-        # print get_luminosities(len(stops), stops, red, green, blue, 255)
+        if palette not in palette_cache:
+            # creating the gradient allocates 255 new TColors, so only do it once
+            r.TColor.CreateGradientColorTable(len(stops), stops, red, green, blue, 255)
+            # print get_luminosities(len(stops), stops, red, green, blue, 255)
+            palette_cache[palette] = array('i', [r.gStyle.GetColorPalette(i) for i in range(r.gStyle.GetNumberOfColors())])
+        else:
+            style.SetPalette(len(palette_cache[palette]), palette_cache[palette])
         style.SetNumberContours(255)
 
 def get_brightdefault_colors():
@@ -270,14 +467,66 @@ def get_legend_marker_info(legend):
 
     return { "coords": coordsNDC, "label_height": label_height, "box_width": boxw, "draw_vertical": draw_vertical }
 
-def get_stack_maximum(data, stack, opts={}):
+class StackModel(object):
+    """
+    Bin contents and sumw2 of a list of backgrounds (arrays of shape (nbgs, nbins+2),
+    including under/overflow bins), with their running sums, total and integrals,
+    computed once so that everything drawing a stack can share them
+    """
+    def __init__(self, bgs):
+        import numpy as np
+        self.bgs = list(bgs)
+        vals, sumw2s = [], []
+        for bg in self.bgs:
+            contents, sumw2 = hist_arrays(bg)
+            vals.append(contents)
+            sumw2s.append(sumw2 if sumw2 is not None else np.abs(contents))
+        nbins = self.bgs[0].GetNbinsX()+2 if self.bgs else 0
+        self.vals = np.array(vals, dtype=np.double).reshape(len(self.bgs), nbins)
+        self.sumw2 = np.array(sumw2s, dtype=np.double).reshape(len(self.bgs), nbins)
+        self.cumulative = self.vals.cumsum(axis=0)
+        self.total = self.vals.sum(axis=0)
+        self.total_sumw2 = self.sumw2.sum(axis=0)
+        # like TH1::Integral(), only visible bins
+        self.integrals = self.vals[:,1:-1].sum(axis=1)
+        self.total_integral = float(self.integrals.sum())
+
+    def errors(self):
+        import numpy as np
+        return np.sqrt(self.sumw2)
+
+    def total_errors(self):
+        import numpy as np
+        return np.sqrt(self.total_sumw2)
+
+    def maximum(self):
+        """
+        Largest visible bin of the total (like THStack::GetMaximum())
+        """
+        return float(self.total[1:-1].max()) if self.total.size > 2 else 0.
+
+    def total_hist(self, name="total"):
+        """
+        A single new histogram (like the first background) holding the total
+        """
+        h = self.bgs[0].Clone(name)
+        h.SetDirectory(0)
+        contents, sumw2 = hist_arrays(h, create_sumw2=True)
+        contents[:] = self.total
+        sumw2[:] = self.total_sumw2
+        h.SetEntries(sum(bg.GetEntries() for bg in self.bgs))
+        sync_hist_stats(h)
+        return h
+
+def get_stack_maximum(data, stack, opts={}, stack_model=None):
     scalefact = 1.05
     if opts["yaxis_range"]:
         return opts["yaxis_range"][1]
+    stack_max = stack_model.maximum() if stack_model is not None else stack.GetMaximum()
     if data:
-        return scalefact*max(data.GetMaximum(),stack.GetMaximum())
+        return scalefact*max(data.GetMaximum(),stack_max)
     else:
-        return scalefact*stack.GetMaximum()
+        return scalefact*stack_max
 
 def compute_darkness(r,g,b):
     """
@@ -285,7 +534,7 @@ def compute_darkness(r,g,b):
     """
     return 1.0 - (0.299*r + 0.587*g + 0.114*b)
 
-def interpolate_colors_rgb(first, second, ndiv, _persist=[]):
+def interpolate_colors_rgb(first, second, ndiv):
     """
     Create ndiv colors that are linearly interpolated between rgb triplets
     first and second
@@ -293,12 +542,14 @@ def interpolate_colors_rgb(first, second, ndiv, _persist=[]):
     colorcodes = []
     for rgb in interpolate_tuples(first,second,ndiv):
         index = r.TColor.GetFreeColorIndex()
-        _persist.append(r.TColor(index, *rgb))
+        color = r.TColor(index, *rgb)
+        # colors are global (referred to by index), so let ROOT's list of colors own them
+        r.SetOwnership(color, False)
         colorcodes.append(index)
     return colorcodes
 
 
-def draw_flag(c1, cx, cy, size, _persist=[]):
+def draw_flag(c1, cx, cy, size):
     """
     Draw US flag
     # NOTE: May cause segfaults when flags are drawn
@@ -314,7 +565,7 @@ def draw_flag(c1, cx, cy, size, _persist=[]):
     fp.SetFillStyle(0);
     fp.Draw();
     fp.cd();
-    _persist.append(fp)
+    persist(fp)
     A = 1.;
     B = 1.9;
     D = 0.76;
@@ -333,13 +584,13 @@ def draw_flag(c1, cx, cy, size, _persist=[]):
         box.SetFillColor(col);
         box.SetLineColor(col);
         box.Draw();
-        _persist.append(box)
+        persist(box)
 
     starbox = r.TBox( 0., 0.5*(1-A/B)+6./13*(A/B), D/B, 1.-0.5*(1-A/B) );
     starbox.SetFillColor(r.kBlue-7);
     starbox.SetLineColor(r.kBlue-7);
     starbox.Draw();
-    _persist.append(starbox)
+    persist(starbox)
 
     row = 0;
     inrow = 0;
@@ -360,7 +611,7 @@ def draw_flag(c1, cx, cy, size, _persist=[]):
         tm.SetMarkerColor(r.kWhite);
         tm.SetMarkerSize(-1.0*starsize); # negative to flip so points upwards
         tm.Draw();
-        _persist.append(tm)
+        persist(tm)
 
         inrow += 1
         if (row%2 == 0):
@@ -377,22 +628,93 @@ def draw_flag(c1, cx, cy, size, _persist=[]):
     lab.SetTextSize(0.1);
     lab.SetTextColor(r.kGray+2);
     lab.Draw();
-    _persist.append(lab)
+    persist(lab)
 
     c1.cd();
 
-def get_mean_sigma_1d_yvals(hist):
+# numpy dtype of the bin contents, given the TArray a histogram class inherits from
+hist_dtypes = [
+        ("TArrayD", "f8"),
+        ("TArrayF", "f4"),
+        ("TArrayI", "i4"),
+        ("TArrayS", "i2"),
+        ("TArrayC", "i1"),
+        ("TArrayL64", "i8"),
+        ]
+
+def buffer_as_array(buf, dtype, size):
+    """
+    View a pointer returned by ROOT (e.g., TArrayD::GetArray()) as a numpy array without copying
+    """
+    import numpy as np
+    # cppyy can't know how long the buffer behind a raw pointer is, so tell it
+    if hasattr(buf, "reshape"): buf.reshape((size,))
+    return np.frombuffer(buf, dtype=dtype, count=size)
+
+def hist_arrays(h, create_sumw2=False):
+    """
+    Return (contents, sumw2) numpy arrays that alias the bin buffers of
+    the TH1/TH2 `h`, so no copies are made, and writing into them writes into
+    the histogram. Under/overflow bins are included: 1D hists give arrays of
+    length nbins+2 indexed by bin number, 2D hists give arrays of shape
+    (nbinsx+2, nbinsy+2) indexed as [ix, iy]. sumw2 is None if `h` doesn't store
+    it, unless create_sumw2 is True. Call `sync_hist_stats(h)` after writing.
+    """
+    for arrname, dtype in hist_dtypes:
+        if h.InheritsFrom(arrname): break
+    else:
+        raise TypeError("Don't know how {} stores its bin contents".format(h.ClassName()))
+    ncells = h.GetNcells()
+    contents = buffer_as_array(h.GetArray(), dtype, ncells)
+    if create_sumw2 and not h.GetSumw2N():
+        h.Sumw2()
+    sumw2 = None
+    if h.GetSumw2N():
+        sumw2 = buffer_as_array(h.GetSumw2().GetArray(), "f8", ncells)
+    if h.GetDimension() == 2:
+        # ROOT's global bin number is ix + (nbinsx+2)*iy
+        shape = (h.GetNbinsY()+2, h.GetNbinsX()+2)
+        contents = contents.reshape(shape).T
+        if sumw2 is not None: sumw2 = sumw2.reshape(shape).T
+    return contents, sumw2
+
+def hist_errors(h):
+    """
+    Return an array of bin errors of `h`, laid out like the arrays from `hist_arrays`
+    """
+    import numpy as np
+    contents, sumw2 = hist_arrays(h)
+    if sumw2 is not None:
+        return np.sqrt(sumw2)
+    return np.sqrt(np.abs(contents))
+
+def sync_hist_stats(h):
+    """
+    After modifying bins through `hist_arrays`, recompute the cached
+    statistics (mean, RMS, ...) of `h` like SetBinContent would, keeping
+    the number of entries
+    """
+    entries = h.GetEntries()
+    h.ResetStats()
+    h.SetEntries(entries)
+
+def axis_edges(axis):
+    """
+    Return the bin edges of a TAxis as a numpy array
+    """
+    import numpy as np
+    nbins = axis.GetNbins()
+    if axis.GetXbins().GetSize():
+        return np.array(buffer_as_array(axis.GetXbins().GetArray(), "f8", nbins+1))
+    return np.linspace(axis.GetXmin(), axis.GetXmax(), nbins+1)
+
+def get_mean_sigma_1d_yvals(hist, exact=False):
     """
     Return mean, sigma, yvals of a 1D hist (by basically "projecting" onto y-axis)
+    See stats.weighted_mean_sigma for the meaning of exact
     """
-    vals = list(hist)[1:-1]
-    errs = [hist.GetBinError(ibin) for ibin in range(hist.GetNbinsX()+1)][1:-1]
-    htmp = r.TH1D("htmp","htmp",150,min(vals),max(vals))
-    if sum(errs) < 1e-6: errs = [1.+err for err in errs]
-    for val,err in zip(vals,errs):
-        if err < 1.e-6: continue
-        htmp.Fill(val,1./err)
-    mean, sigma = htmp.GetMean(), htmp.GetRMS()
+    vals = hist_arrays(hist)[0][1:-1].astype(float)
+    mean, sigma = stats.weighted_mean_sigma(vals, hist_errors(hist)[1:-1], exact=exact)
     return mean, sigma, vals
 
 def move_in_overflows(h):
@@ -402,163 +724,387 @@ def move_in_overflows(h):
     Errors are combined in quadrature
     """
     nbins = h.GetNbinsX()
-    v_under = h[0]
-    v_first = h[1]
-    e_under = h.GetBinError(0)
-    e_first = h.GetBinError(1)
-    v_over = h[nbins+1]
-    v_last = h[nbins]
-    e_over = h.GetBinError(nbins+1)
-    e_last = h.GetBinError(nbins)
 
     # When the bin labels are set the CanExtend messes things up.
     h.SetCanExtend(False)
 
-    # Reset overflows to 0
-    h.SetBinContent(0, 0)
-    h.SetBinContent(nbins+1, 0)
-    h.SetBinError(0, 0)
-    h.SetBinError(nbins+1, 0)
+    # setting errors needs the sumw2 array anyway, and adding the
+    # sumw2 values is the same as combining the errors in quadrature
+    contents, sumw2 = hist_arrays(h, create_sumw2=True)
+    for arr in (contents, sumw2):
+        arr[1] += arr[0]
+        arr[nbins] += arr[nbins+1]
+        arr[0] = 0
+        arr[nbins+1] = 0
+    sync_hist_stats(h)
+
+def as_double_array(vals):
+    """
+    vals as a C-contiguous float64 numpy array, without copying if it already is one
+    """
+    import numpy as np
+    return np.ascontiguousarray(vals, dtype=np.double)
 
-    # Put them into first and last bins
-    h.SetBinContent(1, v_first+v_under)
-    h.SetBinContent(nbins, v_last+v_over)
-    h.SetBinError(1, (e_first**2.+e_under**2.)**0.5)
-    h.SetBinError(nbins, (e_last**2.+e_over**2.)**0.5)
+def lttb_indices(xs, ys, npoints):
+    """
+    Indices of npoints points chosen by the largest-triangle-three-buckets algorithm:
+    the series is split into buckets of consecutive points, and from each, the point
+    making the largest triangle with the previously chosen point and the average of
+    the next bucket is kept (as well as the first and last points)
+    """
+    import numpy as np
+    ntot = len(xs)
+    if npoints >= ntot or npoints < 3:
+        return np.arange(ntot)
+    edges = np.linspace(1, ntot-1, npoints-1).astype(int)
+    indices = np.empty(npoints, dtype=int)
+    indices[0], indices[-1] = 0, ntot-1
+    ia = 0
+    for ibucket in range(npoints-2):
+        lo, hi = edges[ibucket], edges[ibucket+1]
+        nhi = edges[ibucket+2] if ibucket+2 < len(edges) else ntot
+        avgx, avgy = xs[hi:nhi].mean(), ys[hi:nhi].mean()
+        areas = np.abs((xs[ia]-avgx)*(ys[lo:hi]-ys[ia]) - (xs[ia]-xs[lo:hi])*(avgy-ys[ia]))
+        ia = lo + int(areas.argmax())
+        indices[ibucket+1] = ia
+    return indices
+
+def minmax_indices(xs, ys, npoints):
+    """
+    Indices of about npoints points: the lowest and highest point in each of npoints/2 buckets
+    of consecutive points (plus the first and last points), in their original order
+    """
+    import numpy as np
+    ntot = len(xs)
+    if npoints >= ntot or npoints < 4:
+        return np.arange(ntot)
+    edges = np.linspace(0, ntot, npoints//2+1).astype(int)
+    indices = [0, ntot-1]
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        indices.append(lo + int(ys[lo:hi].argmin()))
+        indices.append(lo + int(ys[lo:hi].argmax()))
+    return np.unique(indices)
+
+decimation_methods = {
+        "lttb": lttb_indices,
+        "minmax": minmax_indices,
+        }
+
+def get_output_names(opts):
+    """
+    List of files to save a plot to. output_name can be a name or a list of names,
+    output_formats replaces their extension with each of the ones given,
+    and output_jsroot adds a .json next to the first one
+    """
+    names = opts["output_name"]
+    if not isinstance(names, (list, tuple)): names = [names]
+    if opts["output_formats"]:
+        names = ["{}.{}".format(os.path.splitext(name)[0], fmt.lstrip(".")) for name in names for fmt in opts["output_formats"]]
+    if opts["output_jsroot"]:
+        names = list(names) + ["{}.json".format(os.path.splitext(names[0])[0])]
+    unique_names = []
+    for name in names:
+        if name not in unique_names: unique_names.append(name)
+    return unique_names
+
+def is_chunk_iterator(vals):
+    return not isinstance(vals, (list, tuple)) and not hasattr(vals, "__len__") and hasattr(vals, "__iter__")
+
+def iter_fill_chunks(xvals, yvals=None, weights=None, chunk_size=1<<20):
+    """
+    Yield (x, y, w) C-contiguous float64 arrays of at most chunk_size entries (y and w can be None).
+    Inputs can be anything numpy can view as an array (lists, buffers, np.memmap, ...),
+    which are sliced lazily so only one converted chunk is in memory at a time,
+    or iterators over such chunks. Nothing is copied when the data is already contiguous float64.
+    Raises ValueError if yvals or weights don't have as many entries (or chunks) as xvals.
+    """
+    import numpy as np
+    if is_chunk_iterator(xvals):
+        ys = iter(yvals) if yvals is not None else None
+        ws = iter(weights) if weights is not None else None
+        missing = object()
+        for xchunk in xvals:
+            ychunk = next(ys, missing) if ys is not None else None
+            wchunk = next(ws, missing) if ws is not None else None
+            if ychunk is missing or wchunk is missing:
+                raise ValueError("{} has fewer chunks than xvals".format("yvals" if ychunk is missing else "weights"))
+            for chunk in iter_fill_chunks(xchunk, ychunk, wchunk, chunk_size=chunk_size):
+                yield chunk
+        for name, rest in (("yvals", ys), ("weights", ws)):
+            if rest is not None and next(rest, missing) is not missing:
+                raise ValueError("{} has more chunks than xvals".format(name))
+        return
+    xvals = np.asarray(xvals)
+    if yvals is not None: yvals = np.asarray(yvals)
+    if weights is not None: weights = np.asarray(weights)
+    for name, vals in (("yvals", yvals), ("weights", weights)):
+        if vals is not None and len(vals) != len(xvals):
+            raise ValueError("{} has {} entries, but xvals has {}".format(name, len(vals), len(xvals)))
+    for start in range(0, len(xvals), chunk_size):
+        sl = slice(start, start+chunk_size)
+        yield tuple(
+                np.ascontiguousarray(vals[sl], dtype=np.double) if vals is not None else None
+                for vals in (xvals, yvals, weights)
+                )
+
+def fill_chunk(hist, x, y=None, w=None):
+    # a null weight pointer means unit weights to FillN, so don't allocate them
+    if w is None: w = r.nullptr
+    if y is None:
+        hist.FillN(len(x),x,w)
+    else:
+        hist.FillN(len(x),x,y,w)
 
-def fill_fast(hist, xvals, yvals=None, weights=None):
+def fill_fast(hist, xvals, yvals=None, weights=None, chunk_size=1<<20, threads=1):
     """
     partially stolen from root_numpy implementation
     using for loop with TH1::Fill() is slow, so use
-    numpy to convert array to C-style array, and then FillN
+    numpy to convert array to C-style array, and then FillN.
+    The input is converted and filled chunk_size entries at a time (see iter_fill_chunks
+    for what can be passed), so memory-mapped arrays larger than RAM and iterators
+    over chunks work too. With threads > 1, chunks are filled into per-thread copies
+    of the histogram in parallel, which are then added to `hist`; this needs ROOT's
+    thread safety, so call ROOT.EnableThreadSafety() once beforehand.
+    If the inputs turn out to be bad (e.g., iterators with different numbers of chunks),
+    ValueError is raised and `hist` is left as it was.
+    """
+    chunks = iter_fill_chunks(xvals, yvals, weights, chunk_size=chunk_size)
+    def empty_copy(suffix):
+        # clone in this thread, since Clone touches gDirectory
+        partial = hist.Clone("{}_{}".format(hist.GetName(),suffix))
+        partial.SetDirectory(0)
+        partial.Reset()
+        return partial
+    if threads <= 1:
+        # arrays are checked before the first chunk, but iterators only at the end,
+        # so fill those into a copy that's only added to hist once they're all good
+        target = empty_copy("fill") if is_chunk_iterator(xvals) else hist
+        for x, y, w in chunks:
+            fill_chunk(target, x, y, w)
+        if target is not hist: hist.Add(target)
+        return
+
+    partials = [empty_copy("fill{}".format(ithread)) for ithread in range(threads)]
+
+    # bounded, so that only a few converted chunks are in memory at a time
+    work = queue.Queue(maxsize=2*threads)
+    errors = []
+    def fill_worker(partial):
+        while True:
+            chunk = work.get()
+            if chunk is None: break
+            try:
+                fill_chunk(partial, *chunk)
+            except Exception as e:
+                errors.append(e)
+    # FillN doesn't call back into python, so let the other threads run while filling. This is
+    # a setting of the method for the whole class, so it's restored afterwards for everyone else.
+    fill_n = type(hist).FillN
+    release_gil = getattr(fill_n, "__release_gil__", None)
+    try:
+        fill_n.__release_gil__ = True
+    except AttributeError:
+        fill_n = None
+    workers = [threading.Thread(target=fill_worker, args=(partial,)) for partial in partials]
+    for worker in workers: worker.start()
+    try:
+        for chunk in chunks:
+            work.put(chunk)
+    finally:
+        for _ in workers: work.put(None)
+        for worker in workers: worker.join()
+        if fill_n is not None: fill_n.__release_gil__ = bool(release_gil)
+    if errors: raise errors[0]
+    for partial in partials:
+        hist.Add(partial)
+
+color_darkness_cache = {}
+
+def get_color_darkness(code):
+    """
+    Darkness of a color index (cached, since the palette colors don't change)
+    """
+    if code not in color_darkness_cache:
+        color = r.gROOT.GetColor(code)
+        color_darkness_cache[code] = compute_darkness(color.GetRed(), color.GetGreen(), color.GetBlue())
+    return color_darkness_cache[code]
+
+def get_frame_pixels(pad):
+    """
+    Width and height in pixels of the area inside the margins of a pad
+    """
+    wpx = pad.GetWw()*pad.GetAbsWNDC()
+    hpx = pad.GetWh()*pad.GetAbsHNDC()
+    return (int(wpx*(1.-pad.GetLeftMargin()-pad.GetRightMargin())),
+            int(hpx*(1.-pad.GetBottomMargin()-pad.GetTopMargin())))
+
+def downsample_2d(hist, nx_max, ny_max, mode="sum", xrange=None, yrange=None, name=None):
+    """
+    Return a TH2D merging k x k' blocks of neighboring bins of hist, so that at most nx_max x ny_max bins
+    are shown (within xrange/yrange, if the axes are zoomed). Blocks start at the first visible bin, so the bins
+    in view are merged the same way whether or not the axis is zoomed. The edges at both ends of each axis stay
+    the same, but the first and last block along an axis can have fewer bins. With mode "sum", blocks get the sum of their bins,
+    and with "max", their largest bin, and the z range of hist is kept. Returns hist itself if it's small enough.
     """
     import numpy as np
-    xvals = np.asarray(xvals, dtype=np.double)
-    two_d = False
-    if yvals is not None:
-        two_d = True
-        yvals = np.asarray(yvals, dtype=np.double)
-    if weights is None:
-        weights = np.ones(len(xvals))
-    else:
-        weights = np.asarray(weights, dtype=np.double)
-    if not two_d:
-        hist.FillN(len(xvals),xvals,weights)
-    else:
-        hist.FillN(len(xvals),xvals,yvals,weights)
+    def visible_bins(edges, rng):
+        """
+        Index of the first visible bin, and the number of visible bins
+        """
+        if not rng: return 0, len(edges)-1
+        visible = np.flatnonzero((edges[1:] > rng[0]) & (edges[:-1] < rng[1]))
+        if not len(visible): return 0, 1
+        return int(visible[0]), len(visible)
+    def block_starts(edges, rng, n_max):
+        """
+        Indices of the first bin of each block, with blocks of k bins anchored at the first visible bin
+        """
+        first, nvisible = visible_bins(edges, rng)
+        k = int(math.ceil(1.*nvisible/max(n_max,1)))
+        starts = np.arange(first % k, len(edges)-1, k)
+        if first % k: starts = np.append(0, starts)
+        return k, starts
+    xedges = axis_edges(hist.GetXaxis())
+    yedges = axis_edges(hist.GetYaxis())
+    kx, ix = block_starts(xedges, xrange, nx_max)
+    ky, iy = block_starts(yedges, yrange, ny_max)
+    if kx <= 1 and ky <= 1:
+        return hist
+
+    reducer = {"sum": np.add, "max": np.maximum}[mode]
+    def pool(arr):
+        arr = np.asarray(arr, dtype=np.double)[1:-1,1:-1]
+        return reducer.reduceat(reducer.reduceat(arr, ix, axis=0), iy, axis=1)
+    contents, sumw2 = hist_arrays(hist)
+    if sumw2 is None: sumw2 = np.abs(contents)
+
+    new_xedges = np.ascontiguousarray(np.append(xedges[ix], xedges[-1]))
+    new_yedges = np.ascontiguousarray(np.append(yedges[iy], yedges[-1]))
+    new = r.TH2D(name or "{}_downsampled".format(hist.GetName()), hist.GetTitle(),
+            len(ix), new_xedges, len(iy), new_yedges)
+    new.SetDirectory(0)
+    new_contents, new_sumw2 = hist_arrays(new, create_sumw2=True)
+    new_contents[1:-1,1:-1] = pool(contents)
+    new_sumw2[1:-1,1:-1] = pool(sumw2)
+    new.ResetStats()
+    new.SetEntries(hist.GetEntries())
+    for axis, new_axis in [(hist.GetXaxis(), new.GetXaxis()), (hist.GetYaxis(), new.GetYaxis()), (hist.GetZaxis(), new.GetZaxis())]:
+        new_axis.SetTitle(axis.GetTitle())
+    if mode == "max":
+        new.SetMinimum(hist.GetMinimum())
+        new.SetMaximum(hist.GetMaximum())
+    return new
+
+def get_bin_label_block_size(hist, text_size, sample_text, threshold):
+    """
+    Number of bins k such that k x k blocks of bins on the current pad are at least
+    `threshold` times as large (in pixels) as the TLatex label `sample_text`
+    """
+    if threshold <= 0: return 1
+    pad = r.gPad
+    wpx = pad.GetWw()*pad.GetAbsWNDC()
+    hpx = pad.GetWh()*pad.GetAbsHNDC()
+    bin_w = wpx*(1.-pad.GetLeftMargin()-pad.GetRightMargin())/max(hist.GetNbinsX(),1)
+    bin_h = hpx*(1.-pad.GetBottomMargin()-pad.GetTopMargin())/max(hist.GetNbinsY(),1)
+    # measure the rendered label (so that e.g. #pm counts as one glyph), converting from pad coordinates to pixels
+    t = r.TLatex(0., 0., sample_text)
+    t.SetTextSize(text_size)
+    text_w = t.GetXsize()*wpx/max(pad.GetX2()-pad.GetX1(),1e-12)
+    text_h = t.GetYsize()*hpx/max(pad.GetY2()-pad.GetY1(),1e-12)
+    return max(1, int(math.ceil(threshold*max(text_w/max(bin_w,1e-9), text_h/max(bin_h,1e-9)))))
 
 def draw_smart_2d_bin_labels(hist,opts):
     """
     Replicate the TEXT draw option for TH2 with TLatex drawn everywhere
     but calculate the background color of each bin and draw text as
-    white or black depending on the darkness
+    white or black depending on the darkness.
+    If the bins are too small for the labels to be legible (see bin_text_lod_threshold),
+    labels are either drawn for blocks of bins (with their summed content) or skipped.
     """
-    darknesses = [] # darkness values
-    lights = [] # lighter colors
-    darks = [] # darker colors
+    import numpy as np
     ncolors = r.gStyle.GetNumberContours()
-    for ic in range(ncolors):
-        code = r.gStyle.GetColorPalette(ic)
-        color = r.gROOT.GetColor(code)
-        red = color.GetRed()
-        green = color.GetGreen()
-        blue = color.GetBlue()
-        darks.append(r.TColor.GetColorDark(code))
-        lights.append(r.TColor.GetColorBright(code))
-        darkness = compute_darkness(red, green, blue)
-        darknesses.append(darkness)
-    labels = []
+    darknesses = np.array([get_color_darkness(r.gStyle.GetColorPalette(ic)) for ic in range(ncolors)])
     zlow, zhigh = max(1,hist.GetMinimum()), hist.GetMaximum()
     if opts["zaxis_range"]: zlow, zhigh = opts["zaxis_range"]
+    text_size = 0.025
+    fmt = opts["bin_text_format_smart"]
+    vals = hist_arrays(hist)[0][1:-1,1:-1].astype(float)
+    errs = hist_errors(hist)[1:-1,1:-1]
+    xedges = axis_edges(hist.GetXaxis())
+    yedges = axis_edges(hist.GetYaxis())
+
+    vmax = np.abs(vals).max() if vals.size else 0.
+    sample_text = fmt.format(vmax, math.sqrt(vmax))
+    k = get_bin_label_block_size(hist, text_size, sample_text, opts["bin_text_lod_threshold"])
+    if k > 1:
+        if opts["bin_text_lod_mode"] == "skip":
+            print(">>> Bins are too small for legible text, so not drawing bin labels")
+            return
+        # sum k x k blocks of bins (errors in quadrature), padding the edges with empty bins
+        nx, ny = vals.shape
+        bx, by = -(-nx//k), -(-ny//k)
+        padded_vals = np.zeros((bx*k, by*k))
+        padded_errs2 = np.zeros((bx*k, by*k))
+        padded_vals[:nx,:ny] = vals
+        padded_errs2[:nx,:ny] = errs**2.
+        vals = padded_vals.reshape(bx,k,by,k).sum(axis=(1,3))
+        errs = padded_errs2.reshape(bx,k,by,k).sum(axis=(1,3))**0.5
+        nbins_block = np.zeros((bx*k, by*k))
+        nbins_block[:nx,:ny] = 1.
+        nbins_block = nbins_block.reshape(bx,k,by,k).sum(axis=(1,3))
+        xedges = np.append(xedges[::k], xedges[-1])[:bx+1]
+        yedges = np.append(yedges[::k], yedges[-1])[:by+1]
+        # pick the text color from the average content, which is what the block looks like
+        colorvals = vals/nbins_block
+        print(">>> Bins are too small for legible text, so labeling blocks of {0}x{0} bins".format(k))
+    else:
+        colorvals = vals
+
+    xcents = 0.5*(xedges[1:]+xedges[:-1])
+    ycents = 0.5*(yedges[1:]+yedges[:-1])
+    ixs, iys = vals.nonzero()
+    cvals = np.minimum(colorvals[ixs,iys], zhigh)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if opts["zaxis_log"]:
+            fracs = (np.log(np.maximum(cvals,zlow))-math.log(zlow))/(math.log(zhigh)-math.log(zlow))
+        else:
+            fracs = (cvals-zlow)/(zhigh-zlow)
+    keep = ~(fracs > 1.)
+    idxs = np.clip(np.nan_to_num(fracs*(len(darknesses)-1)).astype(int), 0, len(darknesses)-1)
+    colors = np.where(darknesses[idxs] < 0.7, r.kBlack, r.kWhite)
+
     t = r.TLatex()
     t.SetTextAlign(22)
-    t.SetTextSize(0.025)
-    fmt = opts["bin_text_format_smart"]
-    for ix in range(1,hist.GetNbinsX()+1):
-        for iy in range(1,hist.GetNbinsY()+1):
-            xcent = hist.GetXaxis().GetBinCenter(ix)
-            ycent = hist.GetYaxis().GetBinCenter(iy)
-            val = hist.GetBinContent(ix,iy)
-            err = hist.GetBinError(ix,iy)
-            if val == 0: continue
-            if opts["zaxis_log"]:
-                frac = (math.log(min(val,zhigh))-math.log(zlow))/(math.log(zhigh)-math.log(zlow))
-            else:
-                frac = (min(val,zhigh)-zlow)/(zhigh-zlow)
-            if frac > 1.: continue
-            idx = int(frac*(len(darknesses)-1))
-            if darknesses[idx] < 0.7:
-                t.SetTextColor(r.kBlack)
-            else:
-                t.SetTextColor(r.kWhite)
-            # t.SetTextColor(darks[idx])
-            t.DrawLatex(xcent,ycent,fmt.format(val,err))
-            labels.append(t)
-
-def smart_legend(legend, bgs, data=None, ymin=0., ymax=None, Nx=25, Ny=25, niters=7, opts={}):
+    t.SetTextSize(text_size)
+    for ix, iy, color in zip(ixs[keep], iys[keep], colors[keep]):
+        t.SetTextColor(int(color))
+        t.DrawLatex(float(xcents[ix]),float(ycents[iy]),fmt.format(float(vals[ix,iy]),float(errs[ix,iy])))
+
+def smart_legend(legend, bgs, data=None, ymin=0., ymax=None, Nx=25, Ny=25, niters=7, opts={}, stack_model=None):
     """
     Given a TLegend, backgrounds, and optionally data,
     find a location where the TLegend doesn't overlap these objects
     preserving the width and height of the TLegend object
     by scanning over a Nx x Ny grid. If a non-overlapping position is not
-    found, we decrease the legend width and height and try scanning again.
-    Repeat this `niters` times before giving up.
+    found, we decrease the legend width and height (by factors of 0.9, up to
+    `niters` times) and try scanning again. All candidate positions are checked
+    at once with numpy, and the shrink factor is found by bisection.
     """
-
+    import numpy as np
 
     debug = False # draw bounding boxes, etc
 
-    def bar_in_box(coords_first,coords_second, exclude_if_below=True):
-        # return true if any part of bar (top of bar represented by (x1,y1))
-        # overlaps with box (bx1,bx2,by1,by2)
-        # if !exclude_if_below, then we allow the box if it's above OR below the point
-        x1,y1 = coords_first
-        bx1,bx2,by1,by2 = coords_second
-        does_x_overlap = bx1 <= x1 <= bx2
-        if does_x_overlap:
-            if exclude_if_below:
-                return y1 > by1
-            else:
-                return by1 <= y1 <= by2
-        else: return False
-
-    def point_in_box(coords_first, coords_second):
-        x1,y1 = coords_first
-        bx1, bx2, by1, by2 = coords_second
-        # return true if point is in box
-        return (by1 <= y1 <= by2) or (bx1 <= x1 <= bx2)
-
-    def is_good_legend(coords, pseudo_legend, exclude_if_below=True):
-        # return true if this pseudolegend (given by 4-tuple pseudo_legend)
-        # is a good legend (i.e., doesn't overlap with list of pairs in coords
-        for coord in coords:
-            if bar_in_box(coord, pseudo_legend, exclude_if_below=exclude_if_below): return False
-        return True
-
-    def distance_from_corner(pseudo_legend):
-        # return euclidean distance of corner of pseudo legend cloest to plot
-        # pane corner (note, this is rough)
-        x1,x2,y1,y2 = pseudo_legend
-        dist = 0.
-        if 0.5*(y1+y2) > 0.5: dist += (1.0-y2)**2.
-        else: dist += (y1)**2.
-        if 0.5*(x1+x2) > 0.5: dist += (1.0-x2)**2.
-        else: dist += (x1)**2.
-        return dist**0.5
-
-    allbgs = bgs[0].Clone("allbgs")
-    allbgs.Reset()
+    # height of the tallest thing drawn in each bin
+    if stack_model is None: stack_model = StackModel(bgs)
     if opts["do_stack"]:
-        for hist in bgs:
-            allbgs.Add(hist)
+        tops = stack_model.total[1:-1]
+    elif opts["draw_points"]:
+        tops = (stack_model.vals + stack_model.errors()).max(axis=0)[1:-1]
     else:
-        for ibin in range(1,allbgs.GetNbinsX()+1):
-            allbgs.SetBinContent(ibin, max(hist.GetBinContent(ibin) for hist in bgs))
-            if opts["draw_points"]:
-                allbgs.SetBinContent(ibin, max(hist.GetBinContent(ibin)+hist.GetBinError(ibin) for hist in bgs))
+        tops = stack_model.vals.max(axis=0)[1:-1]
 
     if not ymax:
-        ymax = allbgs.GetMaximum()
+        ymax = tops.max()
 
 
     # get coordinates of legend corners
@@ -568,33 +1114,30 @@ def smart_legend(legend, bgs, data=None, ymin=0., ymax=None, Nx=25, Ny=25, niter
     leg_y2 = legend.GetY2()
     legend_coords = (leg_x1,leg_x2,leg_y1,leg_y2)
     legend_width, legend_height = leg_x2 - leg_x1, leg_y2 - leg_y1
-    xmin = allbgs.GetBinLowEdge(1)
-    xmax = allbgs.GetBinLowEdge(allbgs.GetNbinsX()) + allbgs.GetBinWidth(allbgs.GetNbinsX())
-    coords = []
+    edges = axis_edges(bgs[0].GetXaxis())
+    xmin, xmax = edges[0], edges[-1]
     extra_coords = []
 
     # coords veto a legend if they are within the box, or
     # if the box is below the coord
-    for ibin in range(1,allbgs.GetNbinsX()+1):
-        xval = allbgs.GetBinCenter(ibin)
-        yval = allbgs.GetBinContent(ibin)
+    xvals = 0.5*(edges[1:]+edges[:-1])
+    yvals = tops
+    if data:
         # if we have data, and it's higher than bgs, then use that value
-        if data and data.GetBinContent(ibin)+data.GetBinError(ibin) > yval:
-            xval = data.GetBinCenter(ibin)
-            yval = data.GetBinContent(ibin)
-            yval += 1.0*data.GetBinError(ibin)
-        yfrac = (yval - ymin) / (ymax - ymin)
-        xfrac = (xval - xmin) / (xmax - xmin)
-
-        if opts["yaxis_log"]:
-            ymin = max(ymin,0.1)
-            yfrac = 1.*(math.log(min(yval,ymax))-math.log(ymin))/(math.log(ymax)-math.log(ymin))
-
-        # convert from 0..1 inside plotting pane, to pad coordinates (stupid margins)
-        xcoord = xfrac * (1. - r.gPad.GetLeftMargin() - r.gPad.GetRightMargin()) + r.gPad.GetLeftMargin()
-        ycoord = yfrac * (1. - r.gPad.GetTopMargin() - r.gPad.GetBottomMargin()) + r.gPad.GetBottomMargin()
-        coord = (xcoord, ycoord)
-        coords.append(coord)
+        data_vals = hist_arrays(data)[0][1:-1] + hist_errors(data)[1:-1]
+        yvals = np.where(data_vals > yvals, data_vals, yvals)
+    yfrac = (yvals - ymin) / (ymax - ymin)
+    xfrac = (xvals - xmin) / (xmax - xmin)
+
+    if opts["yaxis_log"]:
+        ymin = max(ymin,0.1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            yfrac = 1.*(np.log(np.minimum(yvals,ymax))-math.log(ymin))/(math.log(ymax)-math.log(ymin))
+
+    # convert from 0..1 inside plotting pane, to pad coordinates (stupid margins)
+    xcoords = xfrac * (1. - r.gPad.GetLeftMargin() - r.gPad.GetRightMargin()) + r.gPad.GetLeftMargin()
+    ycoords = yfrac * (1. - r.gPad.GetTopMargin() - r.gPad.GetBottomMargin()) + r.gPad.GetBottomMargin()
+    coords = np.column_stack([xcoords, ycoords])
 
     # # NOTE: bugged. can't seem to get NDC for TLatex, only user
     # # extra_coords to veto a legend if they are within the box
@@ -608,111 +1151,116 @@ def smart_legend(legend, bgs, data=None, ymin=0., ymax=None, Nx=25, Ny=25, niter
     #     extra_coords.append([x1,y1])
     #     extra_coords.append([x2,y1])
 
+    extra_coords = np.array(extra_coords, dtype=np.double).reshape(-1,2)
+
+    # lower left corners of the legend candidates, on a Nx x Ny grid
+    # (same ordering as scanning x in the outer loop and y in the inner loop)
+    paddingx = 0.03
+    paddingy = 0.03
+    xhigh = 1.-r.gPad.GetRightMargin()-paddingx
+    yhigh = 1.-r.gPad.GetTopMargin()-paddingy
+    cand_x1, cand_y1 = np.meshgrid(
+            1.0*np.arange(Nx)/Nx + paddingx + r.gPad.GetLeftMargin(),
+            1.0*np.arange(Ny)/Ny + paddingy + r.gPad.GetBottomMargin(),
+            indexing="ij")
+    cand_x1, cand_y1 = cand_x1.ravel(), cand_y1.ravel()
+    inside = (cand_x1 <= xhigh) & (cand_y1 <= yhigh)
+    cand_x1, cand_y1 = cand_x1[inside], cand_y1[inside]
+
+    def get_good_legends(width, height):
+        # return a mask of candidates with given width and height that fit
+        # inside the pad and don't overlap any of the coords
+        cand_x2 = cand_x1 + width
+        cand_y2 = cand_y1 + height
+        good = (cand_x2 <= xhigh) & (cand_y2 <= yhigh)
+        # a bar (top of bar represented by a coord) vetoes the candidate if it's
+        # within the x range and the box is below the top of the bar
+        xs, ys = coords[:,0], coords[:,1]
+        does_x_overlap = (cand_x1[:,None] <= xs) & (xs <= cand_x2[:,None])
+        good &= ~(does_x_overlap & (ys > cand_y1[:,None])).any(axis=1)
+        # extra coords veto the candidate only if they are inside the box
+        xs, ys = extra_coords[:,0], extra_coords[:,1]
+        does_x_overlap = (cand_x1[:,None] <= xs) & (xs <= cand_x2[:,None])
+        good &= ~(does_x_overlap & (cand_y1[:,None] <= ys) & (ys <= cand_y2[:,None])).any(axis=1)
+        return good, cand_x2, cand_y2
+
+    def distance_from_corner(x1, x2, y1, y2):
+        # return euclidean distance of corner of pseudo legend cloest to plot
+        # pane corner (note, this is rough)
+        dist = np.where(0.5*(y1+y2) > 0.5, (1.0-y2)**2., y1**2.)
+        dist += np.where(0.5*(x1+x2) > 0.5, (1.0-x2)**2., x1**2.)
+        return dist**0.5
+
+    # shrinking the legend can only remove overlaps, so bisect on the number
+    # of times we need to shrink by 0.9 rather than trying them one by one
+    def fits(ishrink):
+        good, _, _ = get_good_legends(legend_width*0.9**ishrink, legend_height*0.9**ishrink)
+        return good.any()
+
+    if not fits(niters-1):
+        print(">>> Tried to reduce legend width, height {} times, but still couldn't find a good position!".format(niters))
+        return
+
+    low, high = -1, niters-1
+    while high - low > 1:
+        mid = (low + high) // 2
+        if fits(mid): high = mid
+        else: low = mid
+    if high > 0:
+        print(">>> Smart legend had to decrease legend height and width {} times".format(high))
+
+    legend_width *= 0.9**high
+    legend_height *= 0.9**high
+    good, cand_x2, cand_y2 = get_good_legends(legend_width, legend_height)
+    igood = np.flatnonzero(good)
+    dists = distance_from_corner(cand_x1[igood], cand_x2[igood], cand_y1[igood], cand_y2[igood])
+    # argmin picks the first of equally good candidates, like a stable sort would
+    ibest = igood[np.argmin(dists)]
+    legend.SetX1(cand_x1[ibest])
+    legend.SetX2(cand_x2[ibest])
+    legend.SetY1(cand_y1[ibest])
+    legend.SetY2(cand_y2[ibest])
+
     if debug:
-        # draw x's to debug
+        # draw x's and the good candidates to debug
         t = r.TLatex()
         t.SetTextAlign(22)
         t.SetTextFont(42)
         t.SetTextColor(r.kRed)
         t.SetTextSize(0.05)
-        for coord in coords:
-            t.DrawLatexNDC(coord[0],coord[1],"x")
-        for coord in extra_coords:
+        for coord in list(coords)+list(extra_coords):
             t.DrawLatexNDC(coord[0],coord[1],"x")
 
         line = r.TLine()
-        line.SetLineColor(r.kRed)
-
-    # generate list of legend coordinate candidates, preserving original width, height
-    # move around the original legend by Nx increments in x and Ny in y
-    # if we don't find anything, decrease the size and try again
-    paddingx = 0.03
-    paddingy = 0.03
-    for iiter in range(niters):
-        pseudo_legends = []
-        for ix in range(Nx):
-            pseudox1 = 1.0*ix/Nx + paddingx + r.gPad.GetLeftMargin()
-            if pseudox1 > 1.-r.gPad.GetRightMargin()-paddingx: continue
-            pseudox2 = pseudox1 + legend_width
-            if pseudox2 > 1.-r.gPad.GetRightMargin()-paddingx: continue
-            for iy in range(Ny):
-                pseudoy1 = 1.0*iy/Ny + paddingy + r.gPad.GetBottomMargin()
-                if pseudoy1 > 1.-r.gPad.GetTopMargin()-paddingy: continue
-                pseudoy2 = pseudoy1 + legend_height
-                if pseudoy2 > 1.-r.gPad.GetTopMargin()-paddingy: continue
-                pseudo_legends.append([pseudox1,pseudox2,pseudoy1,pseudoy2])
-
-        good_pseudo_legends = []
-        for pseudo_legend in pseudo_legends:
-            if not is_good_legend(coords, pseudo_legend): continue
-            if not is_good_legend(extra_coords, pseudo_legend, exclude_if_below=False): continue
-            good_pseudo_legends.append(pseudo_legend)
-
-            if debug:
-                xr = random.random()*0.05 - 0.025
-                yr = random.random()*0.05 - 0.025
-                x1, x2, y1, y2 = pseudo_legend
-                line.SetLineColor(int(50*random.random()))
-                line.DrawLineNDC(x1+xr,y1+yr,x2+xr,y1+yr)
-                line.DrawLineNDC(x2+xr,y1+yr,x2+xr,y2+yr)
-                line.DrawLineNDC(x2+xr,y2+yr,x1+xr,y2+yr)
-                line.DrawLineNDC(x1+xr,y2+yr,x1+xr,y1+yr)
-
-        good_pseudo_legends = sorted(good_pseudo_legends, key=lambda x: distance_from_corner(x))
-        if len(good_pseudo_legends) > 0:
-            legend.SetX1(good_pseudo_legends[0][0])
-            legend.SetX2(good_pseudo_legends[0][1])
-            legend.SetY1(good_pseudo_legends[0][2])
-            legend.SetY2(good_pseudo_legends[0][3])
-            break
-        else:
-            print(">>> Running another smart legend iteration decreasing legend height and width")
-            legend_width *= 0.9
-            legend_height *= 0.9
-    else:
-        print(">>> Tried to reduce legend width, height {} times, but still couldn't find a good position!".format(niters))
+        for x1, x2, y1, y2 in zip(cand_x1[igood], cand_x2[igood], cand_y1[igood], cand_y2[igood]):
+            xr = random.random()*0.05 - 0.025
+            yr = random.random()*0.05 - 0.025
+            line.SetLineColor(int(50*random.random()))
+            line.DrawLineNDC(x1+xr,y1+yr,x2+xr,y1+yr)
+            line.DrawLineNDC(x2+xr,y1+yr,x2+xr,y2+yr)
+            line.DrawLineNDC(x2+xr,y2+yr,x1+xr,y2+yr)
+            line.DrawLineNDC(x1+xr,y2+yr,x1+xr,y1+yr)
 
 
 def diff_images(fname1, fname2, output="diff.png"):
     """
     Creates a file `output` that represents a diff of two input images
-    `fname1` and `fname`. If these are .pdf, they will be first converted to .png.
+    `fname1` and `fname`. If these are .pdf, they will be first rasterized.
+    To compare whole directories of plots, see regression.compare_dirs.
     Example:
     >>> utils.diff_images("examples/test1.pdf", "examples/test3.pdf", output="diff.png")
     >>> os.system("ic diff.png")
     """
-    import numpy as np
     import matplotlib.pylab as plt
-    conversion_cmd = "gs -q -sDEVICE=pngalpha -o {outname} -sDEVICE=pngalpha -dUseCropBox -r{density} {inname}"
-    # conversion_cmd = "convert -density {density} -trim {inname} -fuzz 1% {outname}"
-    new_fnames = []
-    for fname in [fname1, fname2]:
-        if fname.rsplit(".",1)[-1] == "pdf":
-            fname_in = fname
-            fname_out = fname.replace(".pdf",".png")
-            os.system(conversion_cmd.format(density=75, inname=fname_in, outname=fname_out))
-            new_fnames.append(fname_out)
-    if len(new_fnames) == 2: fname1, fname2 = new_fnames
-    # img1 = plt.imread(fname1)[::2,::2] # downsample by factor of 2
-    # img2 = plt.imread(fname2)[::2,::2]
-    img1 = plt.imread(fname1)
-    img2 = plt.imread(fname2)
-
-    # Calculate the absolute difference on each channel separately
-    error_r = np.fabs(np.subtract(img2[:,:,0], img1[:,:,0]))
-    error_g = np.fabs(np.subtract(img2[:,:,1], img1[:,:,1]))
-    error_b = np.fabs(np.subtract(img2[:,:,2], img1[:,:,2]))
-
-    lum_img = np.sqrt(error_r*error_r + error_g+error_g + error_b*error_b)/np.sqrt(3)
-
-    # # # Calculate the maximum error for each pixel
-    # lum_img = np.maximum(np.maximum(error_r, error_g), error_b)
-
-    # plt.set_cmap('Spectral')
+    from . import regression
+    img1 = regression.rasterize(fname1)
+    img2 = regression.rasterize(fname2)
+    lum_img = regression.difference_image(img1, img2)
     plt.set_cmap('gray')
     plt.imsave(output,-lum_img)
 
-def draw_rounded_box(x1,y1,x2,y2,radius=0.05,width=2,color=r.kGray,alpha=0.5,expand=0.0,_persist=[]):
+def draw_rounded_box(x1,y1,x2,y2,radius=0.05,width=2,color=None,alpha=0.5,expand=0.0):
+    if color is None: color = r.kGray
     x1 -= expand
     x2 += expand
     y1 -= expand
@@ -729,7 +1277,7 @@ def draw_rounded_box(x1,y1,x2,y2,radius=0.05,width=2,color=r.kGray,alpha=0.5,exp
     atr = MyArc(x2-radius,y2-radius,radius,0,90)
 
     coll = [lb,ll,lr,lt,abl,abr,atl,atr]
-    _persist.extend(coll)
+    persist(*coll)
 
     def f(obj):
         obj.SetBit(r.TLine.kLineNDC)
@@ -739,7 +1287,7 @@ def draw_rounded_box(x1,y1,x2,y2,radius=0.05,width=2,color=r.kGray,alpha=0.5,exp
 
     list(map(f, coll))
 
-def draw_shadow_rounded_box(x1,y1,x2,y2,radius=0.05,width=2,color=r.kGray,alpha=0.5,expand=0.0):
+def draw_shadow_rounded_box(x1,y1,x2,y2,radius=0.05,width=2,color=None,alpha=0.5,expand=0.0):
     for amult,ex in [
             (0.50, 0.002),
             (0.75, 0.001),